@@ -5,6 +5,8 @@ suff=$3
 seed=$4
 load=$5
 sampling=$6
+# further trainer options, e.g. --quantize to score the pool in int8
+extra=${@:7}
 
 lr=0.001
 scheduler=reducewhenstuck
@@ -43,4 +45,4 @@ python3 src/active_learning_train.py \
     --src_layer $layers --trg_layer $layers --max_norm 1 --lr $lr --shuffle \
     --arch $arch --gpuid 0 --estop 1e-8 --bs $bs --max_steps $max_steps \
     --scheduler $scheduler --warmup_steps $warmup --cleanup_anyway --beta2 $beta2 --bestacc \
-    --seed $seed --load $load --sampling $sampling
+    --seed $seed --load $load --sampling $sampling $extra
@@ -0,0 +1,55 @@
+#!/bin/bash
+# Same experiment as training_loop.sh, with all rounds of a seed in one process.
+# Pass --resume as the 4th argument to continue after the last finished round.
+# Each seed writes to its own checkpoint directory.
+# Use src/membership.py to export the train/pool files of a round.
+lang=${1:-kor}
+arch=${2:-transformer}
+sampling=${3:-information_density}
+resume=$4
+
+suff=al
+lr=0.001
+scheduler=reducewhenstuck
+max_steps=5000
+warmup=1000
+beta2=0.98       # 0.999
+label_smooth=0.1 # 0.0
+total_eval=100
+bs=400 # 256
+rounds=25
+num_samples=250
+
+# transformer
+layers=4
+hs=1024
+embed_dim=256
+nb_heads=4
+dropout=0.3
+ckpt_dir=checkpoints/sig22
+
+trn_path=../2022InflectionST/part1/development_languages
+tst_path=../2022InflectionST/part1/development_languages
+
+for seed in 2594 28399 15102 506 27827; do
+    model=$ckpt_dir/$arch/$seed/$lang"_"$suff
+    # The train and pool files are never rewritten, {model}.membership.npz
+    # records which pool samples have moved to the train set and
+    # {model}.density.npz the information density of the remaining pool
+
+    python3 src/active_learning_loop.py \
+        --dataset sigmorphon17task1 \
+        --train $trn_path/$lang"_"$suff.train \
+        --dev $trn_path/$lang.dev \
+        --test $tst_path/$lang"_pool".train \
+        --gold $tst_path/$lang.gold \
+        --model $model \
+        --decode greedy --eval_decode beam --max_decode_len 32 \
+        --embed_dim $embed_dim --src_hs $hs --trg_hs $hs --dropout $dropout --nb_heads $nb_heads \
+        --label_smooth $label_smooth --total_eval $total_eval \
+        --src_layer $layers --trg_layer $layers --max_norm 1 --lr $lr --shuffle \
+        --arch $arch --gpuid 0 --estop 1e-8 --bs $bs --max_steps $max_steps \
+        --scheduler $scheduler --warmup_steps $warmup --beta2 $beta2 --bestacc \
+        --rounds $rounds --num_samples $num_samples --sampling $sampling --lang $lang \
+        --seed $seed $resume
+done
@@ -94,7 +94,7 @@ def resample_and_calculate_entropy(files_data, uncertainty_metric="entropy"):
 
     return results, sorted(entropies, key=lambda x: x[-1], reverse=True)[:250]
 
-def main(directory, i, train_file, test_file, uncertainty_metric="entropy"):
+def main(directory, i, train_file, test_file, uncertainty_metric="entropy", membership_file=None):
     files_data = read_tsv_files(directory, i)
     results, uncertain_samples_indices = resample_and_calculate_entropy(files_data, uncertainty_metric)
 
@@ -105,6 +105,17 @@ def main(directory, i, train_file, test_file, uncertainty_metric="entropy"):
         for result in results:
             writer.writerow(result)
 
+    if membership_file is not None:
+        # Move the uncertain samples without rewriting the training and test files
+        sys.path.insert(0, "src")
+        from membership import Membership
+
+        membership = Membership.load(membership_file)
+        membership.move_to_train([idx for idx, _ in uncertain_samples_indices])
+        membership.save(membership_file)
+        print(f"Moved {len(uncertain_samples_indices)} uncertain samples to the training set in {membership_file}.")
+        return
+
     # Read the actual test data
     with open(test_file, 'r', encoding="utf-8") as f:
         test_data = [line.strip() for line in f.readlines()]
@@ -120,20 +131,22 @@ def main(directory, i, train_file, test_file, uncertainty_metric="entropy"):
         print(f"Added {len(uncertain_samples_indices)} uncertain samples to the training file.")
 
     # Rewrite the test file without the selected uncertain samples
+    selected = set(sample[0] for sample in uncertain_samples_indices)
     with open(test_file, 'w', encoding="utf-8") as f:
         for idx, line in enumerate(test_data):
-            if idx not in [sample[0] for sample in uncertain_samples_indices]:
+            if idx not in selected:
                 f.write(line + '\n')
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Usage: python script_name.py <learning_step> <train_file> <test_file> <uncertainty_metric>")
+    if len(sys.argv) not in (5, 6):
+        print("Usage: python script_name.py <learning_step> <train_file> <test_file> <uncertainty_metric> [<membership_file>]")
         sys.exit(1)
 
     i = sys.argv[1]
     train_file = sys.argv[2]
     test_file = sys.argv[3]
     uncertainty_metric = sys.argv[4]
+    membership_file = sys.argv[5] if len(sys.argv) == 6 else None
     directory = "checkpoints/sig22/transformer"
-    main(directory, i, train_file, test_file, uncertainty_metric)
+    main(directory, i, train_file, test_file, uncertainty_metric, membership_file)
@@ -0,0 +1,290 @@
+"""
+active learning rounds in a single process
+"""
+import glob
+import os
+import shutil
+from dataclasses import replace
+
+import torch
+
+from active_learning_train import Trainer
+from decoding import Decode, get_decode_fn
+from ensemble import StackedTransformerEnsemble, TransformerEnsemble
+from trainer import TEST, setup_seed
+
+
+def difficulty_level(train_lemmas, train_features, lemma, feature):
+    lemma_present = lemma in train_lemmas
+    feature_present = feature in train_features
+    if lemma_present and feature_present:
+        return 1
+    elif lemma_present:
+        return 2
+    elif feature_present:
+        return 3
+    else:
+        return 4
+
+
+class ActiveLearningTrainer(Trainer):
+    """
+    keep the vocab, the encoded train/pool/gold data and the trainer state in
+    memory, while running train -> evaluate -> score pool -> select every round.
+    the train and pool files are the master dataset, read through --membership
+    """
+
+    def set_args(self):
+        """
+        get_args
+        """
+        # fmt: off
+        super().set_args()
+        parser = self.parser
+        parser.add_argument('--gold', required=True, type=str, help='file evaluated after every round')
+        parser.add_argument('--rounds', default=25, type=int, help='number of active learning rounds')
+        parser.add_argument('--num_samples', default=250, type=int, help='number of pool samples selected per round')
+        parser.add_argument('--lang', default='kor', type=str, help='language code of the density file')
+        parser.add_argument('--eval_decode', default=Decode.beam, type=Decode, choices=list(Decode), help='decoding for evaluation and pool scoring')
+        parser.add_argument('--resume', default=False, action='store_true', help='continue after the last finished round')
+        parser.add_argument('--warm_start_rounds', default=False, action='store_true', help='fine-tune the best model of the previous round instead of training from scratch, see --warm_start_budget')
+        parser.add_argument('--ensemble_seeds', default=[], nargs='+', type=int, help='train one model per seed every round and evaluate and select with their ensemble')
+        # fmt: on
+
+    def get_params(self):
+        params = super().get_params()
+        if not params.sampling:
+            self.parser.error("--sampling is required")
+        if params.test is None:
+            self.parser.error("--test (the pool) is required")
+        # the pool joins the train set over the rounds
+        params.vocab_files = params.vocab_files + params.test
+        # the membership records the finished rounds
+        if not params.membership:
+            params.membership = f"{params.model}.membership.npz"
+        # the density follows the pool instead of the density file
+        if params.sampling == "information_density" and not params.density_state:
+            params.density_state = f"{params.model}.density.npz"
+        if params.ensemble_seeds and params.eval_decode == Decode.greedy:
+            self.parser.error("--ensemble_seeds needs --eval_decode beam")
+        if params.ensemble_stacked and not params.ensemble_seeds:
+            self.parser.error("--ensemble_stacked needs --ensemble_seeds")
+        if params.warm_start_rounds and params.ensemble_seeds:
+            self.parser.error("--warm_start_rounds does not support ensembles")
+        return params
+
+    def setup_membership(self, filepath, resume=True):
+        # start from the initial train set unless resuming
+        super().setup_membership(filepath, resume=resume and self.params.resume)
+
+    def setup_density(self, filepath, resume=True):
+        super().setup_density(filepath, resume=resume and self.params.resume)
+
+    def write_difficulty(self, round_idx):
+        """
+        difficulty of each gold instance given the current train set
+        """
+        train_lemmas, train_features = set(), set()
+        for lemma, _, tags in self.data.read_examples(self.data.train_file):
+            train_lemmas.add("".join(lemma))
+            train_features.add(";".join(tags))
+        gold = self.params.gold
+        name = os.path.basename(gold).split(".")[0]
+        fp = os.path.join(
+            os.path.dirname(self.params.model), f"{name}_difficulty_{round_idx}.tsv"
+        )
+        with open(fp, "w", encoding="utf-8") as f:
+            f.write("test instance index\tlevel of difficulty\n")
+            for idx, (lemma, _, tags) in enumerate(self.data.read_file(gold), 1):
+                level = difficulty_level(
+                    train_lemmas, train_features, "".join(lemma), ";".join(tags)
+                )
+                f.write(f"{idx}\t{level}\n")
+
+    def build_model(self):
+        """
+        with --ensemble_stacked, one member per --ensemble_seeds stacked into
+        a single model trained at once
+        """
+        params = self.params
+        if not params.ensemble_stacked:
+            return super().build_model()
+        models = []
+        for member_seed in params.ensemble_seeds:
+            setup_seed(member_seed)
+            self.model = None
+            super().build_model()
+            models.append(self.model)
+        self.model = StackedTransformerEnsemble(
+            models, params.ensemble_combine, params.ensemble_uncertainty
+        )
+
+    def train_round(self, decode_fn):
+        """
+        train a new model on the current train set, or fine-tune the model of
+        the previous round with --warm_start_rounds, and load the best one
+        """
+        params = self.params
+        previous, self.model = self.model, None
+        if params.warm_start_rounds and previous is None and params.resume:
+            previous = self.load_round_best()
+        self.models = []
+        self.global_steps = 0
+        self.last_devloss = float("inf")
+        setup_seed(params.seed)
+        if params.warm_start_rounds and previous is not None:
+            max_steps = self.warm_start(previous)
+        else:
+            self.build_model()
+            self.setup_training()
+            max_steps = None
+        self.train_epochs(0, decode_fn, max_steps)
+        best_fp, _ = self.select_model()
+        self.model = None
+        self.load_model(best_fp)
+
+    def train_ensemble_round(self, decode_fn):
+        """
+        train one model per --ensemble_seeds and combine their best models
+        """
+        params = self.params
+        seed, models = params.seed, []
+        try:
+            for member_seed in params.ensemble_seeds:
+                self.logger.info(f"training ensemble member with seed {member_seed}")
+                params.seed = member_seed
+                self.train_round(decode_fn)
+                models.append(self.model)
+                self.cleanup(params.saveall, set(), params.model)
+                self.models = []
+        finally:
+            params.seed = seed
+        self.model = TransformerEnsemble(
+            models, params.ensemble_combine, params.ensemble_uncertainty
+        )
+
+    def round_best_file(self, epoch="*"):
+        return f"{self.params.model}.round_best.epoch_{epoch}"
+
+    def keep_round_best(self):
+        """
+        keep the best model of the round as {model}.round_best.epoch_{epoch},
+        listed in the index, for the warm start of a resumed run. return the
+        filepaths that cleanup keeps
+        """
+        params = self.params
+        self.wait_for_writes()
+        best_fp, _ = self.select_model()
+        best = [m for m in self.models if m.filepath == best_fp][0]
+        round_fp = self.round_best_file(best.epoch)
+        for fp in glob.glob(self.round_best_file()):
+            os.remove(fp)
+        if params.saveall:
+            tmp_file = f"{round_fp}.{os.getpid()}.tmp"
+            shutil.copyfile(best_fp, tmp_file)
+            os.replace(tmp_file, round_fp)
+        else:
+            os.replace(best_fp, round_fp)
+            self.models.remove(best)
+        self.models.append(replace(best, filepath=round_fp))
+        self.write_index(params.model, self.models)
+        return {round_fp}
+
+    def load_round_best(self):
+        """
+        best model of the last finished round, kept by keep_round_best
+        """
+        filepaths = glob.glob(self.round_best_file())
+        if not filepaths:
+            self.logger.warning("no model of the last round, training from scratch")
+            return None
+        self.load_model(filepaths[0])
+        model, self.model = self.model, None
+        return model
+
+    def test_round(self, round_idx, decode_fn):
+        """
+        decode the gold file into {model}.decode.test_{round}.tsv
+        """
+        data, params = self.data, self.params
+        pool_file, nb_pool = data.test_file, data.nb_test
+        # the membership keeps reading the pool file while the gold file stands
+        # in for the test file
+        nb_gold = data.nb_examples(params.gold)
+        data.test_file, data.nb_test = params.gold, nb_gold
+        try:
+            self.calc_loss(TEST, params.bs, -1)
+            results, _, _ = self.decode(
+                TEST, params.bs, f"{params.model}.decode", decode_fn
+            )
+        finally:
+            data.test_file, data.nb_test = pool_file, nb_pool
+        os.replace(
+            f"{params.model}.decode.{TEST}.tsv",
+            f"{params.model}.decode.{TEST}_{round_idx}.tsv",
+        )
+        if results:
+            results = " ".join([f"{r.desc} {r.res}" for r in results])
+            self.logger.info(f"ROUND {round_idx} TEST {results}")
+
+    def select_round(self, decode_fn):
+        """
+        score the pool and move the selected samples to the train set
+        """
+        params = self.params
+        self.check_precision(params.bs, decode_fn)
+        with self.scoring_model():
+            _, self.nll_list, self.entropy_list = self.decode(
+                TEST, params.bs, f"{params.model}.decode", decode_fn
+            )
+        setup_seed(params.seed)
+        selected = self.sample_pool(params.num_samples, params.lang)
+        self.logger.info(
+            f"moved {len(selected)} samples, {self.data.nb_train} train "
+            f"and {self.data.nb_test} pool samples left"
+        )
+
+    def run_rounds(self, decode_fn, eval_decode_fn):
+        params = self.params
+        start_round = self.data.membership.rounds + 1
+        for round_idx in range(start_round, params.rounds + 1):
+            self.logger.info(f"active learning round {round_idx}")
+            self.write_difficulty(round_idx)
+            ensemble = params.ensemble_seeds and not params.ensemble_stacked
+            if ensemble:
+                self.train_ensemble_round(decode_fn)
+            else:
+                self.train_round(decode_fn)
+            with torch.no_grad():
+                self.test_round(round_idx, eval_decode_fn)
+                self.select_round(eval_decode_fn)
+            save_fps = set() if ensemble else self.keep_round_best()
+            self.cleanup(params.saveall, save_fps, params.model)
+
+
+def main():
+    """
+    main
+    """
+    trainer = ActiveLearningTrainer()
+    params = trainer.params
+
+    decode_fn = get_decode_fn(
+        params.decode,
+        params.max_decode_len,
+        params.decode_beam_size,
+        memoize=params.memoize_decode,
+    )
+    eval_decode_fn = get_decode_fn(
+        params.eval_decode,
+        params.max_decode_len,
+        params.decode_beam_size,
+        memoize=params.memoize_decode,
+    )
+    trainer.load_data(params.dataset, params.train, params.dev, params.test)
+    trainer.setup_evalutator()
+    trainer.run_rounds(decode_fn, eval_decode_fn)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,29 @@ train
 """
 import os
 from functools import partial
+from math import ceil
 
+import numpy as np
 import torch
 from tqdm import tqdm
 
+import checkpoint
 import dataloader
 import model
 import transformer
+import uncertainty
 import util
 from decoding import Decode, get_decode_fn
-from trainer import BaseTrainer
+from density import DensityStore, read_dataset
+from ensemble import (
+    COMBINE,
+    UNCERTAINTY,
+    StackedTransformerEnsemble,
+    TransformerEnsemble,
+)
+from levenshtein import edit_distances, pad, paired_distance
+from membership import Membership
+from trainer import TEST, BaseTrainer
 
 from dataloader import BOS_IDX, EOS_IDX, STEP_IDX
 
@@ -59,6 +72,14 @@ class Arch(util.NamedEnum):
 class Trainer(BaseTrainer):
     """docstring for Trainer."""
 
+    def __init__(self):
+        super().__init__()
+        self.density = None
+        # early stopping of warm started fine-tuning
+        self.warm_started = False
+        self.best_devloss = float("inf")
+        self.bad_evals = 0
+
     def set_args(self):
         """
         get_args
@@ -87,6 +108,16 @@ class Trainer(BaseTrainer):
         parser.add_argument('--decode', default=Decode.greedy, type=Decode, choices=list(Decode))
         parser.add_argument('--mono', default=False, action='store_true', help='enforce monotonicity')
         parser.add_argument('--bestacc', default=False, action='store_true', help='select model by accuracy only')
+        parser.add_argument('--membership', default='', type=str, help='train/pool membership file over --train + --test, instead of rewriting them')
+        parser.add_argument('--density_state', default='', type=str, help='information density state over the pool, updated as samples leave it, instead of the density file')
+        parser.add_argument('--ensemble', default=[], nargs='+', type=str, help='decode the pool with the ensemble of these checkpoints and sample from it, without training')
+        parser.add_argument('--ensemble_combine', default='mean', choices=COMBINE, help='average the probabilities of the members or take their product')
+        parser.add_argument('--ensemble_uncertainty', default='mutual_information', choices=UNCERTAINTY, help='ensemble statistic used as entropy for sampling')
+        parser.add_argument('--ensemble_stacked', default=False, action='store_true', help='stack the parameters of the ensemble members and run them as one batched model')
+        parser.add_argument('--warm_start', default='', type=str, help='fine-tune this checkpoint, e.g. the best model of the previous round, instead of training from scratch')
+        parser.add_argument('--warm_start_budget', default=10., type=float, help='warm start fine-tuning steps as passes over the samples added since the checkpoint')
+        parser.add_argument('--warm_start_patience', default=2, type=int, help='stop fine-tuning after this many evaluations without dev loss improvement')
+        parser.add_argument('--warm_start_optimizer', default=False, action='store_true', help='keep the optimizer state after training and restore it when warm starting')
         # fmt: on
 
     def load_data(self, dataset, train, dev, test):
@@ -96,58 +127,128 @@ class Trainer(BaseTrainer):
         # fmt: off
         if params.arch == Arch.hardmono:
             if dataset == Data.sigmorphon17task1:
-                self.data = dataloader.AlignSIGMORPHON2017Task1(train, dev, test, params.shuffle)
+                self.data = dataloader.AlignSIGMORPHON2017Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.g2p:
-                self.data = dataloader.AlignStandardG2P(train, dev, test, params.shuffle)
+                self.data = dataloader.AlignStandardG2P(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.news15:
-                self.data = dataloader.AlignTransliteration(train, dev, test, params.shuffle)
+                self.data = dataloader.AlignTransliteration(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             else:
                 raise ValueError
         else:
             if dataset == Data.sigmorphon17task1:
                 if params.indtag:
-                    self.data = dataloader.TagSIGMORPHON2017Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagSIGMORPHON2017Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.SIGMORPHON2017Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.SIGMORPHON2017Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.unimorph:
                 if params.indtag:
-                    self.data = dataloader.TagUnimorph(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagUnimorph(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.Unimorph(train, dev, test, params.shuffle)
+                    self.data = dataloader.Unimorph(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.sigmorphon19task1:
                 assert isinstance(train, list) and len(train) == 2 and params.indtag
-                self.data = dataloader.TagSIGMORPHON2019Task1(train, dev, test, params.shuffle)
+                self.data = dataloader.TagSIGMORPHON2019Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.sigmorphon19task2:
                 assert params.indtag
-                self.data = dataloader.TagSIGMORPHON2019Task2(train, dev, test, params.shuffle)
+                self.data = dataloader.TagSIGMORPHON2019Task2(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.g2p:
-                self.data = dataloader.StandardG2P(train, dev, test, params.shuffle)
+                self.data = dataloader.StandardG2P(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.p2g:
-                self.data = dataloader.StandardP2G(train, dev, test, params.shuffle)
+                self.data = dataloader.StandardP2G(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.news15:
-                self.data = dataloader.Transliteration(train, dev, test, params.shuffle)
+                self.data = dataloader.Transliteration(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.histnorm:
-                self.data = dataloader.Histnorm(train, dev, test, params.shuffle)
+                self.data = dataloader.Histnorm(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.sigmorphon16task1:
                 if params.indtag:
-                    self.data = dataloader.TagSIGMORPHON2016Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagSIGMORPHON2016Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.SIGMORPHON2016Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.SIGMORPHON2016Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.lemma:
                 if params.indtag:
-                    self.data = dataloader.TagLemmatization(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagLemmatization(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.Lemmatization(train, dev, test, params.shuffle)
+                    self.data = dataloader.Lemmatization(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.lemmanotag:
-                self.data = dataloader.LemmatizationNotag(train, dev, test, params.shuffle)
+                self.data = dataloader.LemmatizationNotag(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             else:
                 raise ValueError
         # fmt: on
+        self.data.set_batching(params.bucket, params.max_tokens, params.prefetch)
+        self.data.set_storage(params.packed_data)
+        if params.membership:
+            self.setup_membership(params.membership)
+        if params.density_state:
+            self.setup_density(params.density_state)
         logger.info("src vocab size %d", self.data.source_vocab_size)
         logger.info("trg vocab size %d", self.data.target_vocab_size)
         logger.info("src vocab %r", self.data.source[:500])
         logger.info("trg vocab %r", self.data.target[:500])
 
+    def setup_membership(self, filepath, resume=True):
+        """
+        read train and pool through the membership file, created if missing
+        """
+        if resume and os.path.isfile(filepath):
+            membership = Membership.load(filepath)
+        else:
+            membership = Membership.create(self.data.nb_train, self.data.nb_test)
+            util.maybe_mkdir(filepath)
+            membership.save(filepath)
+        self.data.set_membership(membership)
+        self.logger.info(
+            "membership %s: %d train and %d pool samples after %d rounds",
+            filepath, membership.nb_train, membership.nb_pool, membership.rounds,
+        )
+
+    def setup_density(self, filepath, resume=True):
+        """
+        information density of the current pool, built over the pool file if missing
+        """
+        data = self.data
+        if resume and os.path.isfile(filepath):
+            density = DensityStore.load(filepath)
+        else:
+            self.logger.info("building the density state over %s", data.test_file)
+            density = DensityStore.build(read_dataset(data.test_file))
+            if data.membership is not None:
+                # the pool file is the master pool, drop the samples already moved
+                pool = data.membership.pool_index() - data.nb_master_train
+                moved = np.ones(density.nb_pool, dtype=bool)
+                moved[pool] = False
+                density.remove(np.flatnonzero(moved))
+            util.maybe_mkdir(filepath)
+            density.save(filepath)
+        assert density.nb_pool == data.nb_test, "density state does not match the pool"
+        self.density = density
+        self.logger.info("density state %s: %d pool samples", filepath, density.nb_pool)
+
+    def update_density(self, pool_rows):
+        """
+        take the selected samples out of the density state
+        """
+        if self.density is not None:
+            self.density.remove(pool_rows)
+            self.density.save(self.params.density_state)
+
+    def load_ensemble(self, filepaths):
+        assert self.model is None
+        self.logger.info("load ensemble of %s", filepaths)
+        if self.params.ensemble_stacked:
+            ensemble_class = StackedTransformerEnsemble
+        else:
+            ensemble_class = TransformerEnsemble
+        models = []
+        for filepath in filepaths:
+            model = checkpoint.load_model(filepath, map_location=self.device)
+            self.match_vocab(model)
+            models.append(model)
+        self.model = ensemble_class(
+            models,
+            combine=self.params.ensemble_combine,
+            uncertainty=self.params.ensemble_uncertainty,
+        )
+
     def build_model(self):
         assert self.model is None
         params = self.params
@@ -203,6 +304,8 @@ class Trainer(BaseTrainer):
         else:
             model_class = regular_classfactory[params.arch]
         self.model = model_class(**kwargs)
+        # architecture recorded in the weights-only checkpoints
+        self.model.config = kwargs
         if params.indtag:
             self.logger.info("number of attribute %d", self.model.nb_attr)
             self.logger.info("dec 1st rnn %r", self.model.dec_rnn.layers[0])
@@ -216,6 +319,62 @@ class Trainer(BaseTrainer):
         self.logger.info("number of parameter %d", self.model.count_nb_params())
         self.model = self.model.to(self.device)
 
+    def warm_start(self, model):
+        """
+        fine-tune `model`, e.g. the best model of the previous round, on the
+        current train set, growing its vocab if needed. return the fine-tuning
+        budget in steps, proportional to the samples added since `model` was
+        trained (rounded up to whole epochs by train_epochs)
+        """
+        assert self.model is None
+        params, data = self.params, self.data
+        self.model = model.to(self.device)
+        resized = self.match_vocab(model)
+        nb_added = data.nb_train - getattr(model, "nb_train", 0)
+        batch_size = data.mean_batch_size(data.train_file, params.bs)
+        max_steps = ceil(params.warm_start_budget * max(nb_added, 1) / batch_size)
+        if params.max_steps > 0:
+            max_steps = min(max_steps, params.max_steps)
+        self.logger.info(
+            f"warm start with {nb_added} new samples, at most {max_steps} steps"
+        )
+
+        self.setup_training()
+        if params.warm_start_optimizer:
+            if resized:
+                self.logger.warning("vocab changed, optimizer state not restored")
+            else:
+                self.load_training(params.model)
+        self.warm_started = True
+        self.best_devloss, self.bad_evals = float("inf"), 0
+        return max_steps
+
+    def update_lr_and_stop_early(self, epoch_idx, devloss, estop):
+        stop_status = super().update_lr_and_stop_early(epoch_idx, devloss, estop)
+        if not self.warm_started:
+            return stop_status
+        if self.best_devloss - devloss >= estop:
+            self.best_devloss, self.bad_evals = devloss, 0
+        else:
+            self.bad_evals += 1
+        if self.bad_evals >= self.params.warm_start_patience:
+            self.logger.info(
+                "Stop fine-tuning at epoch %d, no better dev loss in %d evaluations",
+                epoch_idx,
+                self.bad_evals,
+            )
+            return True
+        return stop_status
+
+    def save_model(self, epoch_idx, devloss, eval_res, model_fp):
+        # the warm start of the next round fine-tunes for the samples added since
+        self.model.nb_train = self.data.nb_train
+        super().save_model(epoch_idx, devloss, eval_res, model_fp)
+
+    def cleanup(self, saveall, save_fps, model_fp, keep_progress=False):
+        keep_progress = keep_progress or self.params.warm_start_optimizer
+        super().cleanup(saveall, save_fps, model_fp, keep_progress=keep_progress)
+
     def dump_state_dict(self, filepath):
         util.maybe_mkdir(filepath)
         self.model = self.model.to("cpu")
@@ -255,9 +414,10 @@ class Trainer(BaseTrainer):
     def evaluate(self, mode, batch_size, epoch_idx, decode_fn):
         self.model.eval()
         sampler, nb_batch = self.iterate_batch(mode, batch_size)
-        results = self.evaluator.evaluate_all(
-            sampler, batch_size, nb_batch, self.model, decode_fn
-        )
+        with self.autocast():
+            results = self.evaluator.evaluate_all(
+                sampler, batch_size, nb_batch, self.model, decode_fn
+            )
         for result in results:
             self.logger.info(
                 f"{mode} {result.long_desc} is {result.res} at epoch {epoch_idx}"
@@ -265,75 +425,80 @@ class Trainer(BaseTrainer):
         return results
 
     def entropy(self, predictions):
-        # Filter out probabilities less than or equal to 0.05
-        predictions = predictions[predictions > 0.05]
-
-        # Calculate entropy
-        ent = -torch.sum(predictions * torch.log(predictions))
-        return ent.item()
+        # Only probabilities >= uncertainty.ENTROPY_THRESHOLD count
+        return uncertainty.thresholded_entropy(predictions).item()
 
     def decode(self, mode, batch_size, write_fp, decode_fn):
         self.model.eval()
-        cnt = 0
         sampler, nb_batch = self.iterate_batch(mode, batch_size)
-        nll_list = []
-        entropy_list = []
-        with open(f"{write_fp}.{mode}.tsv", "w") as fp:
+        # (line, nll, entropy) per example in batch order, see `in_file_order`
+        rows = []
+        for src, src_mask, trg, trg_mask in tqdm(
+                sampler(batch_size), total=nb_batch
+        ):
+            with self.autocast():
+                pred, nlls, entropies, _ = decode_fn(self.model, src, src_mask)
             if self.params.decode == Decode.ensemble:
-                fp.write("target\tall_predictions\tall_log_probs\tdenormalized_probs\tedit_distance\n")
+                trg = util.unpack_batch(trg)
+                # Calculate edit distance for all sequences of the batch at once
+                cleaned_seqs = [
+                    [char for char in seq if char != BOS_IDX and char != EOS_IDX]
+                    for all_sequences in pred
+                    for seq in all_sequences
+                ]
+                targets = [t for t, all_sequences in zip(trg, pred) for _ in all_sequences]
+                all_dists = iter(edit_distances(cleaned_seqs, targets))
+                for t, all_sequences, all_log_probs, probs in zip(trg, pred, nlls, entropies):
+                    dists = [next(all_dists) for _ in all_sequences]
+
+                    t = self.data.decode_target(t)
+
+                    # Preprocess each prediction in all_sequences
+                    all_sequences = util.unpack_batch(all_sequences)
+                    all_sequences = [" ".join(self.data.decode_target(seq)) for seq in all_sequences]
+
+                    # Convert each tensor in all_log_probs to a regular Python value
+                    all_log_probs = [str(log_prob.cpu().item()) for log_prob in all_log_probs]
+                    probs = [str(prob.cpu().item()) for prob in probs]
+
+                    all_sequences = [str(item) for item in all_sequences]
+                    all_log_probs = [str(item) for item in all_log_probs]
+                    probs = [str(item) for item in probs]
+                    dists = [str(item) for item in dists]
+
+                    line = f'{" ".join(t)}\t{"|".join(all_sequences)}\t{"|".join(all_log_probs)}\t{"|".join(probs)}\t{"|".join(dists)}\n'
+                    rows.append((line, None, None))
             else:
-                fp.write("prediction\ttarget\tloss\tdist\tnll\tentropy\n")
-
-            for src, src_mask, trg, trg_mask in tqdm(
-                    sampler(batch_size), total=nb_batch
-            ):
-                pred, nlls, entropies, _ = decode_fn(self.model, src, src_mask)
-                if self.params.decode == Decode.ensemble:
-                    trg = util.unpack_batch(trg)
-                    for t, all_sequences, all_log_probs, probs in zip(trg, pred, nlls, entropies):
-                        dists = []
-                        # Calculate edit distance for all sequences
-                        for seq in all_sequences:
-                            cleaned_seq = [char for char in seq if char != BOS_IDX and char != EOS_IDX]
-                            dists.append(util.edit_distance(cleaned_seq, t))
-
-                        t = self.data.decode_target(t)
-
-                        # Preprocess each prediction in all_sequences
-                        all_sequences = util.unpack_batch(all_sequences)
-                        all_sequences = [" ".join(self.data.decode_target(seq)) for seq in all_sequences]
-
-                        # Convert each tensor in all_log_probs to a regular Python value
-                        all_log_probs = [str(log_prob.cpu().item()) for log_prob in all_log_probs]
-                        probs = [str(prob.cpu().item()) for prob in probs]
-
-                        all_sequences = [str(item) for item in all_sequences]
-                        all_log_probs = [str(item) for item in all_log_probs]
-                        probs = [str(item) for item in probs]
-                        dists = [str(item) for item in dists]
-
-                        fp.write(f'{" ".join(t)}\t{"|".join(all_sequences)}\t{"|".join(all_log_probs)}\t{"|".join(probs)}\t{"|".join(dists)}\n')
-                        cnt += 1
-                else:
-                    self.evaluator.add(src, pred, trg)
-                    nll_list.extend(nlls)
-                    entropy_list.extend(entropies)
+                self.evaluator.add(src, pred, trg)
 
-                    data = (src, src_mask, trg, trg_mask)
+                data = (src, src_mask, trg, trg_mask)
+                with self.autocast():
                     losses = self.model.get_loss(data, reduction=False).cpu()
 
-                    pred = util.unpack_batch(pred)
-                    trg = util.unpack_batch(trg)
-                    for p, t, loss, nll, entropy in zip(pred, trg, losses, nlls, entropies):
-                        dist = util.edit_distance(p, t)
-                        p = self.data.decode_target(p)
-                        t = self.data.decode_target(t)
-                        fp.write(f'{" ".join(p)}\t{" ".join(t)}\t{loss.item()}\t{dist}\t{nll}\t{entropy}\n')
-                        cnt += 1
+                pred = dataloader.trim_batch(pred)
+                trg = dataloader.trim_batch(trg)
+                dists = paired_distance(*pad(*pred), *pad(*trg)).tolist()
+                pred = self.data.decode_target_batch(*pred)
+                trg = self.data.decode_target_batch(*trg)
+                for p, t, loss, dist, nll, entropy in zip(pred, trg, losses.tolist(), dists, nlls, entropies):
+                    line = f'{p}\t{t}\t{loss}\t{dist}\t{nll}\t{entropy}\n'
+                    rows.append((line, nll, entropy))
+
+        # al_sampling indexes the pool file by row, so write in file order
+        rows = self.in_file_order(mode, rows)
+        with open(f"{write_fp}.{mode}.tsv", "w") as fp:
+            if self.params.decode == Decode.ensemble:
+                fp.write("target\tall_predictions\tall_log_probs\tdenormalized_probs\tedit_distance\n")
+            else:
+                fp.write("prediction\ttarget\tloss\tdist\tnll\tentropy\n")
+            for line, _, _ in rows:
+                fp.write(line)
 
-        self.logger.info(f"finished decoding {cnt} {mode} instance")
+        self.logger.info(f"finished decoding {len(rows)} {mode} instance")
         if self.params.decode != Decode.ensemble:
             results = self.evaluator.compute(reset=True)
+            nll_list = [nll for _, nll, _ in rows]
+            entropy_list = [entropy for _, _, entropy in rows]
             return results, nll_list, entropy_list
         else:
             return None, None, None
@@ -341,14 +506,22 @@ class Trainer(BaseTrainer):
     def al_sampling(self, criteria, criteria_list, lang_code="kor", num_samples=100, beta=1.0):
         print(f"Starting al_sampling with criteria: {criteria}, num_samples: {num_samples}, beta: {beta}")
 
-        if criteria == "information_density":
+        if criteria == "information_density" and self.density is not None:
+            density_values = self.density.densities().tolist()
+            print(f"Computed {len(density_values)} density values over the current pool")
+        elif criteria == "information_density":
             file_name = f"active-learning/{lang_code}_density.tsv"
             print(f"Reading density values from {file_name}...")
             with open(file_name, 'r', encoding="utf-8") as f:
                 lines = f.readlines()[1:]  # Skip the header by starting from the second line
                 density_values = [float(line.strip().split('\t')[2]) for line in lines]
                 print(f"Read {len(density_values)} density values from {file_name}")
+            if self.data.membership is not None:
+                # the density file is never rewritten and follows the master pool
+                rows = self.data.membership.pool_index() - self.data.nb_master_train
+                density_values = [density_values[i] for i in rows]
 
+        if criteria == "information_density":
             print("Computing information density...")
             criteria_list = [entropy * (density ** beta) for density, entropy in zip(density_values, criteria_list)]
             print("Information density computation completed.")
@@ -363,6 +536,14 @@ class Trainer(BaseTrainer):
         uncertain_samples_indices = sorted(range(len(criteria_list)), key=lambda i: criteria_list[i], reverse=True)[
                                     :num_samples]
         print(f"Selected {len(uncertain_samples_indices)} uncertain samples indices")
+        self.update_density(uncertain_samples_indices)
+
+        if self.data.membership is not None:
+            self.data.move_to_train(uncertain_samples_indices)
+            self.data.membership.save(self.params.membership)
+            print(f"Moved the uncertain samples to the training set in {self.params.membership}")
+            print("Finished al_sampling")
+            return uncertain_samples_indices
 
         print("Reading test data...")
         test_data = list(self.data.read_file(self.data.test_file))
@@ -399,7 +580,7 @@ class Trainer(BaseTrainer):
                 f.write(f"{lemma}\t{word}\t{tags}\n")
         print("Uncertain samples appended to training file.")
 
-        if criteria == "information_density":
+        if criteria == "information_density" and self.density is None:
             file_name = f"active-learning/{lang_code}_density.tsv"
             print(f"Updating {file_name}...")
 
@@ -418,6 +599,7 @@ class Trainer(BaseTrainer):
             print(f"{file_name} updated.")
 
         print("Finished al_sampling")
+        return uncertain_samples_indices
 
     def random_sampling(self, num_samples=100):
         """
@@ -426,12 +608,24 @@ class Trainer(BaseTrainer):
 
         Parameters:
         - num_samples (int): Number of samples to select.
+
+        Returns the indices of the selected samples in the test set.
         """
+        if self.data.membership is not None:
+            random_indices = random.sample(range(self.data.nb_test), num_samples)
+            self.update_density(random_indices)
+            self.data.move_to_train(random_indices)
+            self.data.membership.save(self.params.membership)
+            return random_indices
+
         # Get the test data
         test_data = list(self.data.read_file(self.data.test_file))
 
         # Randomly select samples from the test data
-        random_samples = random.sample(test_data, num_samples)
+        # (sampling indices picks the same samples as sampling test_data)
+        random_indices = random.sample(range(len(test_data)), num_samples)
+        random_samples = [test_data[i] for i in random_indices]
+        self.update_density(random_indices)
 
         # Remove the selected samples from the test data
         for sample in random_samples:
@@ -461,11 +655,14 @@ class Trainer(BaseTrainer):
                     tags = ';'.join(tags)
                 f.write(f"{lemma}\t{word}\t{tags}\n")
 
-    def select_model(self):
-        best_res = [m for m in self.models if m.evaluation_result][0]
-        best_acc = [m for m in self.models if m.evaluation_result][0]
-        best_devloss = self.models[0]
-        for m in self.models:
+        return random_indices
+
+    def select_model(self, models=None):
+        models = self.models if models is None else models
+        best_res = [m for m in models if m.evaluation_result][0]
+        best_acc = [m for m in models if m.evaluation_result][0]
+        best_devloss = models[0]
+        for m in models:
             if not m.evaluation_result:
                 continue
             if (
@@ -513,10 +710,27 @@ def main():
     trainer.params.decode_beam_size = 5
 
     decode_fn = get_decode_fn(
-        params.decode, params.max_decode_len, params.decode_beam_size
+        params.decode,
+        params.max_decode_len,
+        params.decode_beam_size,
+        memoize=params.memoize_decode,
     )
     trainer.load_data(params.dataset, params.train, params.dev, params.test)
     trainer.setup_evalutator()
+    if params.ensemble:
+        if params.decode == Decode.greedy:
+            trainer.parser.error("--ensemble needs --decode beam or ensemble")
+        # one beam search over the combined members replaces the decode of each
+        trainer.load_ensemble(params.ensemble)
+        with torch.no_grad():
+            trainer.check_precision(params.bs, decode_fn)
+            with trainer.scoring_model():
+                _, trainer.nll_list, trainer.entropy_list = trainer.decode(
+                    TEST, params.bs, f"{params.model}.decode", decode_fn
+                )
+        trainer.sample_pool()
+        return
+    max_steps = None
     if params.load and params.load != "0":
         if params.load == "smart":
             start_epoch = trainer.smart_load_model(params.model) + 1
@@ -525,6 +739,12 @@ def main():
         trainer.logger.info("continue training from epoch %d", start_epoch)
         trainer.setup_training()
         trainer.load_training(params.model)
+    elif params.warm_start:
+        start_epoch = 0
+        trainer.logger.info("warm start from %s", params.warm_start)
+        max_steps = trainer.warm_start(
+            checkpoint.load_model(params.warm_start, map_location=trainer.device)
+        )
     else:  # start from scratch
         start_epoch = 0
         trainer.build_model()
@@ -535,7 +755,7 @@ def main():
                 trainer.dump_state_dict(params.init)
         trainer.setup_training()
 
-    trainer.run(start_epoch, decode_fn=decode_fn)
+    trainer.run(start_epoch, decode_fn=decode_fn, max_steps=max_steps)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,338 @@
+"""
+weights-only checkpoints
+
+A checkpoint file is the magic string, the length of a JSON header and the
+header, followed by the raw bytes of every tensor of the state_dict, each
+aligned to ALIGNMENT bytes. The header holds the model class with its
+constructor arguments (vocab included), the offset, dtype and shape of every
+tensor and training metadata such as the epoch and the dev metrics. Loading
+rebuilds the model and points its parameters at a copy-on-write memory map of
+the file, so nothing is copied until a tensor is written or moved to a device.
+Models without a recorded architecture (`model.config`) are pickled as before,
+and load_model reads both kinds of file.
+
+For inference only, quantize_model makes a dynamically quantized copy of a
+model: the weights of its Linear layers and LSTM cells are stored in int8 and
+the activations are quantized on the fly. Quantized modules hold packed
+weights rather than tensors, so save_quantized pickles the whole model, which
+load_model reads like any pickled model.
+"""
+import copy
+import importlib
+import json
+import os
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+MAGIC = b"MICKPT01"
+ALIGNMENT = 64
+
+# attributes set on a model after it is built that a checkpoint keeps
+MODEL_ATTRS = ["nb_train"]
+
+# modules whose weights quantize_model stores in int8
+QUANTIZED_MODULES = {nn.Linear, nn.LSTMCell, nn.LSTM}
+
+DTYPES = {
+    torch.float64: "float64",
+    torch.float32: "float32",
+    torch.float16: "float16",
+    torch.bfloat16: "bfloat16",
+    torch.int64: "int64",
+    torch.int32: "int32",
+    torch.int16: "int16",
+    torch.int8: "int8",
+    torch.uint8: "uint8",
+    torch.bool: "bool",
+}
+TORCH_DTYPES = {name: dtype for dtype, name in DTYPES.items()}
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def model_config(model):
+    """
+    class and constructor arguments of a model, from the arguments the
+    trainers record in `model.config`. None if the model has no config
+    """
+    config = getattr(model, "config", None)
+    if config is None:
+        return None
+    kwargs = dict(config)
+    if "src_c2i" in kwargs:
+        # the vocab may have been resized since the model was built
+        kwargs["src_vocab_size"] = model.src_vocab_size
+        kwargs["trg_vocab_size"] = model.trg_vocab_size
+        kwargs["src_c2i"] = model.src_c2i
+        kwargs["trg_c2i"] = model.trg_c2i
+        kwargs["attr_c2i"] = model.attr_c2i
+        if "nb_attr" in kwargs:
+            kwargs["nb_attr"] = len(model.attr_c2i or {})
+    return dict(module=type(model).__module__, name=type(model).__name__, kwargs=kwargs)
+
+
+def build_model(config):
+    """
+    new model of a model_config, members of ensembles included
+    """
+    model_class = getattr(importlib.import_module(config["module"]), config["name"])
+    kwargs = dict(config["kwargs"])
+    if "members" in kwargs:
+        kwargs["models"] = [build_model(member) for member in kwargs.pop("members")]
+    model = model_class(**kwargs)
+    if "members" not in config["kwargs"]:
+        model.config = config["kwargs"]
+    return model
+
+
+def _tensor_bytes(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+def snapshot(model, copy_tensors=False, **meta):
+    """
+    (header, state_dict) written by save_model, the tensors copied to the cpu
+    if copy_tensors so that training can go on while they are written. for
+    models without a config, (None, the model or a cpu copy of it)
+    """
+    config = model_config(model)
+    if config is None:
+        return None, copy.deepcopy(model).cpu() if copy_tensors else model
+    state_dict = {
+        name: tensor.detach().to("cpu", copy=copy_tensors)
+        for name, tensor in model.state_dict().items()
+    }
+    for attr in MODEL_ATTRS:
+        if hasattr(model, attr):
+            meta[attr] = getattr(model, attr)
+    return dict(model=config, meta=meta), state_dict
+
+
+def save_model(model, filepath, **meta):
+    """
+    save `model` at `filepath` with the metadata `meta` (JSON serializable),
+    as a weights-only checkpoint if the model has a config, else pickled
+    """
+    write_snapshot(*snapshot(model, **meta), filepath)
+
+
+def write_snapshot(header, state, filepath):
+    """
+    write a snapshot at `filepath` through a temporary file
+    """
+    tmp_file = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if header is None:
+        torch.save(state, tmp_file)
+        os.replace(tmp_file, filepath)
+        return
+    state_dict = state
+
+    tensors, offset = dict(), 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in DTYPES:
+            raise ValueError(f"cannot save {name} of type {tensor.dtype}")
+        nbytes = tensor.numel() * tensor.element_size()
+        tensors[name] = dict(
+            dtype=DTYPES[tensor.dtype], shape=list(tensor.shape), offset=offset
+        )
+        offset = _align(offset + nbytes)
+    header = dict(header, tensors=tensors)
+    header = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    start = _align(len(MAGIC) + 8 + len(header))
+
+    with open(tmp_file, "wb") as fp:
+        fp.write(MAGIC)
+        fp.write(len(header).to_bytes(8, "little"))
+        fp.write(header)
+        for name, tensor in state_dict.items():
+            fp.write(b"\0" * (start + tensors[name]["offset"] - fp.tell()))
+            fp.write(_tensor_bytes(tensor).tobytes())
+    os.replace(tmp_file, filepath)
+
+
+def is_checkpoint(filepath):
+    with open(filepath, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def read_header(filepath):
+    """
+    header of a weights-only checkpoint and the offset of its tensor data
+    """
+    with open(filepath, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filepath} is not a weights-only checkpoint")
+        size = int.from_bytes(fp.read(8), "little")
+        header = json.loads(fp.read(size).decode("utf-8"))
+    return header, _align(len(MAGIC) + 8 + size)
+
+
+def load_state_dict(filepath):
+    """
+    header and state_dict of a weights-only checkpoint, the tensors being
+    copy-on-write views of a memory map of the file
+    """
+    header, start = read_header(filepath)
+    data = np.memmap(filepath, dtype=np.uint8, mode="c")
+    state_dict = dict()
+    for name, info in header["tensors"].items():
+        dtype = TORCH_DTYPES[info["dtype"]]
+        np_dtype = np.int16 if dtype == torch.bfloat16 else info["dtype"]
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        begin = start + info["offset"]
+        array = data[begin : begin + count * np.dtype(np_dtype).itemsize]
+        tensor = torch.from_numpy(array.view(np_dtype)).view(info["shape"])
+        state_dict[name] = tensor.view(dtype) if dtype == torch.bfloat16 else tensor
+    return header, state_dict
+
+
+def assign_state_dict(model, state_dict):
+    """
+    make the parameters and buffers of `model` use the tensors of state_dict
+    without copying them, like a strict load_state_dict
+    """
+    own = model.state_dict(keep_vars=True)
+    missing = [name for name in own if name not in state_dict]
+    unexpected = [name for name in state_dict if name not in own]
+    if missing or unexpected:
+        raise ValueError(f"missing keys {missing}, unexpected keys {unexpected}")
+    for name, tensor in own.items():
+        if tensor.shape != state_dict[name].shape:
+            raise ValueError(
+                f"size mismatch for {name}: {state_dict[name].shape} in the "
+                f"checkpoint, {tensor.shape} in the model"
+            )
+        tensor.data = state_dict[name].to(tensor.dtype)
+
+
+def load_model(filepath, map_location=None, quantize=False):
+    """
+    model saved by save_model or save_quantized, or pickled by torch.save. with
+    quantize, a dynamically quantized copy, see quantize_model, which only runs
+    on the cpu
+    """
+    if is_checkpoint(filepath):
+        header, state_dict = load_state_dict(filepath)
+        model = build_model(header["model"])
+        assign_state_dict(model, state_dict)
+        for attr in MODEL_ATTRS:
+            if attr in header["meta"]:
+                setattr(model, attr, header["meta"][attr])
+    else:
+        model = torch.load(filepath, map_location=map_location)
+    if quantize:
+        return quantize_model(model)
+    if map_location is not None:
+        model = model.to(map_location)
+    return model
+
+
+def is_quantized(model):
+    return getattr(model, "quantized", False)
+
+
+def quantize_model(model):
+    """
+    copy of `model` for inference with the weights of QUANTIZED_MODULES in int8
+    and their activations quantized dynamically, on the cpu
+    """
+    from ensemble import StackedTransformerEnsemble, TransformerEnsemble
+
+    if is_quantized(model):
+        return model
+    if isinstance(model, StackedTransformerEnsemble):
+        # stacked parameters are bound into a shared base, quantize each member
+        model = TransformerEnsemble(model.members(), model.combine, model.uncertainty)
+    else:
+        model = copy.deepcopy(model)
+    model = model.cpu().eval()
+    torch.quantization.quantize_dynamic(
+        model, QUANTIZED_MODULES, dtype=torch.qint8, inplace=True
+    )
+    model.quantized = True
+    return model
+
+
+def save_quantized(model, filepath):
+    """
+    save the quantize_model copy of `model` at `filepath`, through a temporary
+    file
+    """
+    tmp_file = f"{filepath}.{os.getpid()}.tmp"
+    torch.save(quantize_model(model), tmp_file)
+    os.replace(tmp_file, filepath)
+
+
+def read_index(filepath):
+    """
+    entries of an index file, see write_index
+    """
+    with open(filepath, "r", encoding="utf-8") as fp:
+        return json.load(fp)["checkpoints"]
+
+
+def write_index(filepath, entries):
+    """
+    index of the saved models of a run, a list of dicts with their filepath,
+    dev loss, dev metrics and epoch
+    """
+    tmp_file = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as fp:
+        json.dump(dict(checkpoints=entries), fp, ensure_ascii=False)
+    os.replace(tmp_file, filepath)
+
+
+class BackgroundWriter(object):
+    """
+    run file writes in submission order in a background thread. the thread
+    only lives while there is work, so pending writes finish before the
+    interpreter exits. errors are raised by the next `wait`
+    """
+
+    def __init__(self):
+        self.tasks: deque = deque()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.error = None
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            self.tasks.append((fn, args, kwargs))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work)
+                self.thread.start()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if not self.tasks:
+                    self.thread = None
+                    return
+                fn, args, kwargs = self.tasks.popleft()
+            try:
+                fn(*args, **kwargs)
+            except Exception as error:
+                self.error = self.error or error
+
+    def wait(self):
+        """
+        block until every submitted write is done
+        """
+        while True:
+            with self.lock:
+                thread = self.thread
+            if thread is None:
+                break
+            thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
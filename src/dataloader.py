@@ -1,4 +1,11 @@
+import hashlib
+import json
+import os
+import threading
 import xml.etree.ElementTree
+from itertools import chain
+from math import ceil
+from queue import Empty, Queue
 from typing import Dict, List, Optional
 
 import numpy as np
@@ -18,6 +25,271 @@ BOS_IDX = 1
 EOS_IDX = 2
 UNK_IDX = 3
 STEP_IDX = 4
+# source slots of a persistent vocab are reserved in blocks, see Vocab
+VOCAB_BLOCK = 256
+
+
+class PackedSequences(object):
+    """
+    ragged storage of index sequences: the sequences concatenated in a narrow
+    integer buffer with their offsets, padded per batch by `pad`
+    """
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, lst: List[List[int]], dtype=np.int32):
+        lengths = np.fromiter(map(len, lst), np.int64, len(lst))
+        values = np.fromiter(chain.from_iterable(lst), dtype, lengths.sum())
+        offsets = np.zeros(len(lst) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def _positions(self, index):
+        """
+        buffer position of every symbol of the sequences `index`, in order, and
+        the length of these sequences
+        """
+        starts = self.offsets[index]
+        lengths = self.offsets[index + 1] - starts
+        ends = np.cumsum(lengths)
+        shift = np.repeat(starts - (ends - lengths), lengths)
+        return np.arange(len(shift)) + shift, lengths
+
+    def select(self, index):
+        index = np.asarray(index, dtype=np.int64)
+        positions, lengths = self._positions(index)
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return PackedSequences(self.values[positions], offsets)
+
+    def concat(self, other):
+        offsets = np.concatenate([self.offsets[:-1], other.offsets + self.offsets[-1]])
+        return PackedSequences(np.concatenate([self.values, other.values]), offsets)
+
+    def pad(self, index, max_len):
+        """
+        [max_len, len(index)] padded long tensor of the sequences `index`
+        """
+        index = np.asarray(index, dtype=np.int64)
+        positions, lengths = self._positions(index)
+        cols = np.repeat(np.arange(len(index)), lengths)
+        rows = positions - np.repeat(self.offsets[index], lengths)
+        keep = rows < max_len
+        data = np.zeros((max_len, len(index)), dtype=np.int64)
+        data[rows[keep], cols[keep]] = self.values[positions[keep]]
+        return torch.from_numpy(data)
+
+
+def select_examples(data, index):
+    """
+    select examples (columns) of encoded data, attr_data is [nb_example, nb_attr + 1]
+    """
+    if data is None:
+        return None
+    if isinstance(data, tuple):
+        return (select_examples(data[0], index), data[1].index_select(0, index))
+    if isinstance(data, PackedSequences):
+        return data.select(index)
+    return data.index_select(1, index)
+
+
+def concat_examples(a, b):
+    """
+    concatenate the examples of two encoded data, padding the shorter one
+    """
+    if a is None:
+        return None
+    if isinstance(a, tuple):
+        return (concat_examples(a[0], b[0]), torch.cat([a[1], b[1]], dim=0))
+    if isinstance(a, PackedSequences):
+        return a.concat(b)
+    max_len = max(a.size(0), b.size(0))
+    a = torch.cat([a, a.new_zeros(max_len - a.size(0), a.size(1))])
+    b = torch.cat([b, b.new_zeros(max_len - b.size(0), b.size(1))])
+    return torch.cat([a, b], dim=1)
+
+
+def map_tensors(fn, data):
+    """
+    apply fn to every tensor of a (nested) tuple of tensors
+    """
+    if isinstance(data, tuple):
+        return tuple(map_tensors(fn, x) for x in data)
+    return fn(data)
+
+
+def prefetch(iterable, size):
+    """
+    iterate over `iterable` in a background thread keeping up to `size` items
+    ready, so that producing the next items overlaps with using the current one
+    """
+    items: Queue = Queue(maxsize=size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((True, item))
+                if stop.is_set():
+                    return
+            items.put((False, None))
+        except Exception as error:
+            items.put((False, error))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        # unblock the producer if the consumer stopped early
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get(timeout=0.1)
+            except Empty:
+                pass
+
+
+def trim_batch(batch):
+    """
+    strip a [seq_len, bs] batch of indices of BOS and of everything from the
+    first EOS on, returns the kept indices of all sequences concatenated and
+    the length of every sequence, as numpy arrays. a list of index lists (beam
+    search output) only has its BOS and EOS removed
+    """
+    if isinstance(batch, list):
+        seqs = [[c for c in seq if c != BOS_IDX and c != EOS_IDX] for seq in batch]
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        values = np.fromiter(chain.from_iterable(seqs), np.int64, lengths.sum())
+        return values, lengths
+    batch = batch.transpose(0, 1)
+    after_eos = (batch == EOS_IDX).cumsum(dim=1) > 0
+    keep = ~after_eos & (batch != BOS_IDX)
+    return batch[keep].cpu().numpy(), keep.sum(dim=1).cpu().numpy()
+
+
+def split_trimmed(values, lengths):
+    """
+    list of the sequences of trim_batch, as lists
+    """
+    values = values.tolist()
+    ends = np.cumsum(lengths).tolist()
+    return [values[end - length : end] for end, length in zip(ends, lengths.tolist())]
+
+
+class Vocab(object):
+    """
+    persistent append-only symbol tables. a source, target or tag symbol keeps
+    its position in its table once added and unseen symbols are appended. in
+    the model input the tags follow the source symbols, so the source symbols
+    get a block of slots rounded up to VOCAB_BLOCK and the tags start after it:
+    new source symbols take free slots and the tags only move when the block
+    is full. `files` maps the content hash of the files read so far to their
+    number of examples (None if not counted) and whether their symbols are in
+    the vocab
+    """
+
+    def __init__(self, source=None, target=None, tags=None, reserved=0, files=None):
+        self.source = list(source or [])
+        self.target = list(target or [])
+        self.tags = list(tags or [])
+        self.reserved = reserved
+        self.files = dict(files or {})
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as fp:
+            state = json.load(fp)
+        # files written before the reserved block have the tags right after
+        reserved = state.get("reserved", len(state["source"]))
+        files = state.get("files")
+        return cls(state["source"], state["target"], state["tags"], reserved, files)
+
+    def state(self):
+        return dict(
+            source=self.source,
+            target=self.target,
+            tags=self.tags,
+            reserved=self.reserved,
+            files=self.files,
+        )
+
+    def save(self, path):
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as fp:
+            json.dump(self.state(), fp, ensure_ascii=False)
+        os.replace(tmp_file, path)
+
+    def sizes(self):
+        return [len(self.source), len(self.target), len(self.tags)]
+
+    def digest(self, sizes=None):
+        """
+        digest of the indices of the first `sizes` (source, target, tag)
+        symbols, all by default. it stays the same while symbols are appended,
+        unless the tags move
+        """
+        nb_source, nb_target, nb_tag = sizes or self.sizes()
+        state = [
+            self.source[:nb_source],
+            self.target[:nb_target],
+            self.tags[:nb_tag],
+            self.reserved if nb_tag else 0,
+        ]
+        state = json.dumps(state, ensure_ascii=False)
+        return hashlib.sha1(state.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _append(symbols, new):
+        known = set(symbols)
+        added = [x for x in new if x not in known]
+        symbols.extend(added)
+        return len(added)
+
+    def update(self, source, target, nb_attr=0):
+        """
+        append the symbols of a vocab from build_vocab (last `nb_attr` source
+        symbols are tags) not seen yet, returns the number of added symbols
+        """
+        nb_char = len(source) - nb_attr
+        nb_added = self._append(self.source, source[:nb_char])
+        nb_added += self._append(self.target, target)
+        nb_added += self._append(self.tags, source[nb_char:])
+        if self.tags and len(self.source) > self.reserved:
+            self.reserved = (len(self.source) // VOCAB_BLOCK + 1) * VOCAB_BLOCK
+        return nb_added
+
+    def symbols(self):
+        """
+        (source, target) in the layout of build_vocab, without the free slots
+        """
+        return self.source + self.tags, list(self.target)
+
+    def tables(self):
+        """
+        (source, target, nb_attr) of the dataloader, the free source slots
+        filled by placeholders
+        """
+        if not self.tags:
+            return list(self.source), list(self.target), 0
+        free = [f"<free{i}>" for i in range(len(self.source), self.reserved)]
+        return self.source + free + self.tags, list(self.target), len(self.tags)
 
 
 class Dataloader(object):
@@ -32,6 +304,9 @@ class Seq2SeqDataLoader(Dataloader):
         dev_file: List[str],
         test_file: Optional[List[str]] = None,
         shuffle=False,
+        cache_dir: Optional[str] = None,
+        vocab_files: Optional[List[str]] = None,
+        vocab_file: Optional[str] = None,
     ):
         super().__init__()
         self.train_file = train_file[0] if len(train_file) == 1 else train_file
@@ -40,10 +315,30 @@ class Seq2SeqDataLoader(Dataloader):
             test_file[0] if test_file and len(test_file) == 1 else test_file
         )
         self.shuffle = shuffle
+        self.bucket = False
+        self.max_tokens = 0
+        self.prefetch = 0
+        self.packed = False
         self.batch_data: Dict[str, List] = dict()
+        self.batch_lengths: Dict[str, tuple] = dict()
+        self.batch_order: Dict[str, np.ndarray] = dict()
         self.nb_train, self.nb_dev, self.nb_test = 0, 0, 0
         self.nb_attr = 0
-        self.source, self.target = self.build_vocab()
+        self.membership = None
+        self.master_data = None
+        self.nb_master_train = 0
+        self.member_files: List[str] = []
+        self.vocab_files = vocab_files or []
+        self.vocab_file = vocab_file
+        self.vocab: Optional[Vocab] = None
+        self.cache_dir = None
+        if cache_dir and vocab_file is None:
+            self.cache_dir = self._cache_dir(cache_dir)
+        self.source, self.target = self.load_vocab()
+        if cache_dir and vocab_file is not None:
+            # encoded files stay valid while the vocab grows, see _cached_vocab_valid
+            self.cache_dir = self._cache_dir(cache_dir)
+            os.makedirs(self.cache_dir, exist_ok=True)
         self.source_vocab_size = len(self.source)
         self.target_vocab_size = len(self.target)
         self.attr_c2i: Optional[Dict]
@@ -57,6 +352,7 @@ class Seq2SeqDataLoader(Dataloader):
             self.source_c2i = {c: i for i, c in enumerate(self.source)}
             self.attr_c2i = None
         self.target_c2i = {c: i for i, c in enumerate(self.target)}
+        self.target_table = np.array(self.target, dtype=object)
         self.sanity_check()
 
     def sanity_check(self):
@@ -89,43 +385,533 @@ class Seq2SeqDataLoader(Dataloader):
     def _file_identifier(self, file):
         return file
 
+    @staticmethod
+    def _file_hash(file):
+        """
+        content hash of a file or a list of files
+        """
+        if file is None:
+            return ""
+        files = file if isinstance(file, list) else [file]
+        sha1 = hashlib.sha1()
+        for fp in files:
+            with open(fp, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def _cache_dir(self, cache_dir):
+        """
+        cache entry of this dataloader class and train/dev/test content, or of
+        the persistent vocab file, which any file can be encoded with
+        """
+        if self.vocab is not None:
+            key = f"{type(self).__name__}\t{os.path.abspath(self.vocab_file)}"
+            digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+            return os.path.join(cache_dir, f"{type(self).__name__}-{digest[:16]}")
+        files = [self.train_file, self.dev_file, self.test_file, *self.vocab_files]
+        key = [type(self).__name__] + [self._file_hash(fp) for fp in files]
+        digest = hashlib.sha1("\t".join(key).encode("utf-8")).hexdigest()
+        return os.path.join(cache_dir, f"{type(self).__name__}-{digest[:16]}")
+
+    def load_vocab(self):
+        """
+        build_vocab, reusing the vocab and counts from the cache if possible
+        """
+        if self.vocab_file is not None:
+            return self.load_persistent_vocab()
+        if self.cache_dir is not None:
+            meta_file = os.path.join(self.cache_dir, "meta.json")
+            if os.path.isfile(meta_file):
+                with open(meta_file, "r", encoding="utf-8") as fp:
+                    meta = json.load(fp)
+                self.nb_train = meta["nb_train"]
+                self.nb_dev = meta["nb_dev"]
+                self.nb_test = meta["nb_test"]
+                self.nb_attr = meta["nb_attr"]
+                return meta["source"], meta["target"]
+
+        source, target = self.build_vocab()
+        if self.vocab_files:
+            source, target = self.extend_vocab(source, target, self.vocab_files)
+        if self.cache_dir is not None:
+            meta = dict(
+                nb_train=self.nb_train,
+                nb_dev=self.nb_dev,
+                nb_test=self.nb_test,
+                nb_attr=self.nb_attr,
+                source=source,
+                target=target,
+            )
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_file = f"{meta_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as fp:
+                json.dump(meta, fp, ensure_ascii=False)
+            os.replace(tmp_file, meta_file)
+        return source, target
+
+    def load_persistent_vocab(self):
+        """
+        the vocab of `vocab_file`, extended by the files it does not cover yet:
+        known symbols keep their index, new ones are appended and the file is
+        updated. the files it covers are not read again, their number of
+        examples is recorded in the vocab file
+        """
+        if os.path.isfile(self.vocab_file):
+            self.vocab = Vocab.load(self.vocab_file)
+        else:
+            self.vocab = Vocab()
+        vocab = self.vocab
+        state, nb_added = json.dumps(vocab.files), 0
+        self.nb_attr = len(vocab.tags)
+
+        # build_vocab reads the symbols of train and counts train, dev and test
+        files = [self.train_file, self.dev_file, self.test_file]
+        records = [
+            vocab.files.get(self._file_hash(fp), dict(examples=None, symbols=False))
+            for fp in files
+        ]
+        counts = [
+            record["examples"] if fp is not None else 0
+            for fp, record in zip(files, records)
+        ]
+        if None in counts or not records[0]["symbols"]:
+            source, target = self.build_vocab()
+            nb_added += vocab.update(source, target, self.nb_attr)
+            counts = [self.nb_train, self.nb_dev, self.nb_test]
+            records[0]["symbols"] = True
+            for fp, record, cnt in zip(files, records, counts):
+                if fp is not None:
+                    record["examples"] = cnt
+                    vocab.files[self._file_hash(fp)] = record
+        self.nb_train, self.nb_dev, self.nb_test = counts
+
+        new_files = []
+        for fp in self.vocab_files:
+            h = self._file_hash(fp)
+            record = vocab.files.setdefault(h, dict(examples=None, symbols=False))
+            if not record["symbols"]:
+                new_files.append(fp)
+                record["symbols"] = True
+        if new_files:
+            self.nb_attr = len(vocab.tags)
+            source, target = self.extend_vocab(*vocab.symbols(), new_files)
+            nb_added += vocab.update(source, target, self.nb_attr)
+
+        if nb_added or json.dumps(vocab.files) != state:
+            vocab.save(self.vocab_file)
+        source, target, self.nb_attr = vocab.tables()
+        return source, target
+
+    def extend_vocab(self, source, target, files):
+        """
+        add the symbols of `files` to the vocab, as if build_vocab had seen them
+        """
+        special = set([PAD, BOS, EOS, UNK, STEP])
+        src_specials = [x for x in source if x in special]
+        trg_specials = [x for x in target if x in special]
+        src_set, trg_set, tag_set = set(), set(), set()
+        for fp in files:
+            for item in self.read_file(fp):
+                src_set.update(item[0])
+                trg_set.update(item[1])
+                if self.nb_attr > 0:
+                    tag_set.update(item[2])
+        if self.nb_attr > 0:
+            # characters are shared by source and target, tags come last
+            chars = set(target[len(trg_specials) :]) | src_set | trg_set
+            chars = sorted(chars - special)
+            tags = sorted(set(source[-self.nb_attr :]) | (tag_set - special))
+            self.nb_attr = len(tags)
+            source = src_specials + chars + tags
+            target = trg_specials + chars
+        else:
+            source = src_specials + sorted(
+                set(source[len(src_specials) :]) | (src_set - special)
+            )
+            target = trg_specials + sorted(
+                set(target[len(trg_specials) :]) | (trg_set - special)
+            )
+        return source, target
+
+    def _cache_prefix(self, file):
+        name = self._file_hash(file)
+        if self.packed:
+            name = f"{name}.packed"
+        return os.path.join(self.cache_dir, name)
+
+    def _load_cached_data(self, file):
+        """
+        memory map the encoded tensors of `file`, None on cache miss
+        """
+        prefix = self._cache_prefix(file)
+        if not os.path.isfile(f"{prefix}.trg.npy"):
+            return None
+
+        def load(name):
+            # copy-on-write, so torch gets a writable view without reading the file
+            return np.load(f"{prefix}.{name}.npy", mmap_mode="c")
+
+        if self.vocab is not None and not self._cached_vocab_valid(prefix, load):
+            return None
+        if self.packed:
+            src_data = PackedSequences(load("src"), load("src_offsets"))
+            trg_data = PackedSequences(load("trg"), load("trg_offsets"))
+            src_mask, trg_mask = None, None
+        else:
+            src_data = torch.from_numpy(load("src"))
+            trg_data = torch.from_numpy(load("trg"))
+            src_mask = (src_data > 0).float()
+            trg_mask = (trg_data > 0).float()
+        if os.path.isfile(f"{prefix}.attr.npy"):
+            src_data = (src_data, torch.from_numpy(load("attr")))
+        return (src_data, src_mask, trg_data, trg_mask)
+
+    def _cached_vocab_valid(self, prefix, load):
+        """
+        whether an entry encoded with an earlier state of the persistent vocab
+        still holds the current indices: the symbols known then kept their
+        index, and, if the vocab grew since, none of its symbols was unknown
+        """
+        meta_file = f"{prefix}.vocab.json"
+        if not os.path.isfile(meta_file):
+            return False
+        with open(meta_file, "r", encoding="utf-8") as fp:
+            meta = json.load(fp)
+        if self.vocab.digest(meta["sizes"]) != meta["digest"]:
+            return False
+        if meta["sizes"] == self.vocab.sizes():
+            return True
+        names = ["src", "trg"]
+        if os.path.isfile(f"{prefix}.attr.npy"):
+            names.append("attr")
+        return not any((load(name) == UNK_IDX).any() for name in names)
+
+    def _save_cached_data(self, file, data):
+        prefix = self._cache_prefix(file)
+        if os.path.isfile(f"{prefix}.trg.npy"):
+            # an entry of an earlier vocab, incomplete until trg is written again
+            os.remove(f"{prefix}.trg.npy")
+        if self.vocab is not None:
+            sizes = self.vocab.sizes()
+            meta = dict(sizes=sizes, digest=self.vocab.digest(sizes))
+            tmp_file = f"{prefix}.vocab.{os.getpid()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as fp:
+                json.dump(meta, fp)
+            os.replace(tmp_file, f"{prefix}.vocab.json")
+        src_data, _, trg_data, _ = data
+        arrays = dict()
+        if isinstance(src_data, tuple):
+            src_data, arrays["attr"] = src_data[0], src_data[1].numpy()
+        for name, seqs in [("src", src_data), ("trg", trg_data)]:
+            if isinstance(seqs, PackedSequences):
+                arrays[name], arrays[f"{name}_offsets"] = seqs.values, seqs.offsets
+            else:
+                arrays[name] = seqs.numpy()
+        # trg is written last and marks a complete entry
+        for name in ["src", "src_offsets", "attr", "trg_offsets", "trg"]:
+            if name not in arrays:
+                continue
+            tmp_file = f"{prefix}.{name}.{os.getpid()}.tmp"
+            with open(tmp_file, "wb") as fp:
+                np.save(fp, arrays[name])
+            os.replace(tmp_file, f"{prefix}.{name}.npy")
+
+    def _index_dtype(self):
+        """
+        narrowest integer type holding every source and target index
+        """
+        nb_symbol = max(self.source_vocab_size, self.target_vocab_size)
+        return np.int16 if nb_symbol <= np.iinfo(np.int16).max else np.int32
+
+    def _encode_sequences(self, lst: List[List[int]]):
+        """
+        (data, mask) of index lists: a padded tensor and its mask, or packed
+        sequences without mask, see set_storage
+        """
+        if self.packed:
+            return PackedSequences.from_lists(lst, self._index_dtype()), None
+        return self.list_to_tensor(lst)
+
+    def _encode_attr(self, lst: List[List[int]]):
+        """
+        [nb_example, nb_attr + 1] tag indices, in the narrow type when packed
+        """
+        attr_data, _ = self.list_to_tensor(lst)
+        attr_data = attr_data.transpose(0, 1)
+        if self.packed:
+            attr_data = torch.from_numpy(attr_data.numpy().astype(self._index_dtype()))
+        return attr_data
+
+    def _build_batch_data(self, file):
+        lst = list()
+        for src, trg in tqdm(self._iter_helper(file), desc="read file"):
+            lst.append((src, trg))
+        src_data, src_mask = self._encode_sequences([src for src, _ in lst])
+        trg_data, trg_mask = self._encode_sequences([trg for _, trg in lst])
+        return (src_data, src_mask, trg_data, trg_mask)
+
+    def _encode_file(self, file):
+        """
+        encode `file` into padded tensors, through the cache if enabled
+        """
+        data = None
+        if self.cache_dir is not None:
+            data = self._load_cached_data(file)
+        if data is None:
+            data = self._build_batch_data(file)
+            if self.cache_dir is not None:
+                self._save_cached_data(file, data)
+        return data
+
+    def _load_batch_data(self, file):
+        key = self._file_identifier(file)
+        if key not in self.batch_data:
+            if self.membership is not None and file in self._member_files():
+                self.batch_data[key] = self._member_data(file)
+            else:
+                self.batch_data[key] = self._encode_file(file)
+        return key
+
+    def _member_files(self):
+        return self.member_files
+
+    def _member_index(self, file):
+        if file == self.member_files[0]:
+            return self.membership.train_index()
+        else:
+            return self.membership.pool_index()
+
+    def _member_data(self, file):
+        if self.master_data is None:
+            train_file, pool_file = self.member_files
+            train = self._encode_file(train_file)
+            pool = self._encode_file(pool_file)
+            self.master_data = tuple(concat_examples(a, b) for a, b in zip(train, pool))
+        index = torch.from_numpy(self._member_index(file))
+        return tuple(select_examples(x, index) for x in self.master_data)
+
+    def set_membership(self, membership):
+        """
+        read the train and pool (test) examples through `membership` over the
+        master dataset, i.e. the train file followed by the test file
+        """
+        if self.membership is None:
+            # fixed here, so that another file can stand in for the test file
+            self.member_files = [self.train_file, self.test_file]
+            self.nb_master_train = self.nb_train
+            nb_master = self.nb_train + self.nb_test
+        else:
+            nb_master = self.membership.nb_master
+        assert membership.nb_master == nb_master, "membership does not match the data"
+        self.membership = membership
+        self._update_membership()
+
+    def move_to_train(self, pool_rows):
+        """
+        move the pool examples at `pool_rows` to the end of the train set,
+        return their master index
+        """
+        master = self.membership.move_to_train(pool_rows)
+        self._update_membership()
+        return master
+
+    def _update_membership(self):
+        for file in self._member_files():
+            key = self._file_identifier(file)
+            self.batch_data.pop(key, None)
+            self.batch_lengths.pop(key, None)
+            self.batch_order.pop(key, None)
+        self.nb_train = self.membership.nb_train
+        self.nb_test = self.membership.nb_pool
+
+    def read_examples(self, file):
+        """
+        read_file, through the membership for the train and pool files
+        """
+        if self.membership is None or file not in self._member_files():
+            yield from self.read_file(file)
+            return
+        train_file, pool_file = self.member_files
+        master = list(self.read_file(train_file))
+        master.extend(self.read_file(pool_file))
+        for idx in self._member_index(file):
+            yield master[idx]
+
     def list_to_tensor(self, lst: List[List[int]], max_seq_len=None):
-        max_len = max([len(x) for x in lst])
+        """
+        [max_len, nb_seq] padded tensor of index lists and its mask, scattered
+        from the concatenated indices at once
+        """
+        packed = PackedSequences.from_lists(lst, np.int64)
+        max_len = int(packed.lengths.max())
         if max_seq_len is not None:
             max_len = min(max_len, max_seq_len)
-        data = torch.zeros((max_len, len(lst)), dtype=torch.long)
-        for i, seq in tqdm(enumerate(lst), desc="build tensor"):
-            data[: len(seq), i] = torch.tensor(seq)
+        data = packed.pad(np.arange(len(lst)), max_len)
         mask = (data > 0).float()
         return data, mask
 
-    def _batch_sample(self, batch_size, file, shuffle):
-        key = self._file_identifier(file)
-        if key not in self.batch_data:
-            lst = list()
-            for src, trg in tqdm(self._iter_helper(file), desc="read file"):
-                lst.append((src, trg))
-            src_data, src_mask = self.list_to_tensor([src for src, _ in lst])
-            trg_data, trg_mask = self.list_to_tensor([trg for _, trg in lst])
-            self.batch_data[key] = (src_data, src_mask, trg_data, trg_mask)
-
-        src_data, src_mask, trg_data, trg_mask = self.batch_data[key]
-        nb_example = len(src_data[0])
+    def set_batching(self, bucket=False, max_tokens=0, prefetch=0):
+        """
+        bucket: group examples of similar source/target length into batches
+        max_tokens: with bucket, fill batches up to this many padded tokens
+            (batch size * longest source or target) instead of a fixed size
+        prefetch: number of batches prepared ahead by a background thread
+        """
+        self.bucket = bucket
+        self.max_tokens = max_tokens
+        self.prefetch = prefetch
+
+    def set_storage(self, packed=False):
+        """
+        packed: keep the encoded files as PackedSequences, padded and masked
+            per batch, instead of padded tensors with their masks
+        """
+        assert not self.batch_data, "set the storage before encoding any file"
+        self.packed = packed
+
+    def example_order(self, file):
+        """
+        example index of each row yielded by the last batch pass over `file`
+        """
+        return self.batch_order[self._file_identifier(file)]
+
+    def nb_examples(self, file):
+        """
+        number of examples in `file`, encoding it if needed
+        """
+        return len(self._example_lengths(self._load_batch_data(file))[0])
+
+    def _example_lengths(self, key):
+        """
+        source and target length of each example of a cached file
+        """
+        if key not in self.batch_lengths:
+            src_data, src_mask, trg_data, trg_mask = self.batch_data[key]
+            if isinstance(src_data, tuple):
+                src_data = src_data[0]
+            if isinstance(src_data, PackedSequences):
+                self.batch_lengths[key] = (src_data.lengths, trg_data.lengths)
+            else:
+                self.batch_lengths[key] = (
+                    src_mask.sum(dim=0).long().numpy(),
+                    trg_mask.sum(dim=0).long().numpy(),
+                )
+        return self.batch_lengths[key]
+
+    def _batch_index(self, key, batch_size, shuffle):
+        """
+        split the example indices of a cached file into batches
+        """
+        src_len, trg_len = self._example_lengths(key)
+        nb_example = len(src_len)
         if shuffle:
             idx = np.random.permutation(nb_example)
         else:
             idx = np.arange(nb_example)
-        for start in range(0, nb_example, batch_size):
-            idx_ = idx[start : start + batch_size]
-            src_mask_b = src_mask[:, idx_]
-            trg_mask_b = trg_mask[:, idx_]
-            src_len = int(src_mask_b.sum(dim=0).max().item())
-            trg_len = int(trg_mask_b.sum(dim=0).max().item())
-            src_data_b = src_data[:src_len, idx_].to(self.device)
-            trg_data_b = trg_data[:trg_len, idx_].to(self.device)
-            src_mask_b = src_mask_b[:src_len].to(self.device)
-            trg_mask_b = trg_mask_b[:trg_len].to(self.device)
-            yield (src_data_b, src_mask_b, trg_data_b, trg_mask_b)
+
+        if not self.bucket:
+            batches = [
+                idx[start : start + batch_size]
+                for start in range(0, nb_example, batch_size)
+            ]
+        else:
+            # stable sort keeps the shuffled order within a bucket
+            idx = idx[np.lexsort((trg_len[idx], src_len[idx]))]
+            if self.max_tokens > 0:
+                batches = self._token_batches(idx, np.maximum(src_len, trg_len)[idx])
+            else:
+                batches = [
+                    idx[start : start + batch_size]
+                    for start in range(0, nb_example, batch_size)
+                ]
+            if shuffle:
+                batches = [batches[i] for i in np.random.permutation(len(batches))]
+
+        if batches:
+            self.batch_order[key] = np.concatenate(batches)
+        else:
+            self.batch_order[key] = idx
+        return batches
+
+    def _token_batches(self, idx, length):
+        """
+        split the sorted example indices `idx` of lengths `length` into batches
+        of at most --max_tokens padded tokens
+        """
+        batches = []
+        start, longest = 0, 0
+        for end in range(len(idx)):
+            longest_ = max(longest, length[end])
+            if end > start and longest_ * (end - start + 1) > self.max_tokens:
+                batches.append(idx[start:end])
+                start, longest_ = end, length[end]
+            longest = longest_
+        batches.append(idx[start:])
+        return batches
+
+    def nb_batches(self, file, batch_size):
+        """
+        number of batches of a pass over `file`. token budget batches follow
+        the sorted lengths, so their number does not depend on the shuffling
+        """
+        key = self._load_batch_data(file)
+        src_len, trg_len = self._example_lengths(key)
+        if not (self.bucket and self.max_tokens > 0):
+            return ceil(len(src_len) / batch_size)
+        idx = np.lexsort((trg_len, src_len))
+        return len(self._token_batches(idx, np.maximum(src_len, trg_len)[idx]))
+
+    def mean_batch_size(self, file, batch_size):
+        """
+        average number of examples of the batches of `file`
+        """
+        if not (self.bucket and self.max_tokens > 0):
+            return batch_size
+        return self.nb_examples(file) / self.nb_batches(file, batch_size)
+
+    @staticmethod
+    def _batch_tensors(data, idx_, src_len, trg_len):
+        """
+        examples `idx_` of encoded data, cut to the given source/target length
+        """
+        src_data, src_mask, trg_data, trg_mask = data
+        attr_data = None
+        if isinstance(src_data, tuple):
+            src_data, attr_data = src_data
+        if isinstance(src_data, PackedSequences):
+            src_data_b = src_data.pad(idx_, src_len)
+            trg_data_b = trg_data.pad(idx_, trg_len)
+            src_mask_b = (src_data_b > 0).float()
+            trg_mask_b = (trg_data_b > 0).float()
+        else:
+            src_data_b = src_data[:src_len, idx_]
+            trg_data_b = trg_data[:trg_len, idx_]
+            src_mask_b = src_mask[:src_len, idx_]
+            trg_mask_b = trg_mask[:trg_len, idx_]
+        if attr_data is not None:
+            src_data_b = (src_data_b, attr_data[idx_, :].long())
+        return (src_data_b, src_mask_b, trg_data_b, trg_mask_b)
+
+    def _batch_sample(self, batch_size, file, shuffle):
+        key = self._load_batch_data(file)
+        data = self.batch_data[key]
+        src_lens, trg_lens = self._example_lengths(key)
+        batches = self._batch_index(key, batch_size, shuffle)
+        # pinned batches are copied to the gpu while the previous one is used
+        pin = self.device.type == "cuda"
+
+        def prepare():
+            for idx_ in batches:
+                src_len, trg_len = int(src_lens[idx_].max()), int(trg_lens[idx_].max())
+                batch = self._batch_tensors(data, idx_, src_len, trg_len)
+                yield map_tensors(torch.Tensor.pin_memory, batch) if pin else batch
+
+        host_batches = prepare()
+        if self.prefetch > 0:
+            host_batches = prefetch(host_batches, self.prefetch)
+        for batch in host_batches:
+            yield map_tensors(lambda x: x.to(self.device, non_blocking=pin), batch)
 
     def train_batch_sample(self, batch_size):
         yield from self._batch_sample(batch_size, self.train_file, shuffle=self.shuffle)
@@ -136,6 +922,26 @@ class Seq2SeqDataLoader(Dataloader):
     def test_batch_sample(self, batch_size):
         yield from self._batch_sample(batch_size, self.test_file, shuffle=False)
 
+    def subsample_batches(self, batch_size, file, nb_example=0, seed=0):
+        """
+        device batches of a fixed random subsample of `nb_example` examples of
+        `file` (all if 0), drawn without touching the global random state
+        """
+        key = self._load_batch_data(file)
+        data = self.batch_data[key]
+        src_lens, trg_lens = self._example_lengths(key)
+        idx = np.arange(len(src_lens))
+        if 0 < nb_example < len(idx):
+            rng = np.random.RandomState(seed)
+            idx = np.sort(rng.choice(len(idx), nb_example, replace=False))
+        batches = []
+        for start in range(0, len(idx), batch_size):
+            idx_ = idx[start : start + batch_size]
+            src_len, trg_len = int(src_lens[idx_].max()), int(trg_lens[idx_].max())
+            batch = self._batch_tensors(data, idx_, src_len, trg_len)
+            batches.append(map_tensors(lambda x: x.to(self.device), batch))
+        return batches
+
     def encode_source(self, sent):
         if sent[0] != BOS:
             sent = [BOS] + sent
@@ -162,6 +968,17 @@ class Seq2SeqDataLoader(Dataloader):
             sent = sent.view(-1)
         return [self.target[x] for x in sent]
 
+    def decode_target_batch(self, values, lengths, sep=" "):
+        """
+        target strings of a trimmed batch (see trim_batch), symbols joined by sep
+        """
+        symbols = self.target_table[values].tolist()
+        ends = np.cumsum(lengths).tolist()
+        return [
+            sep.join(symbols[end - length : end])
+            for end, length in zip(ends, lengths.tolist())
+        ]
+
     def _sample(self, file):
         for src, trg in self._iter_helper(file):
             yield (
@@ -198,9 +1015,14 @@ class AlignSeq2SeqDataLoader(Seq2SeqDataLoader):
         dev_file: List[str],
         test_file: Optional[List[str]] = None,
         shuffle=False,
+        cache_dir: Optional[str] = None,
+        vocab_files: Optional[List[str]] = None,
+        vocab_file: Optional[str] = None,
     ):
         self.data: Dict[str, List] = dict()
-        super().__init__(train_file, dev_file, test_file, shuffle)
+        super().__init__(
+            train_file, dev_file, test_file, shuffle, cache_dir, vocab_files, vocab_file
+        )
 
     def sanity_check(self):
         super().sanity_check()
@@ -372,38 +1194,14 @@ class AlignSIGMORPHON2017Task1(AlignSeq2SeqDataLoader, SIGMORPHON2017Task1):
                     attr[attr_idx] = self.attr_c2i.get(tag, UNK_IDX)
             yield src, trg, attr
 
-    def _batch_sample(self, batch_size, file, shuffle):
-        key = self._file_identifier(file)
-        if key not in self.batch_data:
-            lst = list()
-            for src, trg, attr in tqdm(self._iter_helper(file), desc="read file"):
-                lst.append((src, trg, attr))
-            src_data, src_mask = self.list_to_tensor([src for src, _, _ in lst])
-            trg_data, trg_mask = self.list_to_tensor([trg for _, trg, _ in lst])
-            attr_data, _ = self.list_to_tensor([attr for _, _, attr in lst])
-            attr_data = attr_data.transpose(0, 1)
-            data = ((src_data, attr_data), src_mask, trg_data, trg_mask)
-            self.batch_data[key] = data
-
-        data = self.batch_data[key]
-        (src_data, attr_data), src_mask, trg_data, trg_mask = data
-        nb_example = len(src_data[0])
-        if shuffle:
-            idx = np.random.permutation(nb_example)
-        else:
-            idx = np.arange(nb_example)
-        for start in range(0, nb_example, batch_size):
-            idx_ = idx[start : start + batch_size]
-            src_mask_b = src_mask[:, idx_]
-            trg_mask_b = trg_mask[:, idx_]
-            src_len = int(src_mask_b.sum(dim=0).max().item())
-            trg_len = int(trg_mask_b.sum(dim=0).max().item())
-            src_data_b = src_data[:src_len, idx_].to(self.device)
-            trg_data_b = trg_data[:trg_len, idx_].to(self.device)
-            src_mask_b = src_mask_b[:src_len].to(self.device)
-            trg_mask_b = trg_mask_b[:trg_len].to(self.device)
-            attr_data_b = attr_data[idx_, :].to(self.device)
-            yield ((src_data_b, attr_data_b), src_mask_b, trg_data_b, trg_mask_b)
+    def _build_batch_data(self, file):
+        lst = list()
+        for src, trg, attr in tqdm(self._iter_helper(file), desc="read file"):
+            lst.append((src, trg, attr))
+        src_data, src_mask = self._encode_sequences([src for src, _, _ in lst])
+        trg_data, trg_mask = self._encode_sequences([trg for _, trg, _ in lst])
+        attr_data = self._encode_attr([attr for _, _, attr in lst])
+        return ((src_data, attr_data), src_mask, trg_data, trg_mask)
 
     def _sample(self, file):
         for src, trg, tags in self._iter_helper(file):
@@ -440,38 +1238,14 @@ class TagSIGMORPHON2017Task1(SIGMORPHON2017Task1):
                     attr[attr_idx] = self.attr_c2i.get(tag, UNK_IDX)
             yield src, trg, attr
 
-    def _batch_sample(self, batch_size, file, shuffle):
-        key = self._file_identifier(file)
-        if key not in self.batch_data:
-            lst = list()
-            for src, trg, attr in tqdm(self._iter_helper(file), desc="read file"):
-                lst.append((src, trg, attr))
-            src_data, src_mask = self.list_to_tensor([src for src, _, _ in lst])
-            trg_data, trg_mask = self.list_to_tensor([trg for _, trg, _ in lst])
-            attr_data, _ = self.list_to_tensor([attr for _, _, attr in lst])
-            attr_data = attr_data.transpose(0, 1)
-            data = ((src_data, attr_data), src_mask, trg_data, trg_mask)
-            self.batch_data[key] = data
-
-        data = self.batch_data[key]
-        (src_data, attr_data), src_mask, trg_data, trg_mask = data
-        nb_example = len(src_data[0])
-        if shuffle:
-            idx = np.random.permutation(nb_example)
-        else:
-            idx = np.arange(nb_example)
-        for start in range(0, nb_example, batch_size):
-            idx_ = idx[start : start + batch_size]
-            src_mask_b = src_mask[:, idx_]
-            trg_mask_b = trg_mask[:, idx_]
-            src_len = int(src_mask_b.sum(dim=0).max().item())
-            trg_len = int(trg_mask_b.sum(dim=0).max().item())
-            src_data_b = src_data[:src_len, idx_].to(self.device)
-            trg_data_b = trg_data[:trg_len, idx_].to(self.device)
-            src_mask_b = src_mask_b[:src_len].to(self.device)
-            trg_mask_b = trg_mask_b[:trg_len].to(self.device)
-            attr_data_b = attr_data[idx_, :].to(self.device)
-            yield ((src_data_b, attr_data_b), src_mask_b, trg_data_b, trg_mask_b)
+    def _build_batch_data(self, file):
+        lst = list()
+        for src, trg, attr in tqdm(self._iter_helper(file), desc="read file"):
+            lst.append((src, trg, attr))
+        src_data, src_mask = self._encode_sequences([src for src, _, _ in lst])
+        trg_data, trg_mask = self._encode_sequences([trg for _, trg, _ in lst])
+        attr_data = self._encode_attr([attr for _, _, attr in lst])
+        return ((src_data, attr_data), src_mask, trg_data, trg_mask)
 
     def _sample(self, file):
         for src, trg, tags in self._iter_helper(file):
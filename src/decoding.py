@@ -1,12 +1,15 @@
+import weakref
 from collections import namedtuple
 
 import torch
+from torch.nn.utils.rnn import pad_sequence
 
 import util
-from dataloader import BOS_IDX, EOS_IDX, STEP_IDX
-from model import HardMonoTransducer, HMMTransducer, dummy_mask
-from transformer import Transformer
-import torch.nn.functional as F
+from dataloader import BOS_IDX, EOS_IDX, PAD_IDX, STEP_IDX, select_examples
+from ensemble import TransformerEnsemble
+from model import HardMonoTransducer, HMMTransducer
+from transformer import Transformer, reorder_decode_state
+from uncertainty import ensemble_uncertainty, nbest_uncertainty
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -26,6 +29,7 @@ class Decoder(object):
             trg_bos=BOS_IDX,
             trg_eos=EOS_IDX,
             skip_attn=True,
+            precision=util.Precision.fp32,
     ):
         self.type = decoder_type
         self.max_len = max_len
@@ -34,14 +38,20 @@ class Decoder(object):
         self.trg_bos = trg_bos
         self.trg_eos = trg_eos
         self.skip_attn = skip_attn
+        self.precision = precision
 
     def __call__(self, transducer, src_sentence, src_mask):
+        # fp32 leaves the autocast state of the caller, e.g. the trainer, as is
+        with util.autocast(self.precision, src_mask.device.type):
+            return self.decode(transducer, src_sentence, src_mask)
+
+    def decode(self, transducer, src_sentence, src_mask):
         if self.type == Decode.greedy:
             if isinstance(transducer, HardMonoTransducer):
                 decode_fn = decode_greedy_mono
             elif isinstance(transducer, HMMTransducer):
                 decode_fn = decode_greedy_hmm
-            elif isinstance(transducer, Transformer):
+            elif isinstance(transducer, (Transformer, TransformerEnsemble)):
                 decode_fn = decode_greedy_transformer
             else:
                 decode_fn = decode_greedy_default
@@ -59,6 +69,8 @@ class Decoder(object):
                 decode_fn = decode_beam_mono
             elif isinstance(transducer, HMMTransducer):
                 decode_fn = decode_beam_hmm
+            elif isinstance(transducer, TransformerEnsemble):
+                decode_fn = decode_beam_ensemble
             elif isinstance(transducer, Transformer):
                 decode_fn = decode_beam_transformer
             else:
@@ -74,7 +86,7 @@ class Decoder(object):
                 trg_eos=self.trg_eos,
             )
         elif self.type == Decode.ensemble:
-            if isinstance(transducer, Transformer):
+            if isinstance(transducer, (Transformer, TransformerEnsemble)):
                 decode_fn = decode_beam_transformer_ensemble
             else:
                 raise ValueError("Ensemble decoding is only supported for Transformer models.")
@@ -94,8 +106,81 @@ class Decoder(object):
         return return_values
 
 
-def get_decode_fn(decode, max_len=100, beam_size=5):
-    return Decoder(decode, max_len=max_len, beam_size=beam_size)
+class MemoizedDecoder(object):
+    """
+    decode every distinct source (and attr) once per model version and scatter
+    the prediction, nll and entropy back to every occurrence, within a batch
+    and across batches. The model version changes with the model object or
+    any in-place update of its parameters, e.g. an optimizer step.
+    """
+
+    def __init__(self, decode_fn):
+        self.decode_fn = decode_fn
+        self.model = None
+        self.version = None
+        self.cache = {}
+
+    def check_version(self, transducer):
+        version = [p._version for p in transducer.parameters()]
+        if self.model is None or self.model() is not transducer:
+            self.cache = {}
+        elif version != self.version:
+            self.cache = {}
+        self.model = weakref.ref(transducer)
+        self.version = version
+
+    @staticmethod
+    def source_keys(src_sentence, src_mask):
+        """
+        hashable key of every source of the batch
+        """
+        lengths = src_mask.sum(dim=0).long().tolist()
+        if isinstance(src_sentence, tuple):
+            src, attr = src_sentence[0].cpu().numpy(), src_sentence[1].cpu().numpy()
+            return [
+                (src[:length, i].tobytes(), attr[i].tobytes())
+                for i, length in enumerate(lengths)
+            ]
+        src = src_sentence.cpu().numpy()
+        return [(src[:length, i].tobytes(),) for i, length in enumerate(lengths)]
+
+    def __call__(self, transducer, src_sentence, src_mask):
+        if not getattr(self.decode_fn, "skip_attn", True):
+            return self.decode_fn(transducer, src_sentence, src_mask)
+        self.check_version(transducer)
+        keys = self.source_keys(src_sentence, src_mask)
+        todo = {}
+        for i, key in enumerate(keys):
+            if key not in self.cache and key not in todo:
+                todo[key] = i
+        if todo:
+            index = torch.tensor(list(todo.values()), device=src_mask.device)
+            output, nlls, entropies, _ = self.decode_fn(
+                transducer,
+                select_examples(src_sentence, index),
+                src_mask.index_select(1, index),
+            )
+            if torch.is_tensor(output):
+                output = output.transpose(0, 1)
+            for key, out, nll, entropy in zip(todo, output, nlls, entropies):
+                self.cache[key] = (out, nll, entropy)
+        output, nlls, entropies = zip(*[self.cache[key] for key in keys])
+        if torch.is_tensor(output[0]):
+            output = pad_sequence(output, padding_value=PAD_IDX)
+        else:
+            output = list(output)
+        return output, list(nlls), list(entropies), None
+
+
+def get_decode_fn(
+    decode, max_len=100, beam_size=5, memoize=False, precision=util.Precision.fp32
+):
+    decode_fn = Decoder(
+        decode, max_len=max_len, beam_size=beam_size, precision=precision
+    )
+    if memoize:
+        return MemoizedDecoder(decode_fn)
+    return decode_fn
 
 
 def decode_greedy_default(
@@ -233,25 +318,22 @@ def decode_greedy_transformer(
     """
     src_sentence: [seq_len]
     """
-    assert isinstance(transducer, Transformer)
+    assert isinstance(transducer, (Transformer, TransformerEnsemble))
     transducer.eval()
     src_mask = (src_mask == 0).transpose(0, 1)
     enc_hs = transducer.encode(src_sentence, src_mask)
 
     _, bs = src_sentence.shape
-    output = torch.tensor([trg_bos] * bs, device=DEVICE)
-    output = output.view(1, bs)
+    word = torch.tensor([trg_bos] * bs, device=DEVICE)
+    output = word.view(1, bs)
+    state = transducer.init_decode_state(enc_hs, src_mask)
 
     finished = None
     nlls_per_instance = torch.zeros(bs, device=DEVICE)
     sequence_lengths = torch.ones(bs, device=DEVICE)
 
     for _ in range(max_len):
-        trg_mask = dummy_mask(output)
-        trg_mask = (trg_mask == 0).transpose(0, 1)
-
-        word_logprob = transducer.decode(enc_hs, src_mask, output, trg_mask)
-        word_logprob = word_logprob[-1]
+        word_logprob, state = transducer.decode_step(enc_hs, src_mask, word, state)
 
         word_logprob_value, word = torch.max(word_logprob, dim=1)  # Get both the value and index
         nlls_per_instance += -word_logprob_value
@@ -314,6 +396,43 @@ def gather_output(next_beams, cur_len, bs, beam_idx):
     ]
 
 
+def unfinished_rows(finish_beams, rows, log_prob, nb_beam, max_len):
+    """
+    position of the active rows whose live beams (log_prob: [bs, nb_beam]) can
+    still finish among their nb_beam best hypotheses, see beam_bound
+    """
+    bound = beam_bound(log_prob, max_len).tolist()
+    keep = []
+    for i, row in enumerate(rows):
+        scores = sorted((float(score) for score, _ in finish_beams[row]), reverse=True)
+        if len(scores) < nb_beam or bound[i] >= scores[nb_beam - 1]:
+            keep.append(i)
+    return keep
+
+
+def beam_bound(log_prob, max_len):
+    """
+    [bs] upper bound of the length normalized score of any hypothesis the live
+    beams of a row can still finish: every step adds a log prob <= 0, so the
+    score is at most the best log prob over the longest length, max_len + 1
+    """
+    return log_prob.max(dim=1).values / (max_len + 1)
+
+
+def select_enc_hs(enc_hs, index):
+    """
+    keep batch entries `index` of the encoder output: seq-first 3d tensors and
+    batch-first 2d tensors (e.g. merged tags), possibly nested in tuples
+    """
+    if enc_hs is None:
+        return None
+    if isinstance(enc_hs, tuple):
+        return tuple(select_enc_hs(h, index) for h in enc_hs)
+    if enc_hs.dim() == 3:
+        return enc_hs.index_select(1, index)
+    return enc_hs.index_select(0, index)
+
+
 def decode_beam_search_default(
         transducer,
         src_sentence,
@@ -339,6 +458,7 @@ def decode_beam_search_default(
     start = Beam(0, hidden, input_, output)
     beams = [start]
     finish_beams = [list() for _ in range(bs)]
+    rows = list(range(bs))
     for i in range(max_len):
         cur_len = i + 2  # bos & the current prediction
         next_beams = []
@@ -362,7 +482,7 @@ def decode_beam_search_default(
                         score = log_prob[j] / cur_len
                         seq = output[:, j].tolist()
                         log_prob[j] = -1e6
-                        finish_beams[j].append((score, seq))
+                        finish_beams[rows[j]].append((score, seq))
 
                 new_beam = Beam(
                     log_prob,
@@ -379,6 +499,22 @@ def decode_beam_search_default(
         input_ = gather_lstm_input(next_beams, bs, emb_dim, beam_idx)
         output = gather_output(next_beams, cur_len, bs, beam_idx)
 
+        # drop rows whose nb_beam best finished hypotheses are final
+        keep = unfinished_rows(finish_beams, rows, log_prob, nb_beam, max_len)
+        if not keep:
+            break
+        if len(keep) < bs:
+            rows = [rows[k] for k in keep]
+            bs = len(rows)
+            keep = torch.tensor(keep, device=DEVICE)
+            enc_hs = select_enc_hs(enc_hs, keep)
+            src_mask = src_mask.index_select(1, keep)
+            log_prob = log_prob.index_select(0, keep)
+            hidden0 = hidden0.index_select(1, keep)
+            hidden1 = hidden1.index_select(1, keep)
+            input_ = input_.index_select(0, keep)
+            output = output.index_select(1, keep)
+
         beams = [
             Beam(
                 lp.squeeze(-1),
@@ -397,7 +533,10 @@ def decode_beam_search_default(
     return [max(b)[1] if b else [] for b in finish_beams], None
 
 
-def decode_beam_transformer(
+BeamSearchResult = namedtuple("BeamSearchResult", "sequences scores lengths counts")
+
+
+def beam_search_transformer(
         transducer,
         src_sentence,
         src_mask,
@@ -405,105 +544,153 @@ def decode_beam_transformer(
         nb_beam=5,
         trg_bos=BOS_IDX,
         trg_eos=EOS_IDX,
+        early_stop=True,
 ):
     """
-    src_sentence: [seq_len]
+    beam search with all bs * nb_beam hypotheses decoded as a single batch
+
+    beam `k` of row `b` lives in column `b * nb_beam + k` of the folded batch.
+    finished hypotheses are recorded as (step, parent beam, score) in
+    preallocated tensors and rebuilt from back pointers once the search is done.
+    with early_stop, a row leaves the batch once its nb_beam best hypotheses
+    are final, which keeps the best hypothesis and its score but drops later,
+    worse ones from the list; without, rows run until max_len or no live beam
+
+    returns BeamSearchResult with
+        sequences: [bs, nb_finish, seq_len], padded with `trg_eos`
+        scores: [bs, nb_finish], length normalized log prob, padded with -inf
+        lengths: [bs, nb_finish], length including bos & eos
+        counts: [bs], number of finished hypotheses per row
     """
-    assert isinstance(transducer, Transformer)
+    assert isinstance(transducer, (Transformer, TransformerEnsemble))
 
     transducer.eval()
     src_mask = (src_mask == 0).transpose(0, 1)
     enc_hs = transducer.encode(src_sentence, src_mask)
 
     _, bs = src_sentence.shape
-    input_ = torch.tensor([trg_bos] * bs, device=DEVICE)
-    input_ = input_.view(1, bs)
-    output = input_
-    start = Beam(0, None, input_, output)
-    beams = [start]
-    finish_beams = [list() for _ in range(bs)]
+    beam_offset = torch.arange(bs, device=DEVICE).view(-1, 1) * nb_beam
+    state = transducer.init_decode_state(enc_hs, src_mask)
+    state = reorder_decode_state(
+        state, torch.arange(bs, device=DEVICE).repeat_interleave(nb_beam)
+    )
+    enc_hs = enc_hs.repeat_interleave(nb_beam, dim=1)
+    src_mask = state.memory_mask
+
+    # only the first beam is alive at the start
+    log_prob = torch.full((bs, nb_beam), float("-inf"), device=DEVICE)
+    log_prob[:, 0] = 0
+    word = torch.full((bs * nb_beam,), trg_bos, dtype=torch.long, device=DEVICE)
+
+    # each beam has at most one eos among its top-k, so nb_beam finish per step
+    capacity = max_len * nb_beam
+    words = torch.zeros((max_len, bs, nb_beam), dtype=torch.long, device=DEVICE)
+    parents = torch.zeros((max_len, bs, nb_beam), dtype=torch.long, device=DEVICE)
+    finish_score = torch.full((bs, capacity), float("-inf"), device=DEVICE)
+    finish_step = torch.zeros((bs, capacity), dtype=torch.long, device=DEVICE)
+    finish_parent = torch.zeros((bs, capacity), dtype=torch.long, device=DEVICE)
+    finish_count = torch.zeros(bs, dtype=torch.long, device=DEVICE)
+    # original row of each active row
+    rows = torch.arange(bs, device=DEVICE)
+
+    nb_step = 0
     for i in range(max_len):
         cur_len = i + 2  # bos & the current prediction
-        next_beams = []
-        for beam in beams:
-            trg_mask = dummy_mask(beam.input)
-            trg_mask = (trg_mask == 0).transpose(0, 1)
-
-            word_logprob = transducer.decode(enc_hs, src_mask, beam.input, trg_mask)
-            word_logprob = word_logprob[-1]
-
-            topk_log_prob, topk_word = word_logprob.topk(nb_beam)
-            topk_log_prob = topk_log_prob.split(1, dim=1)
-            topk_word = topk_word.split(1, dim=1)
-            for log_prob, word in zip(topk_log_prob, topk_word):
-                log_prob = log_prob.squeeze(1)
-                word = word.squeeze(1)
-
-                log_prob = beam.log_prob + log_prob
-                input_ = torch.cat((beam.input, word.view(1, bs)))
-                output = torch.cat((beam.partial_sent, word.view(1, bs)))
-
-                if (word == trg_eos).any():
-                    batch_idx = (word == trg_eos).nonzero().view(-1).tolist()
-                    for j in batch_idx:
-                        score = log_prob[j] / cur_len
-                        seq = output[:, j].tolist()
-                        log_prob[j] = -1e6
-                        finish_beams[j].append((score, seq, cur_len))
-
-                new_beam = Beam(
-                    log_prob,
-                    None,
-                    input_,
-                    output,
-                )
-                next_beams.append(new_beam)
-
-        beam_idx = get_topk_beam_idx(next_beams, nb_beam)
-        log_prob = gather_logprob(next_beams, bs, beam_idx)
-        input_ = torch.stack([b.input for b in next_beams], dim=-1)[
-            torch.arange(cur_len).view(-1, 1, 1),
-            torch.arange(bs).view(1, -1, 1),
-            beam_idx,
-        ]
-        output = gather_output(next_beams, cur_len, bs, beam_idx)
-        beams = [
-            Beam(lp.squeeze(-1), None, ip.squeeze(-1), op.squeeze(-1))
-            for lp, ip, op in zip(
-                log_prob.split(1, dim=-1),
-                input_.split(1, dim=-1),
-                output.split(1, dim=-1),
+        nb_step = i + 1
+        word_logprob, state = transducer.decode_step(enc_hs, src_mask, word, state)
+
+        topk_log_prob, topk_word = word_logprob.topk(nb_beam)
+        # candidates are ordered beam-major: [bs, nb_beam * nb_beam]
+        cand_log_prob = (log_prob.view(-1, 1) + topk_log_prob).view(len(rows), -1)
+        cand_word = topk_word.view(len(rows), -1)
+
+        is_eos = cand_word == trg_eos
+        finish = is_eos & torch.isfinite(cand_log_prob)
+        if finish.any():
+            row, col = finish.nonzero(as_tuple=True)
+            orig_row = rows[row]
+            slot = finish_count[orig_row] + (finish.long().cumsum(dim=1) - 1)[row, col]
+            finish_score[orig_row, slot] = cand_log_prob[row, col] / cur_len
+            finish_step[orig_row, slot] = i
+            finish_parent[orig_row, slot] = torch.div(
+                col, nb_beam, rounding_mode="floor"
             )
-        ]
-
-    # Denormalize the log likelihoods
-    denormalized_log_likelihoods = [[(score * length, seq) for score, seq, length in beams] for beams in
-                                    finish_beams]
-
-    # log_likelihoods = [[(score, seq) for score, seq, length in beams] for beams in finish_beams]
-
-    # Convert denormalized log likelihoods to probabilities
-    probs = [F.softmax(torch.tensor([b[0] for b in beams]), dim=0) for beams in denormalized_log_likelihoods]
+            finish_count.index_add_(0, rows, finish.long().sum(dim=1))
+        cand_log_prob = cand_log_prob.masked_fill(is_eos, float("-inf"))
+
+        log_prob, cand_idx = cand_log_prob.topk(nb_beam, dim=1)
+        beam_idx = torch.div(cand_idx, nb_beam, rounding_mode="floor")
+        word = cand_word.gather(1, cand_idx)
+        words[i, rows] = word
+        parents[i, rows] = beam_idx
+
+        # drop rows without live beams, or whose live beams cannot finish among
+        # the nb_beam best hypotheses any more, so the n-best list is final
+        done = ~torch.isfinite(log_prob).any(dim=1)
+        if early_stop:
+            worst = finish_score[rows].topk(nb_beam, dim=1).values[:, -1]
+            done |= beam_bound(log_prob, max_len) < worst
+        nb_done = int(done.sum().item())
+        if nb_done == len(rows):
+            break
+        if nb_done > 0:
+            keep = (~done).nonzero(as_tuple=True)[0]
+            flat_beam_idx = (beam_idx[keep] + beam_offset[keep]).view(-1)
+            rows = rows[keep]
+            log_prob = log_prob[keep]
+            word = word[keep]
+            beam_offset = beam_offset[: len(rows)]
+            enc_hs = enc_hs.index_select(1, flat_beam_idx)
+            state = reorder_decode_state(state, flat_beam_idx)
+            src_mask = state.memory_mask
+        else:
+            flat_beam_idx = (beam_idx + beam_offset).view(-1)
+            state = reorder_decode_state(state, flat_beam_idx, memory=False)
+        word = word.view(-1)
+
+    nb_finish = max(int(finish_count.max().item()), 1)
+    finish_score = finish_score[:, :nb_finish]
+    finish_step = finish_step[:, :nb_finish]
+    cursor = finish_parent[:, :nb_finish]
+
+    # follow back pointers: a hypothesis finished at step s is
+    # bos + words[0..s-1] along its ancestors + eos
+    sequences = torch.full(
+        (nb_step + 2, bs, nb_finish), trg_eos, dtype=torch.long, device=DEVICE
+    )
+    sequences[0] = trg_bos
+    for j in reversed(range(nb_step)):
+        active = finish_step > j
+        sequences[j + 1] = torch.where(
+            active, words[j].gather(1, cursor), sequences[j + 1]
+        )
+        cursor = torch.where(active, parents[j].gather(1, cursor), cursor)
 
-    # Compute entropy for each set of probabilities
-    entropies = []
-    scaled_entropies = []
-    for prob in probs:
-        # Consider only probabilities >= 0.05
-        filtered_probs = prob[prob >= 0.05]
-        entropy = -torch.sum(filtered_probs * torch.log(filtered_probs))
-        entropies.append(entropy.item())
+    return BeamSearchResult(
+        sequences.permute(1, 2, 0), finish_score, finish_step + 2, finish_count
+    )
 
-        # # Maximum Entropy Scaling
-        # max_entropy = torch.log(torch.tensor(len(filtered_probs)))
-        # scaled_entropy = entropy / max_entropy
-        # scaled_entropies.append(scaled_entropy.item())
 
-    normalized_nlls = [-max(b)[0].item() if b else float('inf') for b in finish_beams]
-    return [max(b)[1] if b else [] for b in finish_beams], None, normalized_nlls, entropies
+def unpack_beam_search_result(result):
+    """
+    convert BeamSearchResult into per row lists of (score, seq, length)
+    """
+    sequences = result.sequences.tolist()
+    scores = result.scores.cpu()
+    lengths = result.lengths.tolist()
+    counts = result.counts.tolist()
+    finish_beams = []
+    for b, count in enumerate(counts):
+        finish_beams.append(
+            [
+                (scores[b, k], sequences[b][k][: lengths[b][k]], lengths[b][k])
+                for k in range(count)
+            ]
+        )
+    return finish_beams
 
 
-def decode_beam_transformer_ensemble(
+def decode_beam_transformer(
         transducer,
         src_sentence,
         src_mask,
@@ -515,79 +702,136 @@ def decode_beam_transformer_ensemble(
     """
     src_sentence: [seq_len]
     """
-    assert isinstance(transducer, Transformer)
-
-    transducer.eval()
-    src_mask = (src_mask == 0).transpose(0, 1)
-    enc_hs = transducer.encode(src_sentence, src_mask)
-
-    _, bs = src_sentence.shape
-    input_ = torch.tensor([trg_bos] * bs, device=DEVICE)
-    input_ = input_.view(1, bs)
-    output = input_
-    start = Beam(0, None, input_, output)
-    beams = [start]
-    finish_beams = [list() for _ in range(bs)]
-    for i in range(max_len):
-        cur_len = i + 2  # bos & the current prediction
-        next_beams = []
-        for beam in beams:
-            trg_mask = dummy_mask(beam.input)
-            trg_mask = (trg_mask == 0).transpose(0, 1)
-
-            word_logprob = transducer.decode(enc_hs, src_mask, beam.input, trg_mask)
-            word_logprob = word_logprob[-1]
-
-            topk_log_prob, topk_word = word_logprob.topk(nb_beam)
-            topk_log_prob = topk_log_prob.split(1, dim=1)
-            topk_word = topk_word.split(1, dim=1)
-            for log_prob, word in zip(topk_log_prob, topk_word):
-                log_prob = log_prob.squeeze(1)
-                word = word.squeeze(1)
+    result = beam_search_transformer(
+        transducer,
+        src_sentence,
+        src_mask,
+        max_len=max_len,
+        nb_beam=nb_beam,
+        trg_bos=trg_bos,
+        trg_eos=trg_eos,
+    )
+    stats = nbest_uncertainty(result.scores, result.lengths.float())
+
+    best = result.scores.argmax(dim=1, keepdim=True)
+    sequences = result.sequences.gather(
+        1, best.unsqueeze(-1).expand(-1, -1, result.sequences.size(-1))
+    )
+    sequences = sequences.squeeze(1).tolist()
+    lengths = result.lengths.gather(1, best).view(-1).tolist()
+    counts = result.counts.tolist()
+    output = [
+        seq[:length] if count else []
+        for seq, length, count in zip(sequences, lengths, counts)
+    ]
+    return output, None, stats.nll.tolist(), stats.entropy.tolist()
 
-                log_prob = beam.log_prob + log_prob
-                input_ = torch.cat((beam.input, word.view(1, bs)))
-                output = torch.cat((beam.partial_sent, word.view(1, bs)))
 
-                if (word == trg_eos).any():
-                    batch_idx = (word == trg_eos).nonzero().view(-1).tolist()
-                    for j in batch_idx:
-                        score = log_prob[j] / cur_len
-                        seq = output[:, j].tolist()
-                        log_prob[j] = -1e6
-                        finish_beams[j].append((score, seq, cur_len))
+def ensemble_beam_search(
+        ensemble,
+        src_sentence,
+        src_mask,
+        max_len=50,
+        nb_beam=5,
+        trg_bos=BOS_IDX,
+        trg_eos=EOS_IDX,
+):
+    """
+    one beam search over the combined distribution of a TransformerEnsemble,
+    the finished hypotheses then scored by every member
 
-                new_beam = Beam(
-                    log_prob,
-                    None,
-                    input_,
-                    output,
-                )
-                next_beams.append(new_beam)
+    returns the BeamSearchResult and its EnsembleUncertainty
+    """
+    result = beam_search_transformer(
+        ensemble,
+        src_sentence,
+        src_mask,
+        max_len=max_len,
+        nb_beam=nb_beam,
+        trg_bos=trg_bos,
+        trg_eos=trg_eos,
+    )
+    bs, nb_finish, seq_len = result.sequences.shape
+    trg = result.sequences.reshape(bs * nb_finish, seq_len).transpose(0, 1)
+    steps = torch.arange(seq_len, device=DEVICE).view(-1, 1)
+    trg_mask = (steps < result.lengths.view(1, -1)).float()
+    member_log_probs = ensemble.sequence_log_probs(
+        src_sentence.repeat_interleave(nb_finish, dim=1),
+        src_mask.repeat_interleave(nb_finish, dim=1),
+        trg,
+        trg_mask,
+    )
+    stats = ensemble_uncertainty(
+        result.scores, member_log_probs.view(ensemble.nb_model, bs, nb_finish)
+    )
+    return result, stats
+
+
+def decode_beam_ensemble(
+        transducer,
+        src_sentence,
+        src_mask,
+        max_len=50,
+        nb_beam=5,
+        trg_bos=BOS_IDX,
+        trg_eos=EOS_IDX,
+):
+    """
+    src_sentence: [seq_len]
 
-        beam_idx = get_topk_beam_idx(next_beams, nb_beam)
-        log_prob = gather_logprob(next_beams, bs, beam_idx)
-        input_ = torch.stack([b.input for b in next_beams], dim=-1)[
-            torch.arange(cur_len).view(-1, 1, 1),
-            torch.arange(bs).view(1, -1, 1),
-            beam_idx,
-        ]
-        output = gather_output(next_beams, cur_len, bs, beam_idx)
-        beams = [
-            Beam(lp.squeeze(-1), None, ip.squeeze(-1), op.squeeze(-1))
-            for lp, ip, op in zip(
-                log_prob.split(1, dim=-1),
-                input_.split(1, dim=-1),
-                output.split(1, dim=-1),
-            )
-        ]
+    the reported entropy is the `uncertainty` statistic of the ensemble
+    """
+    result, stats = ensemble_beam_search(
+        transducer,
+        src_sentence,
+        src_mask,
+        max_len=max_len,
+        nb_beam=nb_beam,
+        trg_bos=trg_bos,
+        trg_eos=trg_eos,
+    )
+    best = result.scores.argmax(dim=1, keepdim=True)
+    sequences = result.sequences.gather(
+        1, best.unsqueeze(-1).expand(-1, -1, result.sequences.size(-1))
+    )
+    sequences = sequences.squeeze(1).tolist()
+    lengths = result.lengths.gather(1, best).view(-1).tolist()
+    counts = result.counts.tolist()
+    output = [
+        seq[:length] if count else []
+        for seq, length, count in zip(sequences, lengths, counts)
+    ]
+    uncertainty = getattr(stats, transducer.uncertainty)
+    return output, None, stats.nll.tolist(), uncertainty.tolist()
 
-    # Denormalize the log likelihoods
-    denormalized_log_likelihoods = [[(score * length, seq) for score, seq, length in beams] for beams in
-                                    finish_beams]
 
-    # Convert denormalized log likelihoods to probabilities
-    probs = [F.softmax(torch.tensor([b[0] for b in beams]), dim=0) for beams in denormalized_log_likelihoods]
+def decode_beam_transformer_ensemble(
+        transducer,
+        src_sentence,
+        src_mask,
+        max_len=50,
+        nb_beam=5,
+        trg_bos=BOS_IDX,
+        trg_eos=EOS_IDX,
+):
+    """
+    src_sentence: [seq_len]
+    """
+    result = beam_search_transformer(
+        transducer,
+        src_sentence,
+        src_mask,
+        max_len=max_len,
+        nb_beam=nb_beam,
+        trg_bos=trg_bos,
+        trg_eos=trg_eos,
+        # every finished hypothesis is listed, not only the nb_beam best
+        early_stop=False,
+    )
+    finish_beams = unpack_beam_search_result(result)
+    stats = nbest_uncertainty(result.scores, result.lengths.float())
+    probs = stats.probs.cpu()
+    probs = [probs[b, :count] for b, count in enumerate(result.counts.tolist())]
 
     # Instead of returning the best sequence, return all sequences in finish_beams
     # along with their probs.
@@ -629,6 +873,7 @@ def decode_beam_mono(
     start = BeamHard(0, hidden, input_, output, attn_pos)
     beams = [start]
     finish_beams = [list() for _ in range(bs)]
+    rows = list(range(bs))
     for i in range(max_len):
         cur_len = i + 2  # bos & the current prediction
         next_beams = []
@@ -655,7 +900,7 @@ def decode_beam_mono(
                         score = log_prob[j] / cur_len
                         seq = output[:, j].tolist()
                         log_prob[j] = -1e6
-                        finish_beams[j].append((score, seq))
+                        finish_beams[rows[j]].append((score, seq))
 
                 new_beam = BeamHard(log_prob, hidden, input_, output, attn_pos)
                 next_beams.append(new_beam)
@@ -669,6 +914,23 @@ def decode_beam_mono(
         attn_pos = torch.stack([b.attn_pos for b in next_beams], dim=-1)[
             0, torch.arange(bs).view(1, -1, 1), beam_idx.unsqueeze(0)
         ]
+
+        # drop rows whose nb_beam best finished hypotheses are final
+        keep = unfinished_rows(finish_beams, rows, log_prob, nb_beam, max_len)
+        if not keep:
+            break
+        if len(keep) < bs:
+            rows = [rows[k] for k in keep]
+            bs = len(rows)
+            keep = torch.tensor(keep, device=DEVICE)
+            enc_hs = select_enc_hs(enc_hs, keep)
+            src_mask = src_mask.index_select(1, keep)
+            log_prob = log_prob.index_select(0, keep)
+            hidden0 = hidden0.index_select(1, keep)
+            hidden1 = hidden1.index_select(1, keep)
+            input_ = input_.index_select(0, keep)
+            output = output.index_select(1, keep)
+            attn_pos = attn_pos.index_select(1, keep)
         beams = [
             BeamHard(
                 lp.squeeze(-1),
@@ -715,6 +977,7 @@ def decode_beam_hmm(
     start = BeamHMM(0, hidden, input_, output, forward)
     beams = [start]
     finish_beams = [list() for _ in range(bs)]
+    rows = list(range(bs))
     for i in range(max_len):
         cur_len = i + 2  # bos & the current prediction
         next_beams = []
@@ -752,7 +1015,7 @@ def decode_beam_hmm(
                         score = log_prob[j] / cur_len
                         seq = output[:, j].tolist()
                         log_prob[j] = -1e6
-                        finish_beams[j].append((score, seq))
+                        finish_beams[rows[j]].append((score, seq))
 
                 new_beam = BeamHMM(
                     log_prob,
@@ -776,6 +1039,23 @@ def decode_beam_hmm(
             beam_idx.unsqueeze(1).unsqueeze(1),
         ]
 
+        # drop rows whose nb_beam best finished hypotheses are final
+        keep = unfinished_rows(finish_beams, rows, log_prob, nb_beam, max_len)
+        if not keep:
+            break
+        if len(keep) < bs:
+            rows = [rows[k] for k in keep]
+            bs = len(rows)
+            keep = torch.tensor(keep, device=DEVICE)
+            enc_hs = select_enc_hs(enc_hs, keep)
+            src_mask = src_mask.index_select(1, keep)
+            log_prob = log_prob.index_select(0, keep)
+            hidden0 = hidden0.index_select(1, keep)
+            hidden1 = hidden1.index_select(1, keep)
+            input_ = input_.index_select(0, keep)
+            output = output.index_select(1, keep)
+            forward = forward.index_select(0, keep)
+
         beams = [
             BeamHMM(
                 lp.squeeze(-1),
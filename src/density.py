@@ -0,0 +1,206 @@
+"""
+information density of the pool samples
+
+The density of a sample is the average of its mean lemma similarity
+(1 / (1 + edit distance)) and its mean feature similarity (cosine of the binary
+character + feature vectors) with the other pool samples, identical lemmas and
+vectors excluded. The DensityStore keeps the similarity sums of every sample
+over the current pool, so samples leaving the pool only cost O(k * n).
+"""
+import os
+
+import numpy as np
+
+from levenshtein import encode, pairwise_distance
+
+# Number of elements in one block of pairwise work, bounds the memory use
+CHUNK_ELEMENTS = 1 << 24
+
+
+def read_dataset(file):
+    """
+    (lemma, features) of every line of a TSV file
+    """
+    dataset = []
+    with open(file, "r", encoding="utf-8") as fp:
+        for line in fp.readlines():
+            toks = line.strip().split("\t")
+            if len(toks) < 3:
+                continue
+            dataset.append((toks[0], toks[2].split(";")))
+    return dataset
+
+
+def to_vectors(dataset, charset, feature_set):
+    """
+    Binary character + feature vectors of all lemmas, deduplicated.
+    Returns the unique vectors [nb_unique, len(charset) + len(feature_set)], their
+    counts and the unique index of every lemma.
+    """
+    char_idx = {c: i for i, c in enumerate(charset)}
+    feature_idx = {f: len(charset) + i for i, f in enumerate(feature_set)}
+    keys = {}
+    inverse = np.empty(len(dataset), dtype=np.int64)
+    for i, (lemma, features) in enumerate(dataset):
+        key = frozenset(char_idx[c] for c in lemma if c in char_idx)
+        key |= frozenset(feature_idx[f] for f in features if f in feature_idx)
+        inverse[i] = keys.setdefault(key, len(keys))
+    vectors = np.zeros((len(keys), len(charset) + len(feature_set)), dtype=np.float32)
+    for key, idx in keys.items():
+        vectors[idx, list(key)] = 1
+    counts = np.bincount(inverse, minlength=len(keys)).astype(np.float64)
+    return vectors, counts, inverse
+
+
+def cosine_similarity_sums(vectors, counts, chunk_elements=CHUNK_ELEMENTS):
+    """
+    For every unique vector, the sum of its cosine similarity with all other
+    lemmas (identical vectors excluded). Dot products of binary vectors are
+    exact in float32, the normalization is done in float64.
+    """
+    norms = np.sqrt(vectors.sum(axis=1, dtype=np.float64))
+    sums = np.zeros(len(vectors), dtype=np.float64)
+    chunk = max(1, chunk_elements // max(1, len(vectors)))
+    for start in range(0, len(vectors), chunk):
+        end = min(start + chunk, len(vectors))
+        dots = (vectors[start:end] @ vectors.T).astype(np.float64)
+        cos = dots / (norms[start:end, None] * norms[None, :])
+        cos[np.arange(end - start), np.arange(start, end)] = 0
+        sums[start:end] = cos @ counts
+    return sums
+
+
+def lemma_similarity_sums(lemmas, chunk_elements=CHUNK_ELEMENTS, verbose=True):
+    """
+    For every lemma, the sum of 1 / (1 + edit distance) with all other lemmas
+    (identical lemmas excluded).
+    """
+    unique = sorted(set(lemmas))
+    unique_idx = {lemma: i for i, lemma in enumerate(unique)}
+    inverse = np.array([unique_idx[lemma] for lemma in lemmas], dtype=np.int64)
+    counts = np.bincount(inverse, minlength=len(unique)).astype(np.float64)
+    [(codes, lengths)] = encode(unique)
+
+    # chunks of lemmas with similar length need fewer DP rows
+    order = np.argsort(lengths, kind="stable")
+    sums = np.zeros(len(unique), dtype=np.float64)
+    chunk = max(1, chunk_elements // (len(unique) * (codes.shape[1] + 1)))
+    for start in range(0, len(unique), chunk):
+        rows = order[start : start + chunk]
+        dists = pairwise_distance(codes[rows], lengths[rows], codes, lengths)
+        sims = np.where(dists == 0, 0.0, 1 / (1 + dists.astype(np.float64)))
+        sums[rows] = sims @ counts
+        if verbose:
+            print(f"Lemma similarity: {start + len(rows)}/{len(unique)} unique lemmas")
+    return sums[inverse]
+
+
+class DensityStore(object):
+    """
+    similarity sums of every sample of the initial pool over the current pool
+    """
+
+    def __init__(self, codes, lengths, vectors, lemma_sums, feature_sums, in_pool):
+        self.codes = codes
+        self.lengths = lengths
+        self.vectors = vectors
+        self.lemma_sums = lemma_sums
+        self.feature_sums = feature_sums
+        self.in_pool = in_pool
+
+    @classmethod
+    def build(cls, dataset, chunk_elements=CHUNK_ELEMENTS):
+        """
+        O(n^2) similarity sums over the whole dataset, done once
+        """
+        lemmas = [lemma for lemma, _ in dataset]
+        charset = sorted(set("".join(lemmas)))
+        feature_set = sorted(set(f for _, features in dataset for f in features))
+        vectors, counts, inverse = to_vectors(dataset, charset, feature_set)
+        feature_sums = cosine_similarity_sums(vectors, counts, chunk_elements)[inverse]
+        lemma_sums = lemma_similarity_sums(lemmas, chunk_elements, verbose=False)
+        [(codes, lengths)] = encode(lemmas)
+        in_pool = np.ones(len(dataset), dtype=bool)
+        return cls(codes, lengths, vectors[inverse], lemma_sums, feature_sums, in_pool)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            return cls(
+                state["codes"],
+                state["lengths"],
+                state["vectors"],
+                state["lemma_sums"],
+                state["feature_sums"],
+                state["in_pool"],
+            )
+
+    def save(self, path):
+        tmp_file = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_file,
+            codes=self.codes,
+            lengths=self.lengths,
+            vectors=self.vectors,
+            lemma_sums=self.lemma_sums,
+            feature_sums=self.feature_sums,
+            in_pool=self.in_pool,
+        )
+        os.replace(tmp_file, path)
+
+    @property
+    def nb_pool(self):
+        return int(self.in_pool.sum())
+
+    def pool_index(self):
+        """
+        index of each pool sample in the initial pool, in pool order
+        """
+        return np.flatnonzero(self.in_pool)
+
+    def similarities(self):
+        """
+        average lemma and feature similarity of the pool samples, in pool order
+        """
+        pool = self.in_pool
+        denom = max(1, self.nb_pool - 1)  # -1 to exclude self
+        return self.lemma_sums[pool] / denom, self.feature_sums[pool] / denom
+
+    def densities(self):
+        """
+        information density of the pool samples, in pool order
+        """
+        avg_lemma_sims, avg_feature_sims = self.similarities()
+        return (avg_lemma_sims + avg_feature_sims) / 2
+
+    def remove(self, pool_rows, chunk_elements=CHUNK_ELEMENTS):
+        """
+        take the samples at rows `pool_rows` of the current pool out of the
+        pool and subtract their similarity with the remaining samples
+        """
+        pool_index = self.pool_index()
+        removed = pool_index[np.asarray(pool_rows, dtype=np.int64)]
+        assert len(np.unique(removed)) == len(removed), "duplicate pool rows"
+        self.in_pool[removed] = False
+        remain = self.pool_index()
+        if len(removed) == 0 or len(remain) == 0:
+            return removed
+
+        vectors = self.vectors[remain]
+        sizes = vectors.sum(axis=1, dtype=np.float64)
+        codes, lengths = self.codes[remain], self.lengths[remain]
+        chunk = max(1, chunk_elements // (len(remain) * (codes.shape[1] + 1)))
+        for start in range(0, len(removed), chunk):
+            rows = removed[start : start + chunk]
+
+            dots = (self.vectors[rows] @ vectors.T).astype(np.float64)
+            rows_sizes = self.vectors[rows].sum(axis=1, dtype=np.float64)
+            cos = dots / np.sqrt(rows_sizes[:, None] * sizes[None, :])
+            # binary vectors are identical iff their dot product equals both sizes
+            same = (dots == rows_sizes[:, None]) & (dots == sizes[None, :])
+            self.feature_sums[remain] -= np.where(same, 0.0, cos).sum(axis=0)
+
+            dists = pairwise_distance(self.codes[rows], self.lengths[rows], codes, lengths)
+            sims = np.where(dists == 0, 0.0, 1 / (1 + dists.astype(np.float64)))
+            self.lemma_sums[remain] -= sims.sum(axis=0)
+        return removed
@@ -0,0 +1,402 @@
+"""
+ensemble of same-vocabulary transformers decoded as a single model
+"""
+import copy
+import math
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+from checkpoint import load_model, model_config
+from dataloader import PAD_IDX
+from transformer import DecodeState, Transformer
+
+try:
+    from torch.func import vmap
+except ImportError:  # torch < 2.0, the members run one after the other
+    vmap = None
+
+COMBINE = ("mean", "product")
+UNCERTAINTY = ("entropy", "vote_entropy", "mutual_information")
+
+
+class TransformerEnsemble(nn.Module):
+    """
+    combine the next-token distributions of N transformers, either by averaging
+    their probabilities ("mean") or as a product of experts ("product").
+
+    the ensemble implements the incremental decoding interface of Transformer
+    (encode, init_decode_state, decode_step), so the batched beam search runs
+    unchanged: the encoder states of the members are stacked as
+    [seq_len, bs, nb_model, embed_dim] and the decoding states are concatenated,
+    member `m` owning entries m * nb_layer ... (m + 1) * nb_layer - 1.
+    """
+
+    def __init__(self, models, combine="mean", uncertainty="mutual_information"):
+        super().__init__()
+        assert len(models) > 0 and all(isinstance(m, Transformer) for m in models)
+        assert len(set(m.trg_vocab_size for m in models)) == 1, "different vocab"
+        assert combine in COMBINE and uncertainty in UNCERTAINTY
+        self.models = nn.ModuleList(models)
+        self.combine = combine
+        # statistic of EnsembleUncertainty reported as entropy when decoding
+        self.uncertainty = uncertainty
+        self.trg_vocab_size = models[0].trg_vocab_size
+        self.label_smooth = models[0].label_smooth
+
+    @classmethod
+    def load(cls, filepaths, device, **kwargs):
+        models = [load_model(fp, map_location=device) for fp in filepaths]
+        return cls(models, **kwargs)
+
+    @property
+    def nb_model(self):
+        return len(self.models)
+
+    @property
+    def config(self):
+        """
+        constructor arguments for checkpoint.model_config, None unless every
+        member has a config
+        """
+        members = [model_config(m) for m in self.models]
+        if None in members:
+            return None
+        return dict(members=members, combine=self.combine, uncertainty=self.uncertainty)
+
+    def encode(self, src_batch, src_mask):
+        return torch.stack([m.encode(src_batch, src_mask) for m in self.models], dim=2)
+
+    def init_decode_state(self, enc_hs, src_mask):
+        states = [
+            m.init_decode_state(enc_hs[:, :, i], src_mask)
+            for i, m in enumerate(self.models)
+        ]
+        return DecodeState(
+            [k for s in states for k in s.keys],
+            [v for s in states for v in s.values],
+            [k for s in states for k in s.memory_keys],
+            [v for s in states for v in s.memory_values],
+            src_mask,
+            states[0].positions,
+            0,
+        )
+
+    def member_states(self, state):
+        """
+        split the concatenated decoding state into one DecodeState per member
+        """
+        start = 0
+        for m in self.models:
+            end = start + len(m.decoder_layers())
+            yield DecodeState(
+                state.keys[start:end],
+                state.values[start:end],
+                state.memory_keys[start:end],
+                state.memory_values[start:end],
+                state.memory_mask,
+                state.positions,
+                state.length,
+            )
+            start = end
+
+    def decode_step(self, enc_hs, src_mask, trg_token, state):
+        """
+        combined word_logprob: [bs, trg_vocab_size] and the updated state
+        """
+        log_probs, states = [], []
+        for i, (m, s) in enumerate(zip(self.models, self.member_states(state))):
+            word_logprob, s = m.decode_step(enc_hs[:, :, i], src_mask, trg_token, s)
+            log_probs.append(word_logprob)
+            states.append(s)
+        state = DecodeState(
+            [k for s in states for k in s.keys],
+            [v for s in states for v in s.values],
+            state.memory_keys,
+            state.memory_values,
+            state.memory_mask,
+            states[0].positions,
+            states[0].length,
+        )
+        return self.combine_log_probs(torch.stack(log_probs)), state
+
+    def combine_log_probs(self, log_probs):
+        """
+        log_probs: [nb_model, ..., trg_vocab_size]
+        """
+        if self.combine == "mean":
+            return log_probs.logsumexp(dim=0) - math.log(self.nb_model)
+        return torch.log_softmax(log_probs.mean(dim=0), dim=-1)
+
+    def member_outputs(self, src_batch, src_mask, trg_batch, trg_mask):
+        """
+        log probs of every member [nb_model, trg_seq_len, batch_size, vocab_siz]
+        """
+        outputs = [m(src_batch, src_mask, trg_batch, trg_mask) for m in self.models]
+        return torch.stack(outputs)
+
+    def forward(self, src_batch, src_mask, trg_batch, trg_mask):
+        """
+        combined log probs [trg_seq_len, batch_size, vocab_siz]
+        """
+        outputs = self.member_outputs(src_batch, src_mask, trg_batch, trg_mask)
+        return self.combine_log_probs(outputs)
+
+    # the loss of the combined distribution
+    loss = Transformer.loss
+    get_loss = Transformer.get_loss
+
+    def sequence_log_probs(self, src_batch, src_mask, trg_batch, trg_mask):
+        """
+        log probability of every target sequence under every member
+
+        src_batch, src_mask, trg_batch, trg_mask: as in Transformer.forward,
+            trg_batch starting with bos
+        returns [nb_model, bs]
+        """
+        outputs = self.member_outputs(src_batch, src_mask, trg_batch, trg_mask)
+        target = trg_batch[1:].expand(outputs.size(0), -1, -1)
+        token = outputs[:, :-1].gather(-1, target.unsqueeze(-1)).squeeze(-1)
+        return (token * trg_mask[1:]).sum(dim=1)
+
+
+def tensor_slots(model):
+    """
+    (module name, "_parameters" or "_buffers", key, index) of every parameter and
+    buffer of a model, tied tensors sharing one index, and the distinct
+    parameters and buffers
+    """
+    slots, tensors, index = [], {"_parameters": [], "_buffers": []}, {}
+    for name, module in model.named_modules():
+        for kind in ("_parameters", "_buffers"):
+            for key, tensor in getattr(module, kind).items():
+                if tensor is None:
+                    continue
+                if id(tensor) not in index:
+                    index[id(tensor)] = len(tensors[kind])
+                    tensors[kind].append(tensor)
+                slots.append((name, kind, key, index[id(tensor)]))
+    return slots, tensors["_parameters"], tensors["_buffers"]
+
+
+def select_member(value, dim, idx):
+    if dim is None or value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(select_member(v, dim, idx) for v in value)
+    return value.select(dim, idx)
+
+
+def stack_members(outputs, dim):
+    if outputs[0] is None:
+        return None
+    if isinstance(outputs[0], (list, tuple)):
+        return type(outputs[0])(stack_members(list(o), dim) for o in zip(*outputs))
+    return torch.stack(outputs, dim=dim)
+
+
+class StackedTransformerEnsemble(TransformerEnsemble):
+    """
+    TransformerEnsemble of same-architecture members whose parameters are
+    stacked along a leading member dimension, so that each layer runs as one
+    batched computation over all members (torch.func.vmap) instead of one
+    forward pass per member. Without torch.func the members run in turn on
+    their slice of the stacked parameters.
+
+    `base` keeps the architecture with its tensors removed; every member call
+    binds the (batched) parameters of the members into it. Member decoding
+    states are stacked at dim 1 ([bs, nb_model, ...]) so beams are still
+    reordered along dim 0.
+    """
+
+    def __init__(self, models, combine="mean", uncertainty="mutual_information"):
+        super().__init__(models, combine, uncertainty)
+        members = [tensor_slots(m) for m in self.models]
+        slots, params, buffers = members[0]
+        for _, member_params, member_buffers in members[1:]:
+            assert [p.shape for p in member_params] == [p.shape for p in params]
+            assert [b.shape for b in member_buffers] == [b.shape for b in buffers]
+        self.stacked_params = nn.ParameterList(
+            nn.Parameter(torch.stack([m[1][i].detach() for m in members]))
+            for i in range(len(params))
+        )
+        for i in range(len(buffers)):
+            stacked = torch.stack([m[2][i] for m in members])
+            self.register_buffer(f"stacked_buffer_{i}", stacked)
+        self.nb_buffer = len(buffers)
+        self.slots = slots
+        self.base = copy.deepcopy(self.models[0])
+        modules = dict(self.base.named_modules())
+        for name, kind, key, _ in slots:
+            getattr(modules[name], kind)[key] = None
+        del self.models
+
+    @property
+    def nb_model(self):
+        return self.stacked_params[0].size(0)
+
+    @property
+    def config(self):
+        member = model_config(self.base)
+        if member is None:
+            return None
+        members = [member] * self.nb_model
+        return dict(members=members, combine=self.combine, uncertainty=self.uncertainty)
+
+    def stacked_buffers(self):
+        return [getattr(self, f"stacked_buffer_{i}") for i in range(self.nb_buffer)]
+
+    @contextmanager
+    def bind(self, params, buffers):
+        """
+        temporarily put one member's (or the batched) tensors into `base`
+        """
+        modules = dict(self.base.named_modules())
+        tensors = {"_parameters": params, "_buffers": buffers}
+        try:
+            for name, kind, key, idx in self.slots:
+                getattr(modules[name], kind)[key] = tensors[kind][idx]
+            yield self.base
+        finally:
+            for name, kind, key, _ in self.slots:
+                getattr(modules[name], kind)[key] = None
+
+    def call_members(self, fn, in_dims, out_dims, *args):
+        """
+        fn(base, *args) for every member, outputs stacked at `out_dims`; args
+        with in_dim None are shared by the members
+        """
+
+        def member(params, buffers, *args):
+            with self.bind(params, buffers) as base:
+                return fn(base, *args)
+
+        params, buffers = list(self.stacked_params), self.stacked_buffers()
+        if vmap is not None:
+            return vmap(
+                member,
+                in_dims=(0, 0) + in_dims,
+                out_dims=out_dims,
+                randomness="different",
+            )(params, buffers, *args)
+        outputs = [
+            member(
+                [p[i] for p in params],
+                [b[i] for b in buffers],
+                *[select_member(a, d, i) for a, d in zip(args, in_dims)],
+            )
+            for i in range(self.nb_model)
+        ]
+        if isinstance(out_dims, tuple):
+            return tuple(stack_members(o, d) for o, d in zip(zip(*outputs), out_dims))
+        return stack_members(outputs, out_dims)
+
+    def members(self):
+        """
+        the members as separate Transformer modules
+        """
+        params, buffers = list(self.stacked_params), self.stacked_buffers()
+        models = []
+        for i in range(self.nb_model):
+            model = copy.deepcopy(self.base)
+            modules = dict(model.named_modules())
+            tensors = {
+                "_parameters": [nn.Parameter(p[i].detach().clone()) for p in params],
+                "_buffers": [b[i].clone() for b in buffers],
+            }
+            for name, kind, key, idx in self.slots:
+                getattr(modules[name], kind)[key] = tensors[kind][idx]
+            models.append(model)
+        return models
+
+    def encode(self, src_batch, src_mask):
+        return self.call_members(
+            lambda m, *args: m.encode(*args), (None, None), 2, src_batch, src_mask
+        )
+
+    def init_decode_state(self, enc_hs, src_mask):
+        def memory(m, enc_hs, src_mask):
+            state = m.init_decode_state(enc_hs, src_mask)
+            return state.memory_keys, state.memory_values
+
+        memory_keys, memory_values = self.call_members(
+            memory, (2, None), 1, enc_hs, src_mask
+        )
+        nb_layer = len(memory_keys)
+        positions = torch.zeros(enc_hs.size(1), dtype=torch.long, device=enc_hs.device)
+        return DecodeState(
+            [None] * nb_layer,
+            [None] * nb_layer,
+            memory_keys,
+            memory_values,
+            src_mask,
+            positions,
+            0,
+        )
+
+    def decode_step(self, enc_hs, src_mask, trg_token, state):
+        """
+        combined word_logprob: [bs, trg_vocab_size] and the updated state
+        """
+
+        def step(m, enc_hs, keys, values, memory_keys, memory_values):
+            member_state = DecodeState(
+                keys,
+                values,
+                memory_keys,
+                memory_values,
+                state.memory_mask,
+                state.positions,
+                state.length,
+            )
+            word_logprob, member_state = m.decode_step(
+                enc_hs, src_mask, trg_token, member_state
+            )
+            return word_logprob, member_state.keys, member_state.values
+
+        cache_dim = None if state.keys[0] is None else 1
+        log_probs, keys, values = self.call_members(
+            step,
+            (2, cache_dim, cache_dim, 1, 1),
+            (0, 1, 1),
+            enc_hs,
+            state.keys,
+            state.values,
+            state.memory_keys,
+            state.memory_values,
+        )
+        state = DecodeState(
+            keys,
+            values,
+            state.memory_keys,
+            state.memory_values,
+            state.memory_mask,
+            state.positions + trg_token.ne(PAD_IDX).long(),
+            state.length + 1,
+        )
+        return self.combine_log_probs(log_probs), state
+
+    def member_outputs(self, src_batch, src_mask, trg_batch, trg_mask):
+        return self.call_members(
+            lambda m, *args: m(*args),
+            (None, None, None, None),
+            0,
+            src_batch,
+            src_mask,
+            trg_batch,
+            trg_mask,
+        )
+
+    def get_loss(self, data, reduction=True):
+        """
+        in training, the sum of the member losses, so that every member gets
+        the gradient of its own loss as when trained alone; otherwise the loss
+        of the combined distribution
+        """
+        if not self.training:
+            return super().get_loss(data, reduction=reduction)
+        src, src_mask, trg, trg_mask = data
+        outputs = self.member_outputs(src, src_mask, trg, trg_mask)
+        losses = [self.loss(out[:-1], trg[1:], reduction=reduction) for out in outputs]
+        return torch.stack(losses).sum(dim=0)
@@ -0,0 +1,169 @@
+"""
+batched Levenshtein distance
+
+Sequences are encoded as padded code matrices [nb_seq, max_len] (padding -1)
+with their lengths. Distances between aligned pairs of sequences
+(`paired_distance`) or between all pairs of two sets of sequences
+(`pairwise_distance`) are computed for the whole batch at once, with Myers'
+bit-parallel algorithm when one side fits in 64 symbols and a row by row
+dynamic program otherwise.
+"""
+import numpy as np
+
+# longest pattern of the bit-parallel algorithm
+WORD_SIZE = 64
+
+_ZERO = np.uint64(0)
+_ONE = np.uint64(1)
+
+
+def encode(*groups):
+    """
+    (codes, lengths) of every group of sequences, the symbols of all groups
+    sharing one code. Symbols can be any hashable, e.g. characters or indices.
+    """
+    symbols = {}
+    encoded = []
+    for seqs in groups:
+        seqs = [[symbols.setdefault(x, len(symbols)) for x in seq] for seq in seqs]
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        codes = np.full((len(seqs), max(1, lengths.max(initial=0))), -1, np.int32)
+        for i, seq in enumerate(seqs):
+            codes[i, : len(seq)] = seq
+        encoded.append((codes, lengths))
+    return encoded
+
+
+def pad(values, lengths):
+    """
+    padded code matrix of sequences given as concatenated integer codes and
+    lengths, e.g. from dataloader.trim_batch
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    width = max(1, lengths.max(initial=0))
+    codes = np.full((len(lengths), width), -1, dtype=np.int32)
+    codes[np.arange(width) < lengths[:, None]] = values
+    return codes, lengths
+
+
+def match_masks(codes, nb_symbol):
+    """
+    [nb_seq, nb_symbol + 1] bit masks of the positions of every symbol, the
+    last column (padding) is empty
+    """
+    nb_seq, max_len = codes.shape
+    assert max_len <= WORD_SIZE
+    masks = np.zeros((nb_seq, nb_symbol + 1), dtype=np.uint64)
+    rows, cols = np.nonzero(codes >= 0)
+    bits = np.left_shift(_ONE, cols.astype(np.uint64))
+    np.bitwise_or.at(masks, (rows, codes[rows, cols]), bits)
+    return masks
+
+
+def _myers(text, text_lens, masks, mask_rows, pattern_lens):
+    """
+    distance between texts and patterns given by their match masks; text[..., i]
+    and mask_rows broadcast to the shape of the result
+    """
+    pattern_lens = np.asarray(pattern_lens)
+    shape = np.broadcast(text[..., 0], mask_rows).shape
+    pv = np.full(shape, ~_ZERO)
+    mv = np.zeros(shape, dtype=np.uint64)
+    score = np.broadcast_to(pattern_lens, shape).astype(np.int64)
+    # bit of the last pattern symbol, whose delta is the change of the distance
+    last = np.where(
+        pattern_lens > 0,
+        np.left_shift(_ONE, np.maximum(pattern_lens - 1, 0).astype(np.uint64)),
+        _ZERO,
+    )
+    for i in range(text.shape[-1]):
+        eq = masks[mask_rows, text[..., i]]
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        active = i < text_lens
+        score += active & ((ph & last) != _ZERO)
+        score -= active & ((mh & last) != _ZERO)
+        # the first row of the table grows by one every column
+        ph = (ph << _ONE) | _ONE
+        mh = mh << _ONE
+        pv = mh | ~(xv | ph)
+        mv = ph & xv
+    return np.where(pattern_lens > 0, score, np.broadcast_to(text_lens, shape))
+
+
+def _row_dp(a_codes, a_lens, b_codes, b_lens):
+    """
+    distance by the dynamic program, one row (symbol of a) at a time for all
+    pairs; the left-to-right dependency inside a row is a cumulative minimum.
+    a_codes[..., i, None] and b_codes broadcast to the shape of the result
+    """
+    len_b = b_codes.shape[-1]
+    shape = np.broadcast(a_codes[..., 0, None], b_codes).shape[:-1]
+    steps = np.arange(len_b + 1, dtype=np.int32)
+    prev = np.broadcast_to(steps, shape + (len_b + 1,))
+    for i in range(a_codes.shape[-1]):
+        cost = (a_codes[..., i, None] != b_codes).astype(np.int32)
+        cur = np.empty(prev.shape, dtype=np.int32)
+        cur[..., 0] = i + 1
+        np.minimum(prev[..., 1:] + 1, prev[..., :-1] + cost, out=cur[..., 1:])
+        cur -= steps
+        np.minimum.accumulate(cur, axis=-1, out=cur)
+        cur += steps
+        # rows past the end of a sequence keep their last value
+        prev = np.where((i < a_lens)[..., None], cur, prev)
+    index = np.broadcast_to(b_lens, shape)[..., None]
+    return np.take_along_axis(prev, index, axis=-1)[..., 0].astype(np.int64)
+
+
+def _trim(codes, lens):
+    return codes[:, : max(1, lens.max(initial=0))]
+
+
+def paired_distance(a_codes, a_lens, b_codes, b_lens):
+    """
+    [nb_seq] distance between the i-th sequence of a and the i-th of b
+    """
+    a_codes, b_codes = _trim(a_codes, a_lens), _trim(b_codes, b_lens)
+    if len(a_lens) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if b_codes.shape[1] > WORD_SIZE and a_codes.shape[1] <= WORD_SIZE:
+        a_codes, a_lens, b_codes, b_lens = b_codes, b_lens, a_codes, a_lens
+    if b_codes.shape[1] > WORD_SIZE:
+        return _row_dp(a_codes, a_lens, b_codes, b_lens)
+    nb_symbol = max(a_codes.max(initial=-1), b_codes.max(initial=-1)) + 1
+    masks = match_masks(b_codes, nb_symbol)
+    rows = np.arange(len(b_lens))
+    return _myers(a_codes, a_lens, masks, rows, b_lens)
+
+
+def pairwise_distance(a_codes, a_lens, b_codes, b_lens):
+    """
+    [len(a), len(b)] distance between every sequence of a and every one of b
+    """
+    a_codes, b_codes = _trim(a_codes, a_lens), _trim(b_codes, b_lens)
+    if b_codes.shape[1] > WORD_SIZE and a_codes.shape[1] <= WORD_SIZE:
+        return pairwise_distance(b_codes, b_lens, a_codes, a_lens).T
+    if b_codes.shape[1] > WORD_SIZE:
+        return _row_dp(a_codes[:, None, :], a_lens[:, None], b_codes[None], b_lens)
+    nb_symbol = max(a_codes.max(initial=-1), b_codes.max(initial=-1)) + 1
+    masks = match_masks(b_codes, nb_symbol)
+    rows = np.arange(len(b_lens))[None, :]
+    return _myers(a_codes[:, None, :], a_lens[:, None], masks, rows, b_lens[None, :])
+
+
+def edit_distances(predicts, targets):
+    """
+    distance between every prediction and its target, as a list of int
+    """
+    (a_codes, a_lens), (b_codes, b_lens) = encode(predicts, targets)
+    return paired_distance(a_codes, a_lens, b_codes, b_lens).tolist()
+
+
+def distance_matrix(seqs_a, seqs_b):
+    """
+    [len(seqs_a), len(seqs_b)] distance between all pairs of sequences
+    """
+    (a_codes, a_lens), (b_codes, b_lens) = encode(seqs_a, seqs_b)
+    return pairwise_distance(a_codes, a_lens, b_codes, b_lens)
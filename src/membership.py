@@ -0,0 +1,114 @@
+"""
+train/pool membership over one immutable master dataset
+
+The master dataset is the initial train file followed by the initial pool
+file. Instead of rewriting both files every round, the membership records for
+every master example its position in the train set (-1 while in the pool) and
+the round it was added in (0 for the initial train set, -1 for the pool).
+"""
+import os
+import sys
+
+import numpy as np
+
+
+class Membership(object):
+    def __init__(self, position, added):
+        self.position = position
+        self.added = added
+
+    @classmethod
+    def create(cls, nb_train, nb_pool):
+        position = np.full(nb_train + nb_pool, -1, dtype=np.int32)
+        position[:nb_train] = np.arange(nb_train, dtype=np.int32)
+        added = np.full(nb_train + nb_pool, -1, dtype=np.int16)
+        added[:nb_train] = 0
+        return cls(position, added)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as state:
+            return cls(state["position"], state["added"])
+
+    def save(self, path):
+        tmp_file = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, position=self.position, added=self.added)
+        os.replace(tmp_file, path)
+
+    @property
+    def nb_master(self):
+        return len(self.position)
+
+    @property
+    def nb_train(self):
+        return int(self.next_position)
+
+    @property
+    def nb_pool(self):
+        return self.nb_master - self.nb_train
+
+    @property
+    def next_position(self):
+        return self.position.max() + 1 if self.nb_master else 0
+
+    @property
+    def rounds(self):
+        """
+        number of finished move_to_train calls
+        """
+        return int(self.added.max()) if self.nb_master else 0
+
+    def train_index(self):
+        """
+        master index of each train example, in train order
+        """
+        index = np.flatnonzero(self.position >= 0)
+        return index[np.argsort(self.position[index], kind="stable")]
+
+    def pool_index(self):
+        """
+        master index of each pool example, in pool order
+        """
+        return np.flatnonzero(self.position < 0)
+
+    def move_to_train(self, pool_rows, pool_index=None):
+        """
+        append the pool examples at rows `pool_rows` (as indexed by
+        pool_index) to the train set, in the given order
+        """
+        if pool_index is None:
+            pool_index = self.pool_index()
+        master = pool_index[np.asarray(pool_rows, dtype=np.int64)]
+        assert len(np.unique(master)) == len(master), "duplicate pool rows"
+        start = self.next_position
+        self.position[master] = np.arange(start, start + len(master), dtype=np.int32)
+        self.added[master] = self.rounds + 1
+        return master
+
+
+def read_lines(file):
+    with open(file, "r", encoding="utf-8") as fp:
+        return [line for line in fp.readlines() if line.strip()]
+
+
+def export(membership_file, master_train, master_pool, train_file, pool_file):
+    """
+    write the current train and pool files for tools reading TSV files
+    """
+    membership = Membership.load(membership_file)
+    lines = read_lines(master_train) + read_lines(master_pool)
+    assert len(lines) == membership.nb_master, "membership does not match the files"
+    with open(train_file, "w", encoding="utf-8") as fp:
+        fp.writelines(lines[i] for i in membership.train_index())
+    with open(pool_file, "w", encoding="utf-8") as fp:
+        fp.writelines(lines[i] for i in membership.pool_index())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 6:
+        print(
+            "Usage: python src/membership.py <membership_file> <master_train> "
+            "<master_pool> <train_file> <pool_file>"
+        )
+        sys.exit(1)
+    export(*sys.argv[1:])
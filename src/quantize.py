@@ -0,0 +1,40 @@
+"""
+export a dynamically quantized int8 copy of the --load model, see
+checkpoint.quantize_model, and report its accuracy drift on the dev set
+"""
+import os
+
+import torch
+
+import checkpoint
+from decoding import get_decode_fn
+from train import Trainer
+
+
+def main():
+    """
+    main
+    """
+    trainer = Trainer()
+    params = trainer.params
+    params.quantize = True
+    decode_fn = get_decode_fn(
+        params.decode, params.max_decode_len, params.decode_beam_size
+    )
+    trainer.load_data(params.dataset, params.train, params.dev, params.test)
+    trainer.setup_evalutator()
+
+    assert params.load
+    trainer.load_model(params.load)
+    with torch.no_grad():
+        trainer.check_precision(params.bs, decode_fn)
+    filepath = f"{params.model}.int8"
+    checkpoint.save_quantized(trainer.model, filepath)
+    trainer.logger.info(
+        f"saved the int8 model in {filepath}: {os.path.getsize(filepath)} bytes, "
+        f"{os.path.getsize(params.load)} in fp32"
+    )
+
+
+if __name__ == "__main__":
+    main()
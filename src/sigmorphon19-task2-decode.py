@@ -5,10 +5,11 @@ import argparse
 
 import torch
 
+from checkpoint import is_quantized, load_model
 from dataloader import BOS, EOS, UNK_IDX
 from decoding import Decoder
 from model import dummy_mask
-from util import maybe_mkdir, unpack_batch
+from util import Precision, maybe_mkdir, unpack_batch
 
 
 def get_args():
@@ -20,6 +21,8 @@ def get_args():
     parser.add_argument('--max_len', default=100, type=int)
     parser.add_argument('--decode', default='greedy', choices=['greedy', 'beam'])
     parser.add_argument('--beam_size', default=5, type=int)
+    parser.add_argument('--precision', default=Precision.fp32, type=Precision, choices=list(Precision))
+    parser.add_argument('--quantize', default=False, action='store_true', help='decode with a dynamically quantized int8 copy of the model, on the cpu')
     return parser.parse_args()
     # fmt: on
 
@@ -51,11 +54,18 @@ def encode(model, word, tags, device):
 def main():
     opt = get_args()
 
-    decode_fn = Decoder(opt.decode, max_len=opt.max_len, beam_size=opt.beam_size)
+    decode_fn = Decoder(
+        opt.decode,
+        max_len=opt.max_len,
+        beam_size=opt.beam_size,
+        precision=opt.precision,
+    )
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = torch.load(open(opt.model, mode="rb"), map_location=device)
-    model = model.to(device)
+    model = load_model(opt.model, map_location=device, quantize=opt.quantize)
+    if is_quantized(model):
+        # int8 models, from --quantize or save_quantized, only run on the cpu
+        device = torch.device("cpu")
 
     trg_i2c = {i: c for c, i in model.trg_c2i.items()}
 
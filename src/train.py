@@ -10,8 +10,10 @@ from tqdm import tqdm
 import dataloader
 import model
 import transformer
+import uncertainty
 import util
 from decoding import Decode, get_decode_fn
+from levenshtein import pad, paired_distance
 from trainer import BaseTrainer
 
 tqdm.monitor_interval = 0
@@ -92,53 +94,55 @@ class Trainer(BaseTrainer):
         # fmt: off
         if params.arch == Arch.hardmono:
             if dataset == Data.sigmorphon17task1:
-                self.data = dataloader.AlignSIGMORPHON2017Task1(train, dev, test, params.shuffle)
+                self.data = dataloader.AlignSIGMORPHON2017Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.g2p:
-                self.data = dataloader.AlignStandardG2P(train, dev, test, params.shuffle)
+                self.data = dataloader.AlignStandardG2P(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.news15:
-                self.data = dataloader.AlignTransliteration(train, dev, test, params.shuffle)
+                self.data = dataloader.AlignTransliteration(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             else:
                 raise ValueError
         else:
             if dataset == Data.sigmorphon17task1:
                 if params.indtag:
-                    self.data = dataloader.TagSIGMORPHON2017Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagSIGMORPHON2017Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.SIGMORPHON2017Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.SIGMORPHON2017Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.unimorph:
                 if params.indtag:
-                    self.data = dataloader.TagUnimorph(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagUnimorph(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.Unimorph(train, dev, test, params.shuffle)
+                    self.data = dataloader.Unimorph(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.sigmorphon19task1:
                 assert isinstance(train, list) and len(train) == 2 and params.indtag
-                self.data = dataloader.TagSIGMORPHON2019Task1(train, dev, test, params.shuffle)
+                self.data = dataloader.TagSIGMORPHON2019Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.sigmorphon19task2:
                 assert params.indtag
-                self.data = dataloader.TagSIGMORPHON2019Task2(train, dev, test, params.shuffle)
+                self.data = dataloader.TagSIGMORPHON2019Task2(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.g2p:
-                self.data = dataloader.StandardG2P(train, dev, test, params.shuffle)
+                self.data = dataloader.StandardG2P(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.p2g:
-                self.data = dataloader.StandardP2G(train, dev, test, params.shuffle)
+                self.data = dataloader.StandardP2G(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.news15:
-                self.data = dataloader.Transliteration(train, dev, test, params.shuffle)
+                self.data = dataloader.Transliteration(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.histnorm:
-                self.data = dataloader.Histnorm(train, dev, test, params.shuffle)
+                self.data = dataloader.Histnorm(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.sigmorphon16task1:
                 if params.indtag:
-                    self.data = dataloader.TagSIGMORPHON2016Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagSIGMORPHON2016Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.SIGMORPHON2016Task1(train, dev, test, params.shuffle)
+                    self.data = dataloader.SIGMORPHON2016Task1(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.lemma:
                 if params.indtag:
-                    self.data = dataloader.TagLemmatization(train, dev, test, params.shuffle)
+                    self.data = dataloader.TagLemmatization(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
                 else:
-                    self.data = dataloader.Lemmatization(train, dev, test, params.shuffle)
+                    self.data = dataloader.Lemmatization(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             elif dataset == Data.lemmanotag:
-                self.data = dataloader.LemmatizationNotag(train, dev, test, params.shuffle)
+                self.data = dataloader.LemmatizationNotag(train, dev, test, params.shuffle, params.data_cache, params.vocab_files, params.vocab)
             else:
                 raise ValueError
         # fmt: on
+        self.data.set_batching(params.bucket, params.max_tokens, params.prefetch)
+        self.data.set_storage(params.packed_data)
         logger.info("src vocab size %d", self.data.source_vocab_size)
         logger.info("trg vocab size %d", self.data.target_vocab_size)
         logger.info("src vocab %r", self.data.source[:500])
@@ -199,6 +203,8 @@ class Trainer(BaseTrainer):
         else:
             model_class = regular_classfactory[params.arch]
         self.model = model_class(**kwargs)
+        # architecture recorded in the weights-only checkpoints
+        self.model.config = kwargs
         if params.indtag:
             self.logger.info("number of attribute %d", self.model.nb_attr)
             self.logger.info("dec 1st rnn %r", self.model.dec_rnn.layers[0])
@@ -251,9 +257,10 @@ class Trainer(BaseTrainer):
     def evaluate(self, mode, batch_size, epoch_idx, decode_fn):
         self.model.eval()
         sampler, nb_batch = self.iterate_batch(mode, batch_size)
-        results = self.evaluator.evaluate_all(
-            sampler, batch_size, nb_batch, self.model, decode_fn
-        )
+        with self.autocast():
+            results = self.evaluator.evaluate_all(
+                sampler, batch_size, nb_batch, self.model, decode_fn
+            )
         for result in results:
             self.logger.info(
                 f"{mode} {result.long_desc} is {result.res} at epoch {epoch_idx}"
@@ -261,45 +268,44 @@ class Trainer(BaseTrainer):
         return results
 
     def entropy(self, predictions):
-        # Filter out probabilities less than or equal to 0.05
-        predictions = predictions[predictions > 0.05]
-
-        # Calculate entropy
-        ent = -torch.sum(predictions * torch.log(predictions))
-        return ent.item()
+        # Only probabilities >= uncertainty.ENTROPY_THRESHOLD count
+        return uncertainty.thresholded_entropy(predictions).item()
 
     def decode(self, mode, batch_size, write_fp, decode_fn):
         self.model.eval()
-        cnt = 0
         sampler, nb_batch = self.iterate_batch(mode, batch_size)
-        with open(f"{write_fp}.{mode}.tsv", "w") as fp:
-            fp.write("prediction\ttarget\tloss\tdist\tnll\tentropy\n")
-            for src, src_mask, trg, trg_mask in tqdm(
-                sampler(batch_size), total=nb_batch
-            ):
+        lines = []
+        for src, src_mask, trg, trg_mask in tqdm(
+            sampler(batch_size), total=nb_batch
+        ):
+            with self.autocast():
                 pred, nlls, entropies, _ = decode_fn(self.model, src, src_mask)
-                self.evaluator.add(src, pred, trg)
+            self.evaluator.add(src, pred, trg)
 
-                data = (src, src_mask, trg, trg_mask)
+            data = (src, src_mask, trg, trg_mask)
+            with self.autocast():
                 losses = self.model.get_loss(data, reduction=False).cpu()
 
-                pred = util.unpack_batch(pred)
-                trg = util.unpack_batch(trg)
-                for p, t, loss, nll, entropy in zip(pred, trg, losses, nlls, entropies):  # Added nll to the loop
-                    dist = util.edit_distance(p, t)
-                    p = self.data.decode_target(p)
-                    t = self.data.decode_target(t)
-                    fp.write(f'{" ".join(p)}\t{" ".join(t)}\t{loss.item()}\t{dist}\t{nll}\t{entropy}\n')
-                    cnt += 1
-        self.logger.info(f"finished decoding {cnt} {mode} instance")
+            pred = dataloader.trim_batch(pred)
+            trg = dataloader.trim_batch(trg)
+            dists = paired_distance(*pad(*pred), *pad(*trg)).tolist()
+            pred = self.data.decode_target_batch(*pred)
+            trg = self.data.decode_target_batch(*trg)
+            for p, t, loss, dist, nll, entropy in zip(pred, trg, losses.tolist(), dists, nlls, entropies):  # Added nll to the loop
+                lines.append(f'{p}\t{t}\t{loss}\t{dist}\t{nll}\t{entropy}\n')
+        with open(f"{write_fp}.{mode}.tsv", "w") as fp:
+            fp.write("prediction\ttarget\tloss\tdist\tnll\tentropy\n")
+            fp.writelines(self.in_file_order(mode, lines))
+        self.logger.info(f"finished decoding {len(lines)} {mode} instance")
         results = self.evaluator.compute(reset=True)
         return results
 
-    def select_model(self):
-        best_res = [m for m in self.models if m.evaluation_result][0]
-        best_acc = [m for m in self.models if m.evaluation_result][0]
-        best_devloss = self.models[0]
-        for m in self.models:
+    def select_model(self, models=None):
+        models = self.models if models is None else models
+        best_res = [m for m in models if m.evaluation_result][0]
+        best_acc = [m for m in models if m.evaluation_result][0]
+        best_devloss = models[0]
+        for m in models:
             if not m.evaluation_result:
                 continue
             if (
@@ -348,7 +354,10 @@ def main():
     trainer.params.decode_beam_size = 5
 
     decode_fn = get_decode_fn(
-        params.decode, params.max_decode_len, params.decode_beam_size
+        params.decode,
+        params.max_decode_len,
+        params.decode_beam_size,
+        memoize=params.memoize_decode,
     )
     trainer.load_data(params.dataset, params.train, params.dev, params.test)
     trainer.setup_evalutator()
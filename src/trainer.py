@@ -1,8 +1,10 @@
 import argparse
+import copy
 import glob
 import os
 import random
 import re
+from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import partial
 from math import ceil
@@ -13,6 +15,7 @@ import torch
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from tqdm import tqdm
 
+import checkpoint
 import util
 
 tqdm.monitor_interval = 0
@@ -49,6 +52,7 @@ class Evaluation:
     filepath: str
     devloss: float
     evaluation_result: Optional[List[util.Eval]]
+    epoch: int = -1
 
 
 class BaseTrainer(object):
@@ -80,6 +84,11 @@ class BaseTrainer(object):
         self.global_steps = 0
         self.last_devloss = float("inf")
         self.models: List[Evaluation] = list()
+        self.writer: Optional[checkpoint.BackgroundWriter] = None
+        self.check_batches = None
+        self.best_check_loss = float("inf")
+        self.precision = self.params.precision
+        self.low_precision_scoring = self.scoring_precision() is not None
 
     def set_args(self):
         """
@@ -115,12 +124,38 @@ class BaseTrainer(object):
         parser.add_argument('--loglevel', default='info', choices=['info', 'debug'])
         parser.add_argument('--saveall', default=False, action='store_true', help='keep all models')
         parser.add_argument('--shuffle', default=False, action='store_true', help='shuffle the data')
+        parser.add_argument('--bucket', default=False, action='store_true', help='batch examples of similar length together')
+        parser.add_argument('--data_cache', default=None, type=str, help='directory caching the encoded data, keyed by file content')
+        parser.add_argument('--vocab_files', default=[], type=str, nargs='+', help='additional files the vocab is built over')
+        parser.add_argument('--vocab', default=None, type=str, help='persistent append-only vocab file with stable indices, created if missing')
+        parser.add_argument('--max_tokens', default=0, type=int, help='with --bucket, maximum padded tokens per batch instead of --bs')
+        parser.add_argument('--prefetch', default=0, type=int, help='number of batches prepared ahead in a background thread')
+        parser.add_argument('--packed_data', default=False, action='store_true', help='keep the encoded data as packed int16/int32 sequences, padded per batch')
+        parser.add_argument('--eval_steps', default=0, type=int, help='check the dev loss every k steps instead of --total_eval, see --eval_margin')
+        parser.add_argument('--eval_margin', default=-1, type=float, help='with --eval_steps, fully evaluate and save a model only if its check loss is below (1 + margin) times the best one (-1: at every check). the model is selected by its dev metrics (e.g. --bestacc), so with a margin the selected model can differ from evaluating every check')
+        parser.add_argument('--eval_subsample', default=0, type=int, help='with --eval_steps, number of dev examples of the loss check (0: all), which drives the lr schedule, early stopping and --eval_margin')
+        parser.add_argument('--async_save', default=False, action='store_true', help='write checkpoints in a background thread')
+        parser.add_argument('--keep_checkpoints', default=0, type=int, help='keep only the best k checkpoints while training, skipping models that would not be kept (0: keep all)')
+        parser.add_argument('--precision', default=util.Precision.fp32, type=util.Precision, choices=list(util.Precision), help='bf16: train and decode under bf16 autocast with the loss in fp32, and score the pool with bf16 weights')
+        parser.add_argument('--precision_tolerance', default=1.0, type=float, help='with --precision bf16 or --quantize, largest drop of the dev accuracy (points) of the bf16/int8 model against fp32 before pool scoring falls back to fp32')
+        parser.add_argument('--quantize', default=False, action='store_true', help='score the pool with a dynamically quantized int8 copy of the model (Linear layers, LSTM cells), cpu only')
+        parser.add_argument('--memoize_decode', default=False, action='store_true', help='decode every distinct source once per model version')
         parser.add_argument('--cleanup_anyway', default=False, action='store_true', help='cleanup anyway')
         parser.add_argument('--sampling', default='')
         # fmt: on
 
     def get_params(self):
-        return self.parser.parse_args()
+        params = self.parser.parse_args()
+        if params.precision == util.Precision.bf16 and not hasattr(torch, "autocast"):
+            self.parser.error("--precision bf16 needs torch.autocast (torch >= 1.10)")
+        if params.quantize and params.precision == util.Precision.bf16:
+            self.parser.error("--quantize and --precision bf16 are exclusive")
+        if params.quantize and torch.cuda.is_available():
+            # the int8 copy runs on the cpu while the batches are on the gpu
+            self.parser.error("--quantize only runs on the cpu")
+        if params.max_tokens > 0 and not params.bucket:
+            self.parser.error("--max_tokens needs --bucket")
+        return params
 
     def checklist_before_run(self):
         assert self.data is not None, "call load_data before run"
@@ -137,14 +172,54 @@ class BaseTrainer(object):
 
     def load_model(self, model):
         assert self.model is None
+        self.wait_for_writes()
         self.logger.info("load model in %s", model)
-        self.model = torch.load(model, map_location=self.device)
+        self.model = checkpoint.load_model(model, map_location=self.device)
         self.model = self.model.to(self.device)
+        self.match_vocab(self.model)
         epoch = int(model.split("_")[-1])
         return epoch
 
+    def match_vocab(self, model):
+        """
+        move `model` to the symbol tables of the data by symbol, e.g. when a
+        persistent --vocab gained symbols since it was trained: the new symbols
+        take free slots or, once the source block is full, move the tags.
+        return whether the vocab changed
+        """
+        data = self.data
+        if data is None or getattr(model, "src_c2i", None) is None:
+            return False
+        vocab = (data.source_c2i, data.target_c2i, data.attr_c2i)
+        if vocab == (model.src_c2i, model.trg_c2i, model.attr_c2i):
+            return False
+        if not hasattr(model, "resize_vocab"):
+            raise ValueError("cannot grow the vocab of a non transformer model")
+        model.resize_vocab(*vocab)
+        self.logger.info(
+            "grow vocab to %d source and %d target symbols",
+            model.src_vocab_size,
+            model.trg_vocab_size,
+        )
+        return True
+
     def smart_load_model(self, model_prefix):
         assert self.model is None
+        self.wait_for_writes()
+        index_file = f"{model_prefix}.index.json"
+        if os.path.isfile(index_file):
+            self.models = [
+                Evaluation(
+                    entry["filepath"],
+                    entry["devloss"],
+                    [util.Eval(*ev) for ev in entry["evals"]],
+                    entry["epoch"],
+                )
+                for entry in checkpoint.read_index(index_file)
+            ]
+            self.models.sort(key=lambda m: m.epoch)
+            return self.load_model(self.models[-1].filepath)
+        # runs without an index, the metrics are parsed from the file names
         models = []
         for model in glob.glob(f"{model_prefix}.nll*"):
             res = re.findall(r"\w*_\d+\.?\d*", model[len(model_prefix):])
@@ -157,7 +232,7 @@ class BaseTrainer(object):
             for ev in evals_:
                 ev = ev.split("_")
                 evals.append(util.Eval(ev[0], ev[0], float(ev[1])))
-            models.append((epoch, Evaluation(model, loss, evals)))
+            models.append((epoch, Evaluation(model, loss, evals, epoch)))
         self.models = [x[1] for x in sorted(models)]
         return self.load_model(self.models[-1].filepath)
 
@@ -225,14 +300,19 @@ class BaseTrainer(object):
         except AttributeError:
             return self.scheduler.get_lr()[0]
 
-    def train(self, epoch_idx, batch_size, max_norm):
+    def train(self, epoch_idx, batch_size, max_norm, on_step=None):
+        """
+        one epoch; on_step is called after every step and stops the epoch by
+        returning True
+        """
         logger, model = self.logger, self.model
         logger.info("At %d-th epoch with lr %f.", epoch_idx, self.get_lr())
         model.train()
         sampler, nb_batch = self.iterate_batch(TRAIN, batch_size)
         losses, cnt = 0, 0
         for batch in tqdm(sampler(batch_size), total=nb_batch):
-            loss = model.get_loss(batch)
+            with self.autocast():
+                loss = model.get_loss(batch)
             self.optimizer.zero_grad()
             loss.backward()
             if max_norm > 0:
@@ -248,31 +328,135 @@ class BaseTrainer(object):
             self.global_steps += 1
             losses += loss.item()
             cnt += 1
+            if on_step is not None and on_step():
+                break
         loss = losses / cnt
         self.logger.info(f"Running average train loss is {loss} at epoch {epoch_idx}")
         return loss
 
     def iterate_batch(self, mode, batch_size):
         if mode == TRAIN:
-            return (self.data.train_batch_sample, ceil(self.data.nb_train / batch_size))
+            nb_batch = self.data.nb_batches(self.data.train_file, batch_size)
+            return (self.data.train_batch_sample, nb_batch)
         elif mode == DEV:
-            return (self.data.dev_batch_sample, ceil(self.data.nb_dev / batch_size))
+            nb_batch = self.data.nb_batches(self.data.dev_file, batch_size)
+            return (self.data.dev_batch_sample, nb_batch)
         elif mode == TEST:
-            return (self.data.test_batch_sample, ceil(self.data.nb_test / batch_size))
+            nb_batch = self.data.nb_batches(self.data.test_file, batch_size)
+            return (self.data.test_batch_sample, nb_batch)
         else:
             raise ValueError(f"wrong mode: {mode}")
 
+    def in_file_order(self, mode, rows):
+        """
+        reorder per-example outputs of a batch pass over `mode` back to file order
+        """
+        if mode == TRAIN:
+            file = self.data.train_file
+        elif mode == DEV:
+            file = self.data.dev_file
+        elif mode == TEST:
+            file = self.data.test_file
+        else:
+            raise ValueError(f"wrong mode: {mode}")
+        ordered = [None] * len(rows)
+        for row, idx in zip(rows, self.data.example_order(file)):
+            ordered[idx] = row
+        return ordered
+
     def calc_loss(self, mode, batch_size, epoch_idx) -> float:
         self.model.eval()
         sampler, nb_batch = self.iterate_batch(mode, batch_size)
         loss, cnt = 0.0, 0
         for batch in tqdm(sampler(batch_size), total=nb_batch):
-            loss += self.model.get_loss(batch).item()
+            with self.autocast():
+                loss += self.model.get_loss(batch).item()
             cnt += 1
         loss = loss / cnt
         self.logger.info(f"Average {mode} loss is {loss} at epoch {epoch_idx}")
         return loss
 
+    def check_loss(self, batch_size, epoch_idx) -> float:
+        """
+        dev loss on the --eval_subsample examples, whose batches stay on the
+        device between checks
+        """
+        self.model.eval()
+        params = self.params
+        key = (self.data.dev_file, batch_size, params.eval_subsample)
+        if self.check_batches is None or self.check_batches[0] != key:
+            batches = self.data.subsample_batches(
+                batch_size, self.data.dev_file, params.eval_subsample, params.seed
+            )
+            self.check_batches = (key, batches)
+        batches = self.check_batches[1]
+        with self.autocast():
+            losses = [self.model.get_loss(batch) for batch in batches]
+        loss = torch.stack(losses).mean().item()
+        self.logger.info(f"Average dev check loss is {loss} at epoch {epoch_idx}")
+        return loss
+
+    def autocast(self):
+        """
+        autocast region of the current precision, see util.autocast
+        """
+        return util.autocast(self.precision, self.device.type)
+
+    def scoring_precision(self):
+        """
+        precision of the model copy of scoring_model: int8 with --quantize,
+        bf16 with --precision bf16, else None
+        """
+        if self.params.quantize:
+            return "int8"
+        if self.params.precision == util.Precision.bf16:
+            return "bf16"
+        return None
+
+    @contextmanager
+    def scoring_model(self):
+        """
+        swap in a copy of the model for inference only passes such as pool
+        scoring, with int8 weights (--quantize) or bf16 weights (--precision
+        bf16), unless check_precision turned it off
+        """
+        model = self.model
+        if self.low_precision_scoring:
+            if self.params.quantize:
+                self.model = checkpoint.quantize_model(model)
+            elif self.precision == util.Precision.bf16:
+                self.model = copy.deepcopy(model).to(torch.bfloat16)
+        try:
+            yield self.model
+        finally:
+            self.model = model
+
+    def check_precision(self, batch_size, decode_fn):
+        """
+        with --precision bf16 or --quantize, report the drift of the dev accuracy
+        of the scoring_model copy against the fp32 model, and score the pool in
+        fp32 if the copy loses more than --precision_tolerance
+        """
+        params = self.params
+        precision = self.scoring_precision()
+        if precision is None:
+            return
+        self.low_precision_scoring = True
+        self.precision = util.Precision.fp32
+        try:
+            fp32_res = self.evaluate(DEV, batch_size, -1, decode_fn)
+        finally:
+            self.precision = params.precision
+        with self.scoring_model():
+            res = self.evaluate(DEV, batch_size, -1, decode_fn)
+        fp32_acc, acc = fp32_res[0].res, res[0].res
+        self.low_precision_scoring = fp32_acc - acc <= params.precision_tolerance
+        self.logger.info(
+            f"dev {fp32_res[0].desc} is {fp32_acc} in fp32 and {acc} in {precision} "
+            f"(drift {acc - fp32_acc:.4f}), scoring the pool in "
+            f"{precision if self.low_precision_scoring else 'fp32'}"
+        )
+
     def iterate_instance(self, mode):
         if mode == TRAIN:
             return self.data.train_sample, self.data.nb_train
@@ -322,10 +506,77 @@ class BaseTrainer(object):
     ):
         eval_tag = "".join(["{}_{}.".format(e.desc, e.res) for e in eval_res])
         fp = f"{model_fp}.nll_{devloss:.4f}.{eval_tag}epoch_{epoch_idx}"
-        torch.save(self.model, fp)
-        self.models.append(Evaluation(fp, devloss, eval_res))
+        evaluation = Evaluation(fp, devloss, eval_res, epoch_idx)
+        # several checks of one epoch can end up with the same file name
+        self.models = [m for m in self.models if m.filepath != fp]
+        keep = self.params.keep_checkpoints
+        if keep > 0:
+            kept = self.top_models(self.models + [evaluation], keep)
+            if evaluation not in kept:
+                self.logger.info("skip saving %s, not among the best %d", fp, keep)
+                return
+            for m in self.models:
+                if m not in kept:
+                    self.submit_write(os.remove, m.filepath)
+            self.models = kept[:-1]
+        evals = [[e.desc, e.long_desc, e.res] for e in eval_res]
+        snapshot = checkpoint.snapshot(
+            self.model,
+            copy_tensors=self.params.async_save,
+            epoch=epoch_idx,
+            devloss=devloss,
+            evals=evals,
+        )
+        self.submit_write(checkpoint.write_snapshot, *snapshot, fp)
+        self.models.append(evaluation)
+        self.write_index(model_fp, self.models)
+
+    def submit_write(self, fn, *args):
+        """
+        run a checkpoint write, in the background with --async_save
+        """
+        if not self.params.async_save:
+            fn(*args)
+            return
+        if self.writer is None:
+            self.writer = checkpoint.BackgroundWriter()
+        self.writer.submit(fn, *args)
+
+    def wait_for_writes(self):
+        if self.writer is not None:
+            self.writer.wait()
+
+    def top_models(self, models: List[Evaluation], k):
+        """
+        the k best of `models` by select_model, in their original order
+        """
+        remaining, best = list(models), set()
+        while remaining and len(best) < k:
+            best_fp, _ = self.select_model(remaining)
+            best.add(best_fp)
+            remaining = [m for m in remaining if m.filepath != best_fp]
+        return [m for m in models if m.filepath in best]
+
+    def write_index(self, model_fp, models: List[Evaluation]):
+        """
+        list `models` in {model_fp}.index.json, read by smart_load_model
+        """
+        entries = [
+            dict(
+                filepath=m.filepath,
+                devloss=m.devloss,
+                evals=[[e.desc, e.long_desc, e.res] for e in m.evaluation_result or []],
+                epoch=m.epoch,
+            )
+            for m in models
+        ]
+        self.submit_write(checkpoint.write_index, f"{model_fp}.index.json", entries)
 
-    def select_model(self):
+    def select_model(self, models: Optional[List[Evaluation]] = None):
+        """
+        filepath of the best of `models` (default: the saved models) and the
+        filepaths to keep
+        """
         raise NotImplementedError
 
     def reload_and_test(self, model_fp, best_fp, batch_size, decode_fn):
@@ -343,9 +594,11 @@ class BaseTrainer(object):
                 self.logger.info(f'DEV {model_fp.split("/")[-1]} {results}')
         else:
             if self.data.test_file is not None:
-                self.calc_loss(TEST, batch_size, -1)
-                self.logger.info("decoding test set")
-                results, self.nll_list, self.entropy_list = self.decode(TEST, batch_size, f"{model_fp}.decode", decode_fn)
+                self.check_precision(batch_size, decode_fn)
+                with self.scoring_model():
+                    self.calc_loss(TEST, batch_size, -1)
+                    self.logger.info("decoding test set")
+                    results, self.nll_list, self.entropy_list = self.decode(TEST, batch_size, f"{model_fp}.decode", decode_fn)
                 if results:
                     for result in results:
                         self.logger.info(
@@ -354,36 +607,44 @@ class BaseTrainer(object):
                     results = " ".join([f"{r.desc} {r.res}" for r in results])
                     self.logger.info(f'TEST {model_fp.split("/")[-1]} {results}')
 
-    def cleanup(self, saveall, save_fps, model_fp):
+    def cleanup(self, saveall, save_fps, model_fp, keep_progress=False):
+        self.wait_for_writes()
         if not saveall:
             for model in self.models:
                 if model.filepath in save_fps:
                     continue
                 os.remove(model.filepath)
+            kept = [m for m in self.models if m.filepath in save_fps]
+            if os.path.exists(f"{model_fp}.index.json"):
+                self.write_index(model_fp, kept)
         progress_file = f"{model_fp}.progress"
-        if os.path.exists(progress_file):
+        if os.path.exists(progress_file) and not keep_progress:
             os.remove(progress_file)
 
-    def run(self, start_epoch, decode_fn=None):
+    def train_epochs(self, start_epoch, decode_fn=None, max_steps=None):
         """
-        helper for training
+        train and evaluate on dev until max steps (--max_steps unless given) or
+        early stopping, return whether training stopped early
         """
         self.checklist_before_run()
         finish = False
         params = self.params
-        steps_per_epoch = ceil(self.data.nb_train / params.bs)
-        if params.max_steps > 0:
-            max_epochs = ceil(params.max_steps / steps_per_epoch)
+        if max_steps is None:
+            max_steps = params.max_steps
+        steps_per_epoch = self.data.nb_batches(self.data.train_file, params.bs)
+        if max_steps > 0:
+            max_epochs = ceil(max_steps / steps_per_epoch)
         else:
             max_epochs = params.epochs
-        params.max_steps = max_epochs * steps_per_epoch
-        self.logger.info(
-            f"maximum training {params.max_steps} steps ({max_epochs} epochs)"
-        )
+        max_steps = max_epochs * steps_per_epoch
+        self.logger.info(f"maximum training {max_steps} steps ({max_epochs} epochs)")
         if params.total_eval > 0:
             eval_every = max(max_epochs // params.total_eval, 1)
         else:
             eval_every = 1
+        if params.eval_steps > 0:
+            self.logger.info(f"check the dev loss every {params.eval_steps} steps")
+            return self.train_steps(start_epoch, max_epochs, decode_fn)
         self.logger.info(f"evaluate every {eval_every} epochs")
 
 
@@ -391,8 +652,8 @@ class BaseTrainer(object):
             print("################################### self.params.seed", self.params.seed)
             self.train(epoch_idx, params.bs, params.max_norm)
             if not (
-                    epoch_idx
-                    and (epoch_idx % eval_every == 0 or epoch_idx + 1 == max_epochs)
+                    (epoch_idx and epoch_idx % eval_every == 0)
+                    or epoch_idx + 1 == max_epochs
             ):
                 continue
             with torch.no_grad():
@@ -403,17 +664,92 @@ class BaseTrainer(object):
                 break
             self.save_model(epoch_idx, devloss, eval_res, params.model)
             self.save_training(params.model)
+        return finish
+
+    def train_steps(self, start_epoch, max_epochs, decode_fn=None):
+        """
+        train_epochs with --eval_steps: a dev loss check every --eval_steps
+        steps and after the last one, see check_and_evaluate
+        """
+        params = self.params
+        self.best_check_loss = float("inf")
+        stop = False
+        if params.eval_margin >= 0:
+            self.logger.warning(
+                "evaluate only the checks within --eval_margin %g of the best loss, "
+                "the selected model can differ from evaluating every check",
+                params.eval_margin,
+            )
+
+        def on_step(epoch_idx):
+            nonlocal stop
+            if self.global_steps % params.eval_steps == 0:
+                stop = self.check_and_evaluate(epoch_idx, decode_fn)
+            return stop
+
+        for epoch_idx in range(start_epoch, max_epochs):
+            step_fn = partial(on_step, epoch_idx)
+            self.train(epoch_idx, params.bs, params.max_norm, step_fn)
+            if stop:
+                return True
+        if self.global_steps % params.eval_steps:
+            return self.check_and_evaluate(max_epochs - 1, decode_fn)
+        return False
+
+    def check_and_evaluate(self, epoch_idx, decode_fn):
+        """
+        check the loss on the dev subsample, which updates the lr and early
+        stopping at every check. evaluate on the whole dev set (loss and
+        decoding) and save the model, with --eval_margin only if the loss is
+        close to the best one. return whether training stops early
+        """
+        params = self.params
+        with torch.no_grad():
+            loss = self.check_loss(params.bs, epoch_idx)
+        if self.update_lr_and_stop_early(epoch_idx, loss, params.estop):
+            self.model.train()
+            return True
+        margin = params.eval_margin
+        if margin >= 0 and loss >= (1 + margin) * self.best_check_loss:
+            self.model.train()
+            return False
+        self.best_check_loss = min(loss, self.best_check_loss)
+        with torch.no_grad():
+            if params.eval_subsample > 0:
+                devloss = self.calc_loss(DEV, params.bs, epoch_idx)
+            else:
+                devloss = loss
+            eval_res = self.evaluate(DEV, params.bs, epoch_idx, decode_fn)
+        self.model.train()
+        self.save_model(epoch_idx, devloss, eval_res, params.model)
+        self.save_training(params.model)
+        return False
+
+    def sample_pool(self, num_samples=250, lang_code="kor"):
+        """
+        move samples from the pool (test) file to the train file according to
+        --sampling, return their pool indices
+        """
+        if self.params.sampling == "random":
+            return self.random_sampling(num_samples=num_samples)
+        elif self.params.sampling == "nll":
+            return self.al_sampling(self.params.sampling, self.nll_list, lang_code, num_samples)
+        elif self.params.sampling == "entropy":
+            return self.al_sampling(self.params.sampling, self.entropy_list, lang_code, num_samples)
+        elif self.params.sampling == "information_density":
+            return self.al_sampling(self.params.sampling, self.entropy_list, lang_code, num_samples)
+        # elif self.params.sampling == "ensemble":
+        return None
+
+    def run(self, start_epoch, decode_fn=None, max_steps=None):
+        """
+        helper for training
+        """
+        params = self.params
+        finish = self.train_epochs(start_epoch, decode_fn, max_steps)
         if finish or params.cleanup_anyway:
             best_fp, save_fps = self.select_model()
             with torch.no_grad():
                 self.reload_and_test(params.model, best_fp, params.bs, decode_fn)
             self.cleanup(params.saveall, save_fps, params.model)
-            if self.params.sampling == "random":
-                self.random_sampling(num_samples=250)
-            elif self.params.sampling == "nll":
-                self.al_sampling(self.params.sampling, self.nll_list, num_samples=250)
-            elif self.params.sampling == "entropy":
-                self.al_sampling(self.params.sampling, self.entropy_list, num_samples=250)
-            elif self.params.sampling == "information_density":
-                self.al_sampling(self.params.sampling, self.entropy_list, num_samples=250)
-            # elif self.params.sampling == "ensemble":
\ No newline at end of file
+            self.sample_pool()
\ No newline at end of file
@@ -1,4 +1,5 @@
 import math
+from collections import namedtuple
 
 import numpy as np
 import torch
@@ -9,6 +10,12 @@ from dataloader import PAD_IDX
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# incremental decoding state, one entry per decoder layer in `keys`, `values`,
+# `memory_keys` and `memory_values`; each is [bs, nb_heads, seq_len, head_dim]
+DecodeState = namedtuple(
+    "DecodeState", "keys values memory_keys memory_values memory_mask positions length"
+)
+
 
 class SinusoidalPositionalEmbedding(nn.Module):
     """This module produces sinusoidal positional embeddings of any length.
@@ -69,6 +76,21 @@ class SinusoidalPositionalEmbedding(nn.Module):
             .detach()
         )
 
+    def embed_positions(self, positions, max_pos):
+        """Embed precomputed positions of any shape, all smaller than `max_pos`."""
+        if self.weights is None or max_pos > self.weights.size(0):
+            self.weights = SinusoidalPositionalEmbedding.get_embedding(
+                max_pos,
+                self.embedding_dim,
+                self.padding_idx,
+            )
+        self.weights = self.weights.to(self._float_tensor)
+        return (
+            self.weights.index_select(0, positions.view(-1))
+            .view(*positions.shape, -1)
+            .detach()
+        )
+
 
 class TransformerEncoderLayer(nn.Module):
     def __init__(
@@ -214,6 +236,141 @@ class TransformerDecoderLayer(nn.Module):
             tgt = self.norm3(tgt)
         return tgt
 
+    def project_memory(self, memory):
+        """
+        cross attention keys and values of the encoder output, computed once per
+        sequence for incremental decoding
+
+        memory: [src_seq_len, bs, d_model]
+        """
+        attn = self.multihead_attn
+        _, w_k, w_v = attn.in_proj_weight.chunk(3)
+        _, b_k, b_v = attn.in_proj_bias.chunk(3)
+        key = split_heads(F.linear(memory, w_k, b_k), attn.num_heads)
+        value = split_heads(F.linear(memory, w_v, b_v), attn.num_heads)
+        return key, value
+
+    def forward_step(
+        self,
+        tgt,
+        prev_key,
+        prev_value,
+        memory_key,
+        memory_value,
+        memory_key_padding_mask=None,
+    ):
+        r"""Pass only the newest target position through the decoder layer.
+
+        Args:
+            tgt: the newest position of the sequence, [bs, d_model] (required).
+            prev_key: cached self attention keys of previous positions (optional).
+            prev_value: cached self attention values of previous positions (optional).
+            memory_key: the output of `project_memory` (required).
+            memory_value: the output of `project_memory` (required).
+            memory_key_padding_mask: the mask for the memory keys per batch (optional).
+        """
+        # self attention block
+        residual = tgt
+        if self.normalize_before:
+            tgt = self.norm1(tgt)
+        _, key, value = F.linear(
+            tgt, self.self_attn.in_proj_weight, self.self_attn.in_proj_bias
+        ).chunk(3, dim=-1)
+        key = split_heads(key.unsqueeze(0), self.self_attn.num_heads)
+        value = split_heads(value.unsqueeze(0), self.self_attn.num_heads)
+        if prev_key is not None:
+            key = torch.cat((prev_key, key), dim=2)
+            value = torch.cat((prev_value, value), dim=2)
+        tgt = attend_step(self.self_attn, tgt, key, value)
+        tgt = residual + self.dropout(tgt)
+        if not self.normalize_before:
+            tgt = self.norm1(tgt)
+        # cross attention block
+        residual = tgt
+        if self.normalize_before:
+            tgt = self.norm2(tgt)
+        tgt = attend_step(
+            self.multihead_attn,
+            tgt,
+            memory_key,
+            memory_value,
+            key_padding_mask=memory_key_padding_mask,
+        )
+        tgt = residual + self.dropout(tgt)
+        if not self.normalize_before:
+            tgt = self.norm2(tgt)
+        # feed forward block
+        residual = tgt
+        if self.normalize_before:
+            tgt = self.norm3(tgt)
+        tgt = self.activation(self.linear1(tgt))
+        tgt = self.activation_dropout(tgt)
+        tgt = self.linear2(tgt)
+        tgt = residual + self.dropout(tgt)
+        if not self.normalize_before:
+            tgt = self.norm3(tgt)
+        return tgt, (key, value)
+
+
+def split_heads(x, nb_heads):
+    """
+    [seq_len, bs, dim] -> [bs, nb_heads, seq_len, head_dim]
+    """
+    seq_len, bs, dim = x.shape
+    return x.view(seq_len, bs, nb_heads, dim // nb_heads).permute(1, 2, 0, 3)
+
+
+def attend_step(attn, query, key, value, key_padding_mask=None):
+    """
+    `nn.MultiheadAttention` for a single query position with precomputed
+    keys and values
+
+    query: [bs, dim], key & value: [bs, nb_heads, seq_len, head_dim]
+    key_padding_mask: [bs, seq_len], True for padding
+    """
+    bs, dim = query.shape
+    head_dim = dim // attn.num_heads
+    w_q, _, _ = attn.in_proj_weight.chunk(3)
+    b_q, _, _ = attn.in_proj_bias.chunk(3)
+    query = F.linear(query, w_q, b_q) * head_dim**-0.5
+    query = query.view(bs, attn.num_heads, 1, head_dim)
+    score = torch.matmul(query, key.transpose(-2, -1))
+    if key_padding_mask is not None:
+        score = score.masked_fill(
+            key_padding_mask.view(bs, 1, 1, -1), float("-inf")
+        )
+    prob = F.softmax(score, dim=-1)
+    prob = F.dropout(prob, p=attn.dropout, training=attn.training)
+    ctx = torch.matmul(prob, value).view(bs, dim)
+    return attn.out_proj(ctx)
+
+
+def reorder_decode_state(state, index, memory=True):
+    """
+    select batch entries of a DecodeState, e.g. surviving beams
+
+    the encoder memory can be kept when `index` only permutes entries sharing
+    the same source, as with beams of the same sentence
+    """
+    keys = [None if k is None else k.index_select(0, index) for k in state.keys]
+    values = [None if v is None else v.index_select(0, index) for v in state.values]
+    if memory:
+        memory_keys = [k.index_select(0, index) for k in state.memory_keys]
+        memory_values = [v.index_select(0, index) for v in state.memory_values]
+        memory_mask = state.memory_mask.index_select(0, index)
+    else:
+        memory_keys, memory_values = state.memory_keys, state.memory_values
+        memory_mask = state.memory_mask
+    return DecodeState(
+        keys,
+        values,
+        memory_keys,
+        memory_values,
+        memory_mask,
+        state.positions.index_select(0, index),
+        state.length,
+    )
+
 
 class Transformer(nn.Module):
     def __init__(
@@ -309,7 +466,76 @@ class Transformer(nn.Module):
             tgt_key_padding_mask=trg_mask,
             memory_key_padding_mask=src_mask,
         )
-        return F.log_softmax(self.final_out(dec_hs), dim=-1)
+        # the log probs, and so the loss, stay in fp32 under bf16 autocast
+        return F.log_softmax(self.final_out(dec_hs).float(), dim=-1)
+
+    def decoder_layers(self):
+        if isinstance(self.decoder, nn.TransformerDecoder):
+            return list(self.decoder.layers)
+        return [self.decoder.decoder_layer] * self.decoder.num_layers
+
+    def init_decode_state(self, enc_hs, src_mask):
+        """
+        empty incremental decoding state with cached encoder-memory projections
+        """
+        layers = self.decoder_layers()
+        memory_keys, memory_values = [], []
+        for layer in layers:
+            key, value = layer.project_memory(enc_hs)
+            memory_keys.append(key)
+            memory_values.append(value)
+        positions = torch.zeros(enc_hs.size(1), dtype=torch.long, device=enc_hs.device)
+        return DecodeState(
+            [None] * len(layers),
+            [None] * len(layers),
+            memory_keys,
+            memory_values,
+            src_mask,
+            positions,
+            0,
+        )
+
+    def decode_step(self, enc_hs, src_mask, trg_token, state):
+        """
+        decode only the newest target token, reusing the cached keys and values
+        of all previous tokens; matches `decode(...)[-1]` in eval mode
+
+        trg_token: [bs]
+        returns word_logprob: [bs, trg_vocab_size] and the updated state
+        """
+        non_pad = trg_token.ne(PAD_IDX).long()
+        positions = state.positions + non_pad
+        max_pos = PAD_IDX + 2 + state.length
+        word_embed = self.embed_scale * self.trg_embed(trg_token)
+        pos_embed = self.position_embed.embed_positions(
+            positions * non_pad + PAD_IDX, max_pos
+        )
+        dec_hs = self.dropout(word_embed + pos_embed)
+
+        keys, values = [], []
+        for i, layer in enumerate(self.decoder_layers()):
+            dec_hs, (key, value) = layer.forward_step(
+                dec_hs,
+                state.keys[i],
+                state.values[i],
+                state.memory_keys[i],
+                state.memory_values[i],
+                memory_key_padding_mask=state.memory_mask,
+            )
+            keys.append(key)
+            values.append(value)
+        if self.decoder.norm is not None:
+            dec_hs = self.decoder.norm(dec_hs)
+        state = DecodeState(
+            keys,
+            values,
+            state.memory_keys,
+            state.memory_values,
+            state.memory_mask,
+            positions,
+            state.length + 1,
+        )
+        return F.log_softmax(self.final_out(dec_hs).float(), dim=-1), state
 
     def forward(self, src_batch, src_mask, trg_batch, trg_mask):
         """
@@ -328,6 +554,42 @@ class Transformer(nn.Module):
         params = sum([np.prod(p.size()) for p in model_parameters])
         return params
 
+    def resize_vocab(self, src_c2i, trg_c2i, attr_c2i):
+        """
+        move a trained model to new symbol tables, e.g. grown by new characters
+        or tags: the embeddings and output rows of known symbols are kept, the
+        new ones initialized as in __init__. return whether the vocab changed
+        """
+        if (self.src_c2i, self.trg_c2i, self.attr_c2i) == (src_c2i, trg_c2i, attr_c2i):
+            return False
+        src_index = symbol_index(self.src_c2i, src_c2i)
+        if attr_c2i:
+            attr_index = symbol_index(self.attr_c2i or {}, attr_c2i)
+            src_index = [a + b for a, b in zip(src_index, attr_index)]
+        trg_index = symbol_index(self.trg_c2i, trg_c2i)
+        src_vocab_size = len(src_c2i) + len(attr_c2i or {})
+        trg_vocab_size = len(trg_c2i)
+
+        device = self.final_out.weight.device
+        src_embed = Embedding(src_vocab_size, self.embed_dim, padding_idx=PAD_IDX)
+        trg_embed = Embedding(trg_vocab_size, self.embed_dim, padding_idx=PAD_IDX)
+        final_out = Linear(self.embed_dim, trg_vocab_size)
+        src_embed, trg_embed = src_embed.to(device), trg_embed.to(device)
+        final_out = final_out.to(device)
+        with torch.no_grad():
+            new, old = src_index
+            src_embed.weight[new] = self.src_embed.weight[old]
+            new, old = trg_index
+            trg_embed.weight[new] = self.trg_embed.weight[old]
+            final_out.weight[new] = self.final_out.weight[old]
+            final_out.bias[new] = self.final_out.bias[old]
+        self.src_embed, self.trg_embed, self.final_out = src_embed, trg_embed, final_out
+        if self.tie_trg_embed:
+            self.final_out.weight = self.trg_embed.weight
+        self.src_vocab_size, self.trg_vocab_size = src_vocab_size, trg_vocab_size
+        self.src_c2i, self.trg_c2i, self.attr_c2i = src_c2i, trg_c2i, attr_c2i
+        return True
+
     def loss(self, predict, target, reduction=True):
         """
         compute loss
@@ -377,6 +639,11 @@ class TagTransformer(Transformer):
         # 0 -> special token & tags, 1 -> character
         self.special_embeddings = Embedding(2, self.embed_dim)
 
+    def resize_vocab(self, src_c2i, trg_c2i, attr_c2i):
+        resized = super().resize_vocab(src_c2i, trg_c2i, attr_c2i)
+        self.nb_attr = len(attr_c2i)
+        return resized
+
     def embed(self, src_batch, src_mask):
         word_embed = self.embed_scale * self.src_embed(src_batch)
         char_mask = (src_batch < (self.src_vocab_size - self.nb_attr)).long()
@@ -478,6 +745,14 @@ class TagUniversalTransformer(TagTransformer, UniversalTransformer):
     pass
 
 
+def symbol_index(old_c2i, new_c2i):
+    """
+    (new indices, old indices) of the symbols in both symbol tables
+    """
+    shared = [c for c in new_c2i if c in old_c2i]
+    return [new_c2i[c] for c in shared], [old_c2i[c] for c in shared]
+
+
 def Embedding(num_embeddings, embedding_dim, padding_idx=None):
     m = nn.Embedding(num_embeddings, embedding_dim, padding_idx=padding_idx)
     nn.init.normal_(m.weight, mean=0, std=embedding_dim**-0.5)
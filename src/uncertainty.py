@@ -0,0 +1,108 @@
+"""
+batched uncertainty statistics over n-best lists
+"""
+from collections import namedtuple
+
+import torch
+import torch.nn.functional as F
+
+# hypotheses below this probability are ignored by the entropy
+ENTROPY_THRESHOLD = 0.05
+
+Uncertainty = namedtuple("Uncertainty", "probs entropy margin least_confidence nll")
+
+
+def thresholded_entropy(probs, threshold=ENTROPY_THRESHOLD):
+    """
+    entropy over the last dimension, only counting probabilities >= threshold
+
+    probs: [..., nb_hyp], zero for padding
+    """
+    keep = probs >= threshold
+    plogp = torch.where(
+        keep, probs * probs.clamp_min(1e-12).log(), torch.zeros_like(probs)
+    )
+    return -plogp.sum(dim=-1)
+
+
+def nbest_uncertainty(scores, lengths, threshold=ENTROPY_THRESHOLD):
+    """
+    uncertainty statistics of a padded n-best list for the whole batch
+
+    scores: [bs, nb_hyp], length normalized log prob, padded with -inf
+    lengths: [bs, nb_hyp], hypothesis length used for the normalization
+
+    returns Uncertainty with
+        probs: [bs, nb_hyp], softmax over the unnormalized log prob, zero for padding
+        entropy: [bs], entropy over hypotheses with probability >= threshold
+        margin: [bs], difference between the two most probable hypotheses
+        least_confidence: [bs], one minus the probability of the best hypothesis
+        nll: [bs], negative length normalized log prob of the best hypothesis,
+            inf for rows without hypothesis
+    """
+    valid = torch.isfinite(scores)
+    log_prob = scores * lengths
+    log_prob = log_prob.masked_fill(~valid, float("-inf"))
+    has_hyp = valid.any(dim=1, keepdim=True)
+    # rows without hypothesis would softmax to nan
+    probs = F.softmax(log_prob.masked_fill(~has_hyp, 0), dim=1)
+    probs = probs.masked_fill(~valid, 0)
+
+    entropy = thresholded_entropy(probs, threshold)
+
+    if probs.size(1) > 1:
+        top2 = probs.topk(2, dim=1).values
+        margin = top2[:, 0] - top2[:, 1]
+    else:
+        margin = probs[:, 0]
+    least_confidence = 1 - probs.max(dim=1).values
+    least_confidence = least_confidence.masked_fill(~has_hyp.squeeze(1), 0)
+
+    nll = -scores.max(dim=1).values
+    return Uncertainty(probs, entropy, margin, least_confidence, nll)
+
+
+EnsembleUncertainty = namedtuple(
+    "EnsembleUncertainty", "probs entropy vote_entropy mutual_information nll"
+)
+
+
+def ensemble_uncertainty(scores, member_log_probs, threshold=ENTROPY_THRESHOLD):
+    """
+    agreement statistics of an ensemble over a padded n-best list
+
+    scores: [bs, nb_hyp], length normalized log prob under the combined model,
+        padded with -inf
+    member_log_probs: [nb_model, bs, nb_hyp], log prob of each hypothesis under
+        each member
+
+    returns EnsembleUncertainty with
+        probs: [bs, nb_hyp], mean over the members of their posterior over the
+            n-best list, zero for padding
+        entropy: [bs], entropy of probs over hypotheses with probability >= threshold
+        vote_entropy: [bs], entropy of the votes of the members for their most
+            probable hypothesis
+        mutual_information: [bs], entropy of probs minus the mean entropy of
+            the members (disagreement between the members)
+        nll: [bs], negative length normalized log prob of the best hypothesis
+    """
+    valid = torch.isfinite(scores)
+    has_hyp = valid.any(dim=1, keepdim=True)
+    log_prob = member_log_probs.masked_fill(~valid, float("-inf"))
+    # rows without hypothesis would softmax to nan
+    member_probs = F.softmax(log_prob.masked_fill(~has_hyp, 0), dim=-1)
+    member_probs = member_probs.masked_fill(~valid, 0)
+    probs = member_probs.mean(dim=0)
+
+    entropy = thresholded_entropy(probs, threshold)
+    total = thresholded_entropy(probs, 0)
+    expected = thresholded_entropy(member_probs, 0).mean(dim=0)
+    mutual_information = (total - expected).clamp_min(0)
+
+    nb_model = member_probs.size(0)
+    votes = F.one_hot(member_probs.argmax(dim=-1), member_probs.size(-1))
+    votes = votes.sum(dim=0).float().masked_fill(~has_hyp, 0) / nb_model
+    vote_entropy = thresholded_entropy(votes, 0)
+
+    nll = -scores.max(dim=1).values
+    return EnsembleUncertainty(probs, entropy, vote_entropy, mutual_information, nll)
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import os
 import random
@@ -11,11 +12,12 @@ from enum import Enum
 from functools import partial
 from typing import List
 
-import numpy as np
+import torch
 from torch.optim.lr_scheduler import LambdaLR
 from tqdm import tqdm
 
-from dataloader import BOS_IDX, EOS_IDX, STEP_IDX
+from dataloader import STEP_IDX, split_trimmed, trim_batch
+from levenshtein import edit_distances
 
 tqdm = partial(tqdm, bar_format="{l_bar}{r_bar}")
 
@@ -25,6 +27,21 @@ class NamedEnum(Enum):
         return self.value
 
 
+class Precision(NamedEnum):
+    fp32 = "fp32"
+    bf16 = "bf16"
+
+
+def autocast(precision, device_type="cpu"):
+    """
+    autocast region of a precision: with bf16, matmuls and convolutions run in
+    bfloat16 and precision sensitive ops such as softmax stay in float32
+    """
+    if precision == Precision.bf16:
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
 def grad_norm(parameters, norm_type=2):
     parameters = list(filter(lambda p: p.grad is not None, parameters))
     norm_type = float(norm_type)
@@ -118,25 +135,7 @@ def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
 
 
 def unpack_batch(batch):
-    if isinstance(batch, list) and isinstance(batch[0], list):
-        return [
-            [char for char in seq if char != BOS_IDX and char != EOS_IDX]
-            for seq in batch
-        ]
-    batch = batch.transpose(0, 1).cpu().numpy()
-    bs, seq_len = batch.shape
-    output = []
-    for i in range(bs):
-        seq = []
-        for j in range(seq_len):
-            elem = batch[i, j]
-            if elem == BOS_IDX:
-                continue
-            if elem == EOS_IDX:
-                break
-            seq.append(elem)
-        output.append(seq)
-    return output
+    return split_trimmed(*trim_batch(batch))
 
 
 @dataclass
@@ -188,22 +187,22 @@ class BasicEvaluator(Evaluator):
         """
         evaluate single instance
         """
-        correct = 1
-        if len(predict) == len(ground_truth):
-            for elem1, elem2 in zip(predict, ground_truth):
-                if elem1 != elem2:
-                    correct = 0
-                    break
-        else:
-            correct = 0
-        dist = edit_distance(predict, ground_truth)
-        return correct, dist
+        return self.evaluate_batch([predict], [ground_truth])[0]
+
+    def evaluate_batch(self, predicts, ground_truths):
+        """
+        evaluate a batch of instances, edit distances computed at once
+        """
+        dists = edit_distances(predicts, ground_truths)
+        return [
+            (int(len(p) == len(t) and all(x == y for x, y in zip(p, t))), dist)
+            for p, t, dist in zip(predicts, ground_truths, dists)
+        ]
 
     def add(self, source, predict, target):
         predict = unpack_batch(predict)
         target = unpack_batch(target)
-        for p, t in zip(predict, target):
-            correct, distance = self.evaluate(p, t)
+        for correct, distance in self.evaluate_batch(predict, target):
             self.correct += correct
             self.distance += distance
             self.nb_sample += 1
@@ -220,9 +219,9 @@ class BasicEvaluator(Evaluator):
 
 
 class HistnormEvaluator(BasicEvaluator):
-    def evaluate(self, predict, ground_truth):
-        correct, dist = super().evaluate(predict, ground_truth)
-        return correct, dist / len(ground_truth)
+    def evaluate_batch(self, predicts, ground_truths):
+        evals = super().evaluate_batch(predicts, ground_truths)
+        return [(c, d / len(t)) for (c, d), t in zip(evals, ground_truths)]
 
 
 class G2PEvaluator(BasicEvaluator):
@@ -232,16 +231,15 @@ class G2PEvaluator(BasicEvaluator):
     def reset(self):
         self.src_dict = defaultdict(list)
 
-    def evaluate(self, predict, ground_truth):
-        correct, dist = super().evaluate(predict, ground_truth)
-        return correct, dist / len(ground_truth)
+    def evaluate_batch(self, predicts, ground_truths):
+        evals = super().evaluate_batch(predicts, ground_truths)
+        return [(c, d / len(t)) for (c, d), t in zip(evals, ground_truths)]
 
     def add(self, source, predict, target):
         source = unpack_batch(source)
         predict = unpack_batch(predict)
         target = unpack_batch(target)
-        for s, p, t in zip(source, predict, target):
-            correct, distance = self.evaluate(p, t)
+        for s, (correct, distance) in zip(source, self.evaluate_batch(predict, target)):
             self.src_dict[str(s)].append((correct, distance))
 
     def compute(self, reset=True):
@@ -275,13 +273,13 @@ class P2GEvaluator(G2PEvaluator):
 class PairBasicEvaluator(BasicEvaluator):
     """docstring for PairBasicEvaluator"""
 
-    def evaluate(self, predict, ground_truth):
+    def evaluate_batch(self, predicts, ground_truths):
         """
-        evaluate single instance
+        evaluate a batch of instances, ignoring the step symbol
         """
-        predict = [x for x in predict if x != STEP_IDX]
-        ground_truth = [x for x in ground_truth if x != STEP_IDX]
-        return super().evaluate(predict, ground_truth)
+        predicts = [[x for x in p if x != STEP_IDX] for p in predicts]
+        ground_truths = [[x for x in t if x != STEP_IDX] for t in ground_truths]
+        return super().evaluate_batch(predicts, ground_truths)
 
 
 class PairG2PEvaluator(PairBasicEvaluator, G2PEvaluator):
@@ -301,8 +299,8 @@ class TranslitEvaluator(BasicEvaluator):
         source = unpack_batch(source)
         predict = unpack_batch(predict)
         target = unpack_batch(target)
-        for s, p, t in zip(source, predict, target):
-            correct, distance = self.evaluate(p, t)
+        evals = self.evaluate_batch(predict, target)
+        for s, p, t, (correct, distance) in zip(source, predict, target, evals):
             self.src_dict[str(s)].append((correct, distance, len(p), len(t)))
 
     def compute(self, reset=True):
@@ -343,19 +341,5 @@ class PairTranslitEvaluator(PairBasicEvaluator, TranslitEvaluator):
 
 
 def edit_distance(str1, str2):
-    """Simple Levenshtein implementation for evalm."""
-    table = np.zeros([len(str2) + 1, len(str1) + 1])
-    for i in range(1, len(str2) + 1):
-        table[i][0] = table[i - 1][0] + 1
-    for j in range(1, len(str1) + 1):
-        table[0][j] = table[0][j - 1] + 1
-    for i in range(1, len(str2) + 1):
-        for j in range(1, len(str1) + 1):
-            if str1[j - 1] == str2[i - 1]:
-                dg = 0
-            else:
-                dg = 1
-            table[i][j] = min(
-                table[i - 1][j] + 1, table[i][j - 1] + 1, table[i - 1][j - 1] + dg
-            )
-    return int(table[len(str2)][len(str1)])
+    """Levenshtein distance of a single pair, see levenshtein.edit_distances."""
+    return edit_distances([str1], [str2])[0]